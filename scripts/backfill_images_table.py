@@ -0,0 +1,63 @@
+"""
+Backfill derived keys on image metadata written before they existed:
+
+  - image#<imageId> pointer items, used to resolve an imageId with GetItem instead of the imageId-index GSI
+    (handlers fall back to the GSI while a pointer is missing).
+  - userStatus (user#<userId>#<status>), the partition key of the sparse userStatus-index used by list_images
+    status filtering (items without it are not returned for status filtered listings).
+
+Safe to re-run; it only needs to run once per table after deploying.
+
+    python scripts/backfill_images_table.py --table images-table
+"""
+import argparse
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+
+def pointer_for(item):
+    pointer = {"PK": f"image#{item['imageId']}", "SK": f"image#{item['imageId']}",
+               "itemPK": item["PK"], "itemSK": item["SK"]}
+    if item.get("userId"):
+        pointer["userId"] = item["userId"]
+    return pointer
+
+
+def backfill(table_name, dry_run=False):
+    table = boto3.resource("dynamodb").Table(table_name)
+    scan_args = {
+        "FilterExpression": Attr("SK").begins_with("createdAt#") & Attr("imageId").exists(),
+        "ProjectionExpression": "PK, SK, imageId, userId, #s, userStatus",
+        "ExpressionAttributeNames": {"#s": "status"},
+    }
+    pointers = statuses = 0
+    with table.batch_writer(overwrite_by_pkeys=["PK", "SK"]) as batch:
+        while True:
+            resp = table.scan(**scan_args)
+            for item in resp.get("Items", []):
+                pointers += 1
+                if not dry_run:
+                    batch.put_item(Item=pointer_for(item))
+
+                expected = f"{item['PK']}#{item['status']}" if item.get("status") else None
+                if expected and item.get("userStatus") != expected:
+                    statuses += 1
+                    if not dry_run:
+                        table.update_item(Key={"PK": item["PK"], "SK": item["SK"]},
+                                          UpdateExpression="SET userStatus = :us",
+                                          ConditionExpression="#s = :s",
+                                          ExpressionAttributeNames={"#s": "status"},
+                                          ExpressionAttributeValues={":us": expected, ":s": item["status"]})
+            if not resp.get("LastEvaluatedKey"):
+                break
+            scan_args["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return pointers, statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", required=True, help="images table name")
+    parser.add_argument("--dry-run", action="store_true", help="count items without writing")
+    args = parser.parse_args()
+    pointers, statuses = backfill(args.table, args.dry_run)
+    print(f"pointers_written={pointers} user_status_updated={statuses}")
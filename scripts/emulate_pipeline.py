@@ -0,0 +1,350 @@
+"""
+Run the upload pipeline locally under synthetic load, on moto in-process (no deployment, no Docker):
+
+  initiate_upload -> PUT original -> S3 notification -> upload_router -> lane queue (SQS, with DLQ)
+  -> image_processor.handler (one module per lane) -> DynamoDB AVAILABLE / REJECTED
+
+The lane queues and their consumers use PROCESSING_LANES, the settings S3Stack deploys: visibility timeout,
+maxReceiveCount, batch size, batching window, consumer concurrency and MAX_WORKERS. A poller per concurrent
+consumer emulates the SQS event source: it gathers a batch (up to the batching window), invokes the handler
+and deletes every message not reported in batchItemFailures. Failed messages come back after the visibility
+timeout and go to the lane's DLQ after maxReceiveCount receives.
+
+Reports end-to-end latency from upload to the processed message (per lane), throughput, invocations and
+DLQ counts. Everything runs in one process, so absolute numbers reflect this machine's cores rather than
+Lambda's; use it to compare settings and code changes under the same load.
+
+    python scripts/emulate_pipeline.py --images 200 --rate 20 --heavy-ratio 0.2
+    python scripts/emulate_pipeline.py --images 100 --error-rate 0.3 --time-scale 0.02 --json report.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+API_LAMBDAS = os.path.join(ROOT, "stacks", "api_stack", "lambdas")
+S3_LAMBDAS = os.path.join(ROOT, "stacks", "s3_stack", "lambdas")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "stacks", "shared", "python_layer"), S3_LAMBDAS, API_LAMBDAS]
+
+import boto3
+from moto import mock_dynamodb, mock_s3, mock_sqs
+from moto.core.botocore_stubber import BotocoreStubber
+from stacks.benchmarking import percentile, synthetic_image
+from stacks.constants import FAST_LANE_MAX_BYTES, PROCESSING_LANES
+
+REGION = "us-east-1"
+TABLE = "images-table"
+BUCKET = "images-bucket"
+# Originals of the synthetic load: small ones route to the fast lane, large ones to the heavy lane.
+SMALL = {"JPEG": ((1280, 960), {"quality": 85}), "PNG": ((800, 600), {}), "WEBP": ((1280, 960), {"quality": 80})}
+LARGE = {"JPEG": ((4032, 3024), {"quality": 90}), "PNG": ((2560, 1440), {}), "WEBP": ((3000, 2000), {"quality": 85})}
+EXTENSIONS = {"JPEG": ("jpg", "image/jpeg"), "PNG": ("png", "image/png"), "WEBP": ("webp", "image/webp")}
+# Pollers short poll (a long poll would hold the moto lock below) and sleep this long when the queue is empty.
+IDLE_SECONDS = 0.05
+
+
+def serialize_service_calls():
+    """
+    moto's in-memory backends are not thread-safe (concurrent writes to a table fail), so emulated service
+    calls run one at a time. Handler code, decoding and encoding still run concurrently.
+    """
+    lock = threading.RLock()
+    call = BotocoreStubber.__call__
+
+    def locked(self, *args, **kwargs):
+        with lock:
+            return call(self, *args, **kwargs)
+    BotocoreStubber.__call__ = locked
+
+
+def create_resources():
+    dynamodb = boto3.client("dynamodb", region_name=REGION)
+    dynamodb.create_table(
+        TableName=TABLE,
+        KeySchema=[{"AttributeName": "PK", "KeyType": "HASH"}, {"AttributeName": "SK", "KeyType": "RANGE"}],
+        AttributeDefinitions=[{"AttributeName": name, "AttributeType": "S"}
+                              for name in ("PK", "SK", "imageId", "createdAt", "userStatus")],
+        GlobalSecondaryIndexes=[
+            {"IndexName": "imageId-index", "Projection": {"ProjectionType": "ALL"},
+             "KeySchema": [{"AttributeName": "imageId", "KeyType": "HASH"}, {"AttributeName": "createdAt", "KeyType": "RANGE"}]},
+            {"IndexName": "userStatus-index", "Projection": {"ProjectionType": "ALL"},
+             "KeySchema": [{"AttributeName": "userStatus", "KeyType": "HASH"}, {"AttributeName": "SK", "KeyType": "RANGE"}]},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    boto3.client("s3", region_name=REGION).create_bucket(Bucket=BUCKET)
+
+
+def create_queues(time_scale):
+    """Lane queue and DLQ per lane, with the stack's visibility timeout (scaled) and maxReceiveCount."""
+    sqs = boto3.client("sqs", region_name=REGION)
+    queues = {}
+    for lane, settings in PROCESSING_LANES.items():
+        dlq_url = sqs.create_queue(QueueName=f"{lane}-dlq")["QueueUrl"]
+        dlq_arn = sqs.get_queue_attributes(QueueUrl=dlq_url, AttributeNames=["QueueArn"])["Attributes"]["QueueArn"]
+        visibility = max(1, round(settings["timeout"] * time_scale))
+        queue_url = sqs.create_queue(QueueName=lane, Attributes={
+            "VisibilityTimeout": str(visibility),
+            "RedrivePolicy": json.dumps({"deadLetterTargetArn": dlq_arn, "maxReceiveCount": settings["max_receive_count"]}),
+        })["QueueUrl"]
+        queues[lane] = (queue_url, dlq_url)
+    return queues
+
+
+def load_processor(lane, queue_url):
+    """A separate image_processor module per lane, configured like its function (workers, lease, decode budget)."""
+    settings = PROCESSING_LANES[lane]
+    os.environ.update({"QUEUE_URL": queue_url, "MAX_WORKERS": str(settings["max_workers"]),
+                       "PROCESSING_LEASE_SECONDS": str(settings["timeout"]),
+                       "DECODE_BUDGET_PIXELS": str(settings["memory_size"] * 120_000)})
+    spec = importlib.util.spec_from_file_location(f"image_processor_{lane}", os.path.join(S3_LAMBDAS, "image_processor.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploaded = {}
+        self.done = {}
+        self.invocations = {lane: 0 for lane in PROCESSING_LANES}
+        self.batch_sizes = {lane: [] for lane in PROCESSING_LANES}
+        self.item_failures = {lane: 0 for lane in PROCESSING_LANES}
+        self.crashes = {lane: 0 for lane in PROCESSING_LANES}
+
+    def uploaded_at(self, key):
+        with self.lock:
+            self.uploaded[key] = time.monotonic()
+
+    def processed(self, lane, keys):
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                self.done.setdefault(key, (lane, now))
+
+
+def message_keys(message):
+    try:
+        return [rec["s3"]["object"]["key"] for rec in json.loads(message["Body"]).get("Records", [])]
+    except (ValueError, KeyError, AttributeError):
+        return []
+
+
+def poll(lane, queue_url, processor, stats, stop, time_scale, error_rate):
+    """One concurrent consumer of a lane, as the SQS event source mapping runs it."""
+    settings = PROCESSING_LANES[lane]
+    sqs = boto3.client("sqs", region_name=REGION)
+    window = (settings["max_batching_window"] or 0) * time_scale
+    while not stop.is_set():
+        batch, started = [], None
+        while len(batch) < settings["batch_size"] and not stop.is_set():
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=min(10, settings["batch_size"] - len(batch)),
+                                           WaitTimeSeconds=0, AttributeNames=["ApproximateReceiveCount"]).get("Messages", [])
+            batch.extend(messages)
+            if batch and started is None:
+                started = time.monotonic()
+            if batch and time.monotonic() - started >= window:
+                break
+            if not messages:
+                time.sleep(IDLE_SECONDS)
+        if not batch:
+            continue
+
+        with stats.lock:
+            stats.invocations[lane] += 1
+            stats.batch_sizes[lane].append(len(batch))
+        if random.random() < error_rate:
+            # A crashed or timed out invocation: nothing is deleted, the whole batch comes back.
+            with stats.lock:
+                stats.crashes[lane] += 1
+            continue
+        event = {"Records": [{"messageId": m["MessageId"], "receiptHandle": m["ReceiptHandle"], "body": m["Body"],
+                              "attributes": m.get("Attributes", {}), "eventSource": "aws:sqs"} for m in batch]}
+        try:
+            failed = {f["itemIdentifier"] for f in processor.handler(event, None)["batchItemFailures"]}
+        except Exception:
+            failed = {m["MessageId"] for m in batch}
+        with stats.lock:
+            stats.item_failures[lane] += len(failed)
+        succeeded = [m for m in batch if m["MessageId"] not in failed]
+        for start in range(0, len(succeeded), 10):
+            sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+                {"Id": str(i), "ReceiptHandle": m["ReceiptHandle"]} for i, m in enumerate(succeeded[start:start + 10])])
+        stats.processed(lane, [key for m in succeeded for key in message_keys(m)])
+
+
+def corpus(formats):
+    """Encoded originals per (size class, format); every upload appends unique bytes so no two share a contentHash."""
+    return {(size_class, fmt): synthetic_image(size, fmt, **options)
+            for size_class, sizes in (("small", SMALL), ("large", LARGE))
+            for fmt, (size, options) in sizes.items() if fmt in formats}
+
+
+def upload(n, args, images, initiate_upload, upload_router, stats):
+    """One synthetic upload: initiate, PUT the original and deliver the S3 notification to the router."""
+    rng = random.Random(n)
+    fmt = rng.choice(args.formats)
+    size_class = "large" if rng.random() < args.heavy_ratio else "small"
+    extension, content_type = EXTENSIONS[fmt]
+    body = images[(size_class, fmt)] + os.urandom(16)
+    if rng.random() < args.corrupt_rate:
+        body = body[:64] + os.urandom(len(body) - 64)
+
+    request = {"userId": f"user{n % args.users}", "filename": f"img{n}.{extension}", "contentType": content_type}
+    resp = initiate_upload.handler({"body": json.dumps(request)}, None)
+    if resp["statusCode"] != 200:
+        raise RuntimeError(f"initiate_upload returned {resp['statusCode']}: {resp['body']}")
+    key = json.loads(resp["body"])["upload"]["fields"]["key"]
+    boto3.client("s3", region_name=REGION).put_object(Bucket=BUCKET, Key=key, Body=body, ContentType=content_type)
+    stats.uploaded_at(key)
+    upload_router.handler({"Records": [{"eventSource": "aws:s3", "eventName": "ObjectCreated:Put",
+                                        "s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "size": len(body)}}}]}, None)
+
+
+def queue_depth(sqs, url):
+    attributes = sqs.get_queue_attributes(QueueUrl=url, AttributeNames=["ApproximateNumberOfMessages"])["Attributes"]
+    return int(attributes["ApproximateNumberOfMessages"])
+
+
+def item_statuses():
+    table = boto3.resource("dynamodb", region_name=REGION).Table(TABLE)
+    counts, scan_args = {}, {"ProjectionExpression": "SK, #s", "ExpressionAttributeNames": {"#s": "status"}}
+    while True:
+        resp = table.scan(**scan_args)
+        for item in resp["Items"]:
+            if item["SK"].startswith("createdAt#"):
+                counts[item["status"]] = counts.get(item["status"], 0) + 1
+        if "LastEvaluatedKey" not in resp:
+            return counts
+        scan_args["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def summary(values):
+    if not values:
+        return None
+    return {"count": len(values), "p50_ms": round(percentile(values, 50), 1), "p95_ms": round(percentile(values, 95), 1),
+            "p99_ms": round(percentile(values, 99), 1), "max_ms": round(max(values), 1)}
+
+
+def run(args):
+    os.environ.update({"AWS_DEFAULT_REGION": REGION, "AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                       "IMAGES_TABLE": TABLE, "IMAGES_BUCKET": BUCKET, "FAST_LANE_MAX_BYTES": str(FAST_LANE_MAX_BYTES),
+                       # moto 4 stores aws-chunked (checksummed) PutObject bodies over 1 MiB corrupted.
+                       "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"})
+    create_resources()
+    queues = create_queues(args.time_scale)
+    os.environ.update({"FAST_QUEUE_URL": queues["fast"][0], "HEAVY_QUEUE_URL": queues["heavy"][0]})
+    import initiate_upload
+    import upload_router
+    processors = {lane: load_processor(lane, queue_url) for lane, (queue_url, _) in queues.items()}
+    print("generating the corpus...", file=sys.stderr)
+    images = corpus(args.formats)
+
+    stats, stop = Stats(), threading.Event()
+    pollers = [threading.Thread(target=poll, daemon=True,
+                                args=(lane, queues[lane][0], processors[lane], stats, stop, args.time_scale, args.error_rate))
+               for lane, settings in PROCESSING_LANES.items()
+               for _ in range(min(settings["max_concurrency"], args.max_concurrency or settings["max_concurrency"]))]
+    for poller in pollers:
+        poller.start()
+
+    print(f"uploading {args.images} images...", file=sys.stderr)
+    sqs = boto3.client("sqs", region_name=REGION)
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.uploaders) as uploaders:
+            futures = []
+            for n in range(args.images):
+                if args.rate:
+                    time.sleep(max(0, start + n / args.rate - time.monotonic()))
+                futures.append(uploaders.submit(upload, n, args, images, initiate_upload, upload_router, stats))
+        for future in futures:
+            future.result()
+        while time.monotonic() - start < args.max_seconds:
+            dead_lettered = sum(queue_depth(sqs, dlq_url) for _, dlq_url in queues.values())
+            if len(stats.done) + dead_lettered >= args.images:
+                break
+            time.sleep(0.2)
+        elapsed = time.monotonic() - start
+    finally:
+        # Pollers must be done before the mocks stop, or they would call the real endpoints.
+        stop.set()
+        for poller in pollers:
+            poller.join()
+
+    latencies = {lane: [] for lane in PROCESSING_LANES}
+    for key, (lane, finished) in stats.done.items():
+        latencies[lane].append((finished - stats.uploaded[key]) * 1000)
+    finished_at = max((finished for _, finished in stats.done.values()), default=start)
+    return {
+        "images": args.images,
+        "processed": len(stats.done),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(len(stats.done) / max(finished_at - start, 1e-6), 2),
+        "latency": {"all": summary([v for values in latencies.values() for v in values]),
+                    **{lane: summary(values) for lane, values in latencies.items()}},
+        "lanes": {lane: {"invocations": stats.invocations[lane],
+                         "mean_batch_size": round(sum(stats.batch_sizes[lane]) / max(len(stats.batch_sizes[lane]), 1), 2),
+                         "batch_item_failures": stats.item_failures[lane],
+                         "crashed_invocations": stats.crashes[lane],
+                         "queue_depth": queue_depth(sqs, queue_url),
+                         "dlq": queue_depth(sqs, dlq_url)}
+                  for lane, (queue_url, dlq_url) in queues.items()},
+        "statuses": item_statuses(),
+        "settings": {"time_scale": args.time_scale, "rate": args.rate, "heavy_ratio": args.heavy_ratio,
+                     "formats": args.formats, "error_rate": args.error_rate, "corrupt_rate": args.corrupt_rate},
+    }
+
+
+def print_report(report):
+    print(f"{report['processed']}/{report['images']} images processed in {report['elapsed_s']} s, "
+          f"{report['throughput_per_s']} images/s")
+    print(f"statuses: {report['statuses']}")
+    for lane in ("all", *PROCESSING_LANES):
+        latency = report["latency"][lane]
+        if latency:
+            print(f"latency {lane:>5}: n={latency['count']} p50={latency['p50_ms']} ms p95={latency['p95_ms']} ms "
+                  f"p99={latency['p99_ms']} ms max={latency['max_ms']} ms")
+    for lane, lane_stats in report["lanes"].items():
+        print(f"lane {lane:>5}: " + ", ".join(f"{name}={value}" for name, value in lane_stats.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=200, help="uploads to generate")
+    parser.add_argument("--rate", type=float, default=20, help="uploads per second (0: all at once)")
+    parser.add_argument("--heavy-ratio", type=float, default=0.2, help="fraction of large originals (heavy lane)")
+    parser.add_argument("--formats", type=lambda v: v.upper().split(","), default=["JPEG", "PNG", "WEBP"])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--uploaders", type=int, default=8, help="concurrent upload clients")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="fraction of uploads with garbage after the header (mostly REJECTED)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of invocations that crash; their batches are redelivered and may reach the DLQ")
+    parser.add_argument("--time-scale", type=float, default=0.1,
+                        help="factor on the batching windows and visibility timeouts (1: as deployed)")
+    parser.add_argument("--max-concurrency", type=int, default=0,
+                        help="cap on concurrent consumers per lane (default: the lane's max_concurrency)")
+    parser.add_argument("--max-seconds", type=float, default=600, help="give up waiting after this long")
+    parser.add_argument("--logs", default=os.devnull, help="file for the handlers' JSON logs and EMF records")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    serialize_service_calls()
+    with mock_s3(), mock_dynamodb(), mock_sqs(), open(args.logs, "w") as logs, contextlib.redirect_stdout(logs):
+        report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Recount the per-user usage items (user#<userId> / usage) from the image items.
+
+The usage aggregator only sees the images whose stream records arrive after the table stream was enabled, so
+run this once after deploying it to seed the libraries that already exist, and again whenever the aggregates
+are suspect (records sent to the usage aggregator DLQ). Safe to run alongside the live stream:
+
+  - The user's item is read first. The recount is written only if the stream has not updated it since, so an
+    update is never overwritten; such users are recounted again.
+  - The written item has recountedAt, a whole second taken before its images were read. The aggregator skips
+    stream records from before it, which the recount already holds, and applies the later ones.
+
+A change that lands while a user's images are being read (a few milliseconds) may still be counted twice;
+re-running fixes it.
+
+    python scripts/recount_usage.py --table images-table
+"""
+import argparse
+import time
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+USAGE_SK = "usage"
+# lastSequence of users the stream has not counted yet; every stream sequence number compares greater.
+NO_SEQUENCE = "0" * 40
+USERS_PER_ROUND = 100
+ATTEMPTS = 5
+
+
+def user_partitions(table):
+    """PKs of the users with image items or a usage item."""
+    scan_args = {"FilterExpression": Attr("PK").begins_with("user#") & (Attr("SK").begins_with("createdAt#") | Attr("SK").eq(USAGE_SK)),
+                 "ProjectionExpression": "PK"}
+    partitions = set()
+    while True:
+        resp = table.scan(**scan_args)
+        partitions.update(item["PK"] for item in resp.get("Items", []))
+        if not resp.get("LastEvaluatedKey"):
+            return sorted(partitions)
+        scan_args["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def count_images(table, partition):
+    """Usage attributes of one user from a strongly consistent query of their image items."""
+    usage = {"totalBytes": 0}
+    qargs = {"KeyConditionExpression": Key("PK").eq(partition) & Key("SK").begins_with("createdAt#"),
+             "ProjectionExpression": "#s, #size, createdAt", "ExpressionAttributeNames": {"#s": "status", "#size": "size"},
+             "ConsistentRead": True}
+    while True:
+        resp = table.query(**qargs)
+        for item in resp.get("Items", []):
+            status = f"{item.get('status', 'PENDING').lower()}Images"
+            usage[status] = usage.get(status, 0) + 1
+            usage["totalBytes"] += item.get("size", 0)
+            if item.get("createdAt") and item["createdAt"] > usage.get("lastUploadAt", ""):
+                usage["lastUploadAt"] = item["createdAt"]
+        if not resp.get("LastEvaluatedKey"):
+            return usage
+        qargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def write_usage(table, partition, seen, usage, recounted_at):
+    """
+    Replace the usage item, unless the stream updated it after it was read (seen, None when there was none).
+    Returns False in that case.
+    """
+    item = {"PK": partition, "SK": USAGE_SK, **usage, "recountedAt": recounted_at,
+            "lastSequence": (seen or {}).get("lastSequence", NO_SEQUENCE)}
+    if seen is None:
+        condition = {"ConditionExpression": "attribute_not_exists(PK)"}
+    elif "lastSequence" in seen:
+        condition = {"ConditionExpression": "lastSequence = :seen", "ExpressionAttributeValues": {":seen": seen["lastSequence"]}}
+    else:
+        condition = {"ConditionExpression": "attribute_not_exists(lastSequence)"}
+    try:
+        table.put_item(Item=item, **condition)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
+
+
+def recount(table_name, dry_run=False, clock=time.time, sleep=time.sleep, table=None):
+    """
+    Recount every user, USERS_PER_ROUND at a time: read their usage items, wait for the next whole second
+    (recountedAt), then count and write each user. Users the stream updated in between go to the next round.
+    Returns (users recounted, users given up after ATTEMPTS rounds).
+    """
+    table = table or boto3.resource("dynamodb").Table(table_name)
+    pending = [(partition, 0) for partition in user_partitions(table)]
+    recounted, failed = 0, []
+    while pending:
+        batch, pending = pending[:USERS_PER_ROUND], pending[USERS_PER_ROUND:]
+        seen = {partition: table.get_item(Key={"PK": partition, "SK": USAGE_SK}, ConsistentRead=True).get("Item")
+                for partition, _ in batch}
+        recounted_at = int(clock()) + 1
+        sleep(max(0.0, recounted_at - clock()))
+        for partition, attempt in batch:
+            usage = count_images(table, partition)
+            if dry_run or write_usage(table, partition, seen[partition], usage, recounted_at):
+                recounted += 1
+            elif attempt + 1 < ATTEMPTS:
+                pending.append((partition, attempt + 1))
+            else:
+                failed.append(partition)
+    return recounted, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", required=True, help="images table name")
+    parser.add_argument("--dry-run", action="store_true", help="count without writing")
+    args = parser.parse_args()
+    recounted, failed = recount(args.table, args.dry_run)
+    print(f"users_recounted={recounted} users_failed={len(failed)}")
+    for partition in failed:
+        print(f"failed: {partition}")
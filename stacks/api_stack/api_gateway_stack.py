@@ -1,22 +1,32 @@
 import os
-from aws_cdk import Stack, Duration, aws_apigateway as apigw, aws_lambda as _lambda, aws_iam as iam, aws_logs
-from aws_cdk.aws_lambda_python_alpha import PythonFunction, PythonLayerVersion
+from aws_cdk import Stack, Duration, ArnFormat, aws_apigateway as apigw, aws_lambda as _lambda, aws_iam as iam, aws_logs
+from aws_cdk.aws_lambda_python_alpha import PythonLayerVersion
 from constructs import Construct
 from aws_cdk import Duration
+from stacks.constants import MAX_IMAGES_PER_USER, MAX_BYTES_PER_USER
 
 class ApiStack(Stack):
     def __init__(self, scope: Construct, id: str, table, bucket, **kwargs):
         super().__init__(scope, id, **kwargs)
 
         
+        # Shared modules (aws_clients, instrumentation, throttling) and third-party packages for every function in
+        # the stack, from the source directory the S3 stack's layer is built from as well.
         lambda_layer = PythonLayerVersion(
             self,
             id=f"{id}-lambda-layer",
             layer_version_name=f"{id}-lambda-layer",
-            entry=os.path.join(os.path.dirname(__file__), "lambdas", "python_layer"),            
+            entry=os.path.join(os.path.dirname(__file__), "..", "shared", "python_layer"),
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_11]            
         )
         
+        lambdas_dir = os.path.join(os.path.dirname(__file__), "lambdas")
+
+        def handler_code(module):
+            # Only the handler and the helpers it imports (dependencies come from the layer), instead of
+            # every handler in the lambdas directory.
+            return _lambda.Code.from_asset(lambdas_dir, exclude=["*", f"!{module}.py", "!utils.py"])
+
         def create_lambda_role(name, actions, resources):
             role = iam.Role(self, f"{name}Role", assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"))
             role.add_managed_policy(iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole"))
@@ -27,19 +37,20 @@ class ApiStack(Stack):
                                             actions=["s3:PutObject", "s3:CreateMultipartUpload", "s3:AbortMultipartUpload"],
                                             resources=[f"{bucket.bucket_arn}/*"])
         
-        initiate_upload_role.add_to_policy(iam.PolicyStatement(actions=["dynamodb:PutItem"], resources=[table.table_arn]))
+        initiate_upload_role.add_to_policy(iam.PolicyStatement(actions=["dynamodb:PutItem", "dynamodb:GetItem", "dynamodb:BatchWriteItem", "dynamodb:BatchGetItem", "dynamodb:Query"],
+                                                               resources=[table.table_arn, f"{table.table_arn}/index/*"]))
   
 
 
         # Generate Pre Signed URL
-        initiate_upload_lambda = PythonFunction(
+        initiate_upload_lambda = _lambda.Function(
             self,  
             f"{id}-initiate-upload-lambda",
             function_name="initiate_upload_lambda",
             description="Lambda function to Upload image",
             runtime=_lambda.Runtime.PYTHON_3_11,            
-            entry=os.path.join(os.path.dirname(__file__), "lambdas"),
-            index="initiate_upload.py",            
+            code=handler_code("initiate_upload"),
+            handler="initiate_upload.handler",
             architecture=_lambda.Architecture.X86_64,
             layers=[lambda_layer],
             timeout=Duration.seconds(30),
@@ -48,13 +59,16 @@ class ApiStack(Stack):
             memory_size=512,
             environment={
                 "IMAGES_TABLE": table.table_name,
-                "IMAGES_BUCKET": bucket.bucket_name               
+                "IMAGES_BUCKET": bucket.bucket_name,
+                "MAX_IMAGES_PER_USER": str(MAX_IMAGES_PER_USER),
+                "MAX_BYTES_PER_USER": str(MAX_BYTES_PER_USER)
             },
         )
 
         list_imag_role = create_lambda_role("ListImages",
                                     actions=["dynamodb:Query", "dynamodb:Scan"],
                                     resources=[table.table_arn, f"{table.table_arn}/index/*"])
+        list_imag_role.add_to_policy(iam.PolicyStatement(actions=["s3:GetObject"], resources=[f"{bucket.bucket_arn}/*"]))
 
         
         # List Images on User Id with Filter option
@@ -64,17 +78,19 @@ class ApiStack(Stack):
             function_name="list_images_lambda",
             description="Lambda function to List images",
             runtime=_lambda.Runtime.PYTHON_3_11,            
-            code=_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), "lambdas")),
+            code=handler_code("list_images"),
             handler="list_images.handler",
+            layers=[lambda_layer],
             timeout=Duration.seconds(30),
             role=list_imag_role,
             environment={
-                "IMAGES_TABLE": table.table_name                
+                "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name
             },
         )
 
         get_img_role = create_lambda_role("GetImage",
-                        actions=["dynamodb:Query", "s3:GetObject"],
+                        actions=["dynamodb:GetItem", "dynamodb:Query", "s3:GetObject"],
                         resources=[table.table_arn, f"{table.table_arn}/index/*", f"{bucket.bucket_arn}/*"])
 
         get_img_role.add_to_policy(iam.PolicyStatement(actions=["s3:ListBucket"],resources=[bucket.bucket_arn]))
@@ -86,8 +102,9 @@ class ApiStack(Stack):
             function_name="download_image_lambda",
             description="Lambda function to Download image",
             runtime=_lambda.Runtime.PYTHON_3_11,            
-            code=_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), "lambdas")),
+            code=handler_code("download_image"),
             handler="download_image.handler",
+            layers=[lambda_layer],
             timeout=Duration.seconds(30),
             role=get_img_role,
             environment={
@@ -96,9 +113,54 @@ class ApiStack(Stack):
             },
         )
 
+        complete_upload_role = create_lambda_role("CompleteUpload",
+                        actions=["s3:PutObject", "s3:AbortMultipartUpload", "s3:ListMultipartUploadParts"],
+                        resources=[f"{bucket.bucket_arn}/*"])
+        complete_upload_role.add_to_policy(iam.PolicyStatement(actions=["dynamodb:GetItem", "dynamodb:Query", "dynamodb:DeleteItem"],
+                        resources=[table.table_arn, f"{table.table_arn}/index/*"]))
+
+        complete_upload_lambda = _lambda.Function(
+            self,  
+            f"{id}-complete-upload-lambda",
+            function_name="complete_upload_lambda",
+            description="Lambda function to complete or abort multipart image uploads",
+            runtime=_lambda.Runtime.PYTHON_3_11,            
+            code=handler_code("complete_upload"),
+            handler="complete_upload.handler",
+            layers=[lambda_layer],
+            timeout=Duration.seconds(30),
+            role=complete_upload_role,
+            environment={
+               "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name                     
+            },
+        )
+
+        batch_get_role = create_lambda_role("BatchGetImages",
+                        actions=["dynamodb:BatchGetItem", "dynamodb:Query", "s3:GetObject"],
+                        resources=[table.table_arn, f"{table.table_arn}/index/*", f"{bucket.bucket_arn}/*"])
+
+        batch_get_images_lambda = _lambda.Function(
+            self,  
+            f"{id}-batch-get-images-lambda",
+            function_name="batch_get_images_lambda",
+            description="Lambda function to fetch metadata and download URLs of many images",
+            runtime=_lambda.Runtime.PYTHON_3_11,            
+            code=handler_code("batch_get_images"),
+            handler="batch_get_images.handler",
+            layers=[lambda_layer],
+            timeout=Duration.seconds(30),
+            role=batch_get_role,
+            environment={
+               "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name                     
+            },
+        )
+
         delete_img_role = create_lambda_role( "DeleteImage",
-                                        actions=["dynamodb:DeleteItem", "dynamodb:Query", "s3:DeleteObject"],
+                                        actions=["dynamodb:GetItem", "dynamodb:DeleteItem", "dynamodb:Query", "s3:DeleteObject", "s3:DeleteObjectVersion"],
                                         resources=[table.table_arn, f"{bucket.bucket_arn}/*", f"{table.table_arn}/index/*"])
+        delete_img_role.add_to_policy(iam.PolicyStatement(actions=["s3:ListBucketVersions"], resources=[bucket.bucket_arn]))
 
 
 
@@ -108,8 +170,9 @@ class ApiStack(Stack):
             function_name="delete_image_lambda",
             description="Lambda function to Delete image",
             runtime=_lambda.Runtime.PYTHON_3_11,            
-            code=_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), "lambdas")),
+            code=handler_code("delete_image"),
             handler="delete_image.handler",
+            layers=[lambda_layer],
             timeout=Duration.seconds(30),
             role=delete_img_role,
             environment={
@@ -119,6 +182,110 @@ class ApiStack(Stack):
         )
 
 
+        bulk_delete_role = create_lambda_role("BulkDeleteImages",
+                                        actions=["dynamodb:BatchGetItem", "dynamodb:BatchWriteItem", "dynamodb:Query",
+                                                 "s3:DeleteObject", "s3:DeleteObjectVersion"],
+                                        resources=[table.table_arn, f"{table.table_arn}/index/*", f"{bucket.bucket_arn}/*"])
+        bulk_delete_role.add_to_policy(iam.PolicyStatement(actions=["s3:ListBucketVersions"], resources=[bucket.bucket_arn]))
+
+        bulk_delete_lambda = _lambda.Function(
+            self,  
+            f"{id}-bulk-delete-lambda",
+            function_name="bulk_delete_images_lambda",
+            description="Lambda function to Delete many images",
+            runtime=_lambda.Runtime.PYTHON_3_11,            
+            code=handler_code("bulk_delete"),
+            handler="bulk_delete.handler",
+            layers=[lambda_layer],
+            timeout=Duration.seconds(60),
+            role=bulk_delete_role,
+            environment={
+               "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name                     
+            },
+        )
+
+        # Whole-library deletion: the worker re-invokes itself, so its ARN is built from the name
+        # instead of referencing the function (which would be a circular dependency with its role).
+        delete_worker_name = "delete_user_images_worker_lambda"
+        delete_worker_arn = Stack.of(self).format_arn(service="lambda", resource="function", resource_name=delete_worker_name,
+                                                      arn_format=ArnFormat.COLON_RESOURCE_NAME)
+
+        delete_worker_role = create_lambda_role("DeleteUserImagesWorker",
+                                        actions=["dynamodb:Query", "dynamodb:BatchWriteItem", "dynamodb:GetItem", "dynamodb:UpdateItem",
+                                                 "dynamodb:DeleteItem", "s3:DeleteObject", "s3:DeleteObjectVersion"],
+                                        resources=[table.table_arn, f"{bucket.bucket_arn}/*"])
+        delete_worker_role.add_to_policy(iam.PolicyStatement(actions=["s3:ListBucketVersions"], resources=[bucket.bucket_arn]))
+        delete_worker_role.add_to_policy(iam.PolicyStatement(actions=["lambda:InvokeFunction"], resources=[delete_worker_arn]))
+
+        delete_worker_lambda = _lambda.Function(
+            self,  
+            f"{id}-delete-user-images-worker-lambda",
+            function_name=delete_worker_name,
+            description="Lambda function to Delete all images of a user (async job)",
+            runtime=_lambda.Runtime.PYTHON_3_11,            
+            code=handler_code("delete_user_images"),
+            handler="delete_user_images.job_handler",
+            layers=[lambda_layer],
+            timeout=Duration.minutes(15),
+            role=delete_worker_role,
+            environment={
+               "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name                     
+            },
+        )
+
+        delete_jobs_role = create_lambda_role("DeleteUserImages",
+                                        actions=["dynamodb:PutItem", "dynamodb:GetItem"],
+                                        resources=[table.table_arn])
+
+        delete_jobs_lambda = _lambda.Function(
+            self,  
+            f"{id}-delete-user-images-lambda",
+            function_name="delete_user_images_lambda",
+            description="Lambda function to start and report whole-library deletion jobs",
+            runtime=_lambda.Runtime.PYTHON_3_11,            
+            code=handler_code("delete_user_images"),
+            handler="delete_user_images.handler",
+            layers=[lambda_layer],
+            timeout=Duration.seconds(30),
+            role=delete_jobs_role,
+            environment={
+               "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name,
+                "WORKER_FUNCTION_NAME": delete_worker_lambda.function_name
+            },
+        )
+        delete_worker_lambda.grant_invoke(delete_jobs_role)
+
+        thumbnail_role = create_lambda_role("GetThumbnail",
+                        actions=["dynamodb:GetItem", "dynamodb:Query", "dynamodb:PutItem", "dynamodb:DeleteItem",
+                                 "s3:GetObject", "s3:PutObject"],
+                        resources=[table.table_arn, f"{table.table_arn}/index/*", f"{bucket.bucket_arn}/*"])
+        # Without ListBucket a HEAD on a missing rendition is a 403 instead of a 404.
+        thumbnail_role.add_to_policy(iam.PolicyStatement(actions=["s3:ListBucket"], resources=[bucket.bucket_arn]))
+
+        # On-demand renditions (Pillow comes from the layer)
+        get_thumbnail_lambda = _lambda.Function(
+            self,  
+            f"{id}-get-thumbnail-lambda",
+            function_name="get_thumbnail_lambda",
+            description="Lambda function to generate and serve renditions on demand",
+            runtime=_lambda.Runtime.PYTHON_3_11,            
+            code=handler_code("get_thumbnail"),
+            handler="get_thumbnail.handler",
+            architecture=_lambda.Architecture.X86_64,
+            layers=[lambda_layer],
+            timeout=Duration.seconds(30),
+            role=thumbnail_role,
+            log_retention=aws_logs.RetentionDays.ONE_MONTH,
+            memory_size=1024,
+            environment={
+                "IMAGES_TABLE": table.table_name,
+                "IMAGES_BUCKET": bucket.bucket_name               
+            },
+        )
+
         # API Resources        
         api = apigw.RestApi(self,             
                             "ImagesApi",
@@ -132,6 +299,23 @@ class ApiStack(Stack):
         images.add_method("POST", apigw.LambdaIntegration(initiate_upload_lambda))
         images.add_method("GET", apigw.LambdaIntegration(list_images_lambda))
 
+        images_batch = images.add_resource("batch")
+        images_batch.add_method("POST", apigw.LambdaIntegration(batch_get_images_lambda))
+
+        images_delete = images.add_resource("delete")
+        images_delete.add_method("POST", apigw.LambdaIntegration(bulk_delete_lambda))
+
         image_id = images.add_resource("{imageId}")
         image_id.add_method("GET", apigw.LambdaIntegration(download_image_lambda))
-        image_id.add_method("DELETE", apigw.LambdaIntegration(delete_image_lambda))
\ No newline at end of file
+        image_id.add_method("DELETE", apigw.LambdaIntegration(delete_image_lambda))
+
+        thumbnail = image_id.add_resource("thumbnail")
+        thumbnail.add_method("GET", apigw.LambdaIntegration(get_thumbnail_lambda))
+
+        multipart = image_id.add_resource("multipart")
+        multipart.add_method("POST", apigw.LambdaIntegration(complete_upload_lambda))
+
+        users = api.root.add_resource("users")
+        deletion_jobs = users.add_resource("{userId}").add_resource("deletion-jobs")
+        deletion_jobs.add_method("POST", apigw.LambdaIntegration(delete_jobs_lambda))
+        deletion_jobs.add_resource("{jobId}").add_method("GET", apigw.LambdaIntegration(delete_jobs_lambda))
\ No newline at end of file
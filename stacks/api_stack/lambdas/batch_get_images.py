@@ -0,0 +1,54 @@
+import os, json
+import aws_clients
+from instrumentation import instrumented, log
+from utils import resolve_images, json_default, UrlSigner
+
+IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
+IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+PRESIGNED_EXPIRES = int(os.environ.get("PRESIGNED_EXPIRES", "300"))
+MAX_IMAGE_IDS = 100
+
+table = aws_clients.lazy_table(IMAGES_TABLE)
+
+def http_response(status_code:int, body:dict):
+    return { "statusCode": status_code, "body": json.dumps(body, default=json_default) }
+
+
+@instrumented
+def handler(event, context):
+    """
+    Metadata and Pre Signed download URLs (original and thumbnail) for up to 100 images in one call.
+    URLs are signed locally with one derived SigV4 signing key.
+    Request body: {"imageIds": [...]}. Unknown ids are returned in notFound.
+    """
+    try:
+        body = json.loads(event.get("body") or "{}")
+    except Exception:
+        return http_response(400, {"error":"invalid JSON body"})
+
+    image_ids = body.get("imageIds")
+    if not isinstance(image_ids, list) or not image_ids or not all(isinstance(i, str) and i for i in image_ids):
+        return http_response(400, {"error":"imageIds must be a non-empty list of strings"})
+    image_ids = list(dict.fromkeys(image_ids))
+    if len(image_ids) > MAX_IMAGE_IDS:
+        return http_response(400, {"error":f"at most {MAX_IMAGE_IDS} imageIds per request"})
+
+    try:
+        found = resolve_images(table, image_ids)
+    except Exception as e:
+        log("dynamodb_batch_get_error", level="ERROR", error=e)
+        return http_response(500, {"error":"failed to fetch metadata"})
+
+    signer = UrlSigner(IMAGES_BUCKET, PRESIGNED_EXPIRES)
+    images, not_found = [], []
+    for image_id in image_ids:
+        item = found.get(image_id)
+        if not item or not item.get("s3Key"):
+            not_found.append(image_id)
+            continue
+        image = {"imageId": image_id, "metadata": item, "downloadUrl": signer.presign(item["s3Key"])}
+        if item.get("thumbnailKey"):
+            image["thumbnailUrl"] = signer.presign(item["thumbnailKey"])
+        images.append(image)
+
+    return http_response(200, {"images": images, "notFound": not_found})
@@ -0,0 +1,76 @@
+import os, json
+from botocore.exceptions import ClientError
+import aws_clients
+from instrumentation import instrumented, log
+from utils import resolve_images, image_pointer_key, image_prefixes, delete_all_versions, batch_write
+
+IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
+IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+MAX_IMAGE_IDS = 100
+
+table = aws_clients.lazy_table(IMAGES_TABLE)
+s3 = aws_clients.lazy_client("s3")
+
+def http_response(status_code:int, body:dict):
+    return { "statusCode": status_code, "body": json.dumps(body) }
+
+
+@instrumented
+def handler(event, context):
+    """
+    Delete up to 100 images in one call. Request body: {"imageIds": [...]}.
+    Metadata is resolved with BatchGetItem, every version of the originals and renditions is removed with
+    DeleteObjects (1000 keys per call) and the items and pointers with BatchWriteItem.
+    Images whose objects could not all be deleted keep their metadata and are reported in failed.
+    """
+    try:
+        body = json.loads(event.get("body") or "{}")
+    except Exception:
+        return http_response(400, {"error":"invalid JSON body"})
+
+    image_ids = body.get("imageIds")
+    if not isinstance(image_ids, list) or not image_ids or not all(isinstance(i, str) and i for i in image_ids):
+        return http_response(400, {"error":"imageIds must be a non-empty list of strings"})
+    image_ids = list(dict.fromkeys(image_ids))
+    if len(image_ids) > MAX_IMAGE_IDS:
+        return http_response(400, {"error":f"at most {MAX_IMAGE_IDS} imageIds per request"})
+
+    try:
+        found = resolve_images(table, image_ids)
+    except Exception as e:
+        log("dynamodb_batch_get_error", level="ERROR", error=e)
+        return http_response(500, {"error":"failed to fetch metadata"})
+
+    prefixes = {image_id: image_prefixes(item) for image_id, item in found.items()}
+    try:
+        objects_deleted, errors = delete_all_versions(s3, IMAGES_BUCKET, [p for ps in prefixes.values() for p in ps])
+    except ClientError as e:
+        log("s3_bulk_delete_error", level="ERROR", error=e)
+        return http_response(500, {"error":"failed to delete objects from storage"})
+
+    failed = {image_id for image_id, ps in prefixes.items()
+              if any(err.get("Key", "").startswith(tuple(ps)) for err in errors)}
+    if errors:
+        log("s3_bulk_delete_partial_error", level="ERROR", failed=sorted(failed), errors=errors[:5])
+
+    requests = []
+    for image_id, item in found.items():
+        if image_id not in failed:
+            requests.append({"DeleteRequest": {"Key": {"PK": item["PK"], "SK": item["SK"]}}})
+            requests.append({"DeleteRequest": {"Key": image_pointer_key(image_id)}})
+    try:
+        unprocessed = batch_write(table, requests)
+    except Exception as e:
+        log("dynamodb_batch_delete_error", level="ERROR", error=e)
+        unprocessed = requests
+    for request in unprocessed:
+        key = request["DeleteRequest"]["Key"]
+        failed.update(image_id for image_id, item in found.items()
+                      if key in ({"PK": item["PK"], "SK": item["SK"]}, image_pointer_key(image_id)))
+
+    deleted = [image_id for image_id in image_ids if image_id in found and image_id not in failed]
+
+    return http_response(200, {"deleted": deleted,
+                               "notFound": [image_id for image_id in image_ids if image_id not in found],
+                               "failed": [image_id for image_id in image_ids if image_id in failed],
+                               "objectsDeleted": objects_deleted})
@@ -0,0 +1,99 @@
+import os, json
+from botocore.exceptions import ClientError
+import aws_clients
+from instrumentation import instrumented, log
+from utils import get_image_item, image_pointer_key
+
+IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
+IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+
+s3 = aws_clients.lazy_client("s3")
+table = aws_clients.lazy_table(IMAGES_TABLE)
+
+def http_response(status_code:int, body:dict):
+    return { "statusCode": status_code, "body": json.dumps(body) }
+
+
+def list_uploaded_parts(s3_key, upload_id):
+    parts = []
+    kwargs = {"Bucket": IMAGES_BUCKET, "Key": s3_key, "UploadId": upload_id}
+    while True:
+        resp = s3.list_parts(**kwargs)
+        parts.extend({"PartNumber": p["PartNumber"], "ETag": p["ETag"]} for p in resp.get("Parts", []))
+        if not resp.get("IsTruncated"):
+            return parts
+        kwargs["PartNumberMarker"] = resp["NextPartNumberMarker"]
+
+
+@instrumented
+def handler(event, context):
+    """
+    Complete or abort the multipart upload of a PENDING image.
+    Request body: {"action": "complete", "parts": [{"PartNumber": 1, "ETag": "..."}]} (parts optional, listed from S3 when omitted)
+    or {"action": "abort"}, which also removes the image metadata.
+    Completion emits the S3 event that the image processor picks up.
+    """
+    image_id = (event.get("pathParameters") or {}).get("imageId")
+    if not image_id:
+        return http_response(400, {"error":"imageId required"})
+
+    try:
+        body = json.loads(event.get("body") or "{}")
+    except Exception:
+        return http_response(400, {"error":"invalid JSON body"})
+
+    action = body.get("action")
+    if action not in ("complete", "abort"):
+        return http_response(400, {"error":"action must be complete or abort"})
+
+    try:
+        item = get_image_item(table, image_id)
+    except Exception as e:
+        log("dynamodb_get_error", level="ERROR", imageId=image_id, error=e)
+        return http_response(500, {"error":"failed to fetch metadata"})
+
+    if not item:
+        return http_response(404, {"error":"image not found"})
+    upload_id = item.get("uploadId")
+    if not upload_id or item.get("status") != "PENDING":
+        return http_response(409, {"error":"image has no multipart upload in progress"})
+
+    s3_key = item["s3Key"]
+    if action == "abort":
+        try:
+            s3.abort_multipart_upload(Bucket=IMAGES_BUCKET, Key=s3_key, UploadId=upload_id)
+        except ClientError as e:
+            if e.response.get("Error",{}).get("Code") != "NoSuchUpload":
+                log("s3_multipart_abort_error", level="ERROR", key=s3_key, error=e)
+                return http_response(500, {"error":"failed to abort upload"})
+        try:
+            table.meta.client.transact_write_items(TransactItems=[
+                {"Delete": {"TableName": IMAGES_TABLE, "Key": {"PK": item["PK"], "SK": item["SK"]}}},
+                {"Delete": {"TableName": IMAGES_TABLE, "Key": image_pointer_key(image_id)}},
+            ])
+        except Exception as e:
+            log("dynamodb_delete_error", level="ERROR", imageId=image_id, error=e)
+            return http_response(500, {"error":"failed to delete metadata"})
+        return http_response(200, {"imageId": image_id, "aborted": True})
+
+    try:
+        parts = body.get("parts") or list_uploaded_parts(s3_key, upload_id)
+        parts = sorted(({"PartNumber": int(p["PartNumber"]), "ETag": p["ETag"]} for p in parts), key=lambda p: p["PartNumber"])
+    except (KeyError, TypeError, ValueError):
+        return http_response(400, {"error":"parts must be a list of PartNumber and ETag"})
+    except ClientError as e:
+        log("s3_list_parts_error", level="ERROR", key=s3_key, error=e)
+        return http_response(500, {"error":"failed to list uploaded parts"})
+    if not parts:
+        return http_response(400, {"error":"no parts uploaded"})
+
+    try:
+        s3.complete_multipart_upload(Bucket=IMAGES_BUCKET, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except ClientError as e:
+        code = e.response.get("Error",{}).get("Code")
+        log("s3_multipart_complete_error", level="ERROR", key=s3_key, error=e)
+        if code in ("InvalidPart", "InvalidPartOrder", "EntityTooSmall", "NoSuchUpload"):
+            return http_response(400, {"error":f"failed to complete upload: {code}"})
+        return http_response(500, {"error":"failed to complete upload"})
+
+    return http_response(200, {"imageId": image_id, "completed": True})
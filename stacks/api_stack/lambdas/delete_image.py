@@ -1,26 +1,29 @@
-import os, json, boto3
+import os, json
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
+import aws_clients
+from instrumentation import instrumented, log, metric, timer
+from utils import get_image_item, image_pointer_key, image_prefixes, delete_all_versions
 
 IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
 IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
 
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(IMAGES_TABLE)
-s3 = boto3.client("s3")
+table = aws_clients.lazy_table(IMAGES_TABLE)
+s3 = aws_clients.lazy_client("s3")
 
 def http_response(status_code:int, body:dict):
     return { "statusCode": status_code, "body": json.dumps(body) }
 
 
+@instrumented
 def handler(event, context):
     """
     Validate imageId in pathParameters.
     Conditional image deletion
-      - Query Image Table with imageId.
+      - Resolve image metadata with imageId (pointer item).
       - Validate UserId access to delete the image.
     
-      Delete image from S3 and in Table records with exception handling.
+      Delete every version of the original and its renditions from S3, then the metadata item and its pointer
+      in one transaction, with exception handling.
 
     """
 
@@ -31,33 +34,36 @@ def handler(event, context):
         return http_response(400, {"error":"imageId required"})
 
     try:
-        resp = table.query(IndexName="imageId-index", KeyConditionExpression=Key("imageId").eq(image_id), Limit=1)
+        with timer("dynamodb_lookup"):
+            item = get_image_item(table, image_id)
     except Exception as e:
-        print("dynamodb_query_error", error=str(e), imageId=image_id)
+        log("dynamodb_get_error", level="ERROR", imageId=image_id, error=e)
         return http_response(500, {"error":"failed to query metadata"})
 
-    items = resp.get("Items", [])
-    if not items:
+    if not item:
         return http_response(404, {"error":"image not found"})
 
-    item = items[0]
     if caller_user and item.get("userId") != caller_user:
         return http_response(403, {"error":"forbidden"})
 
-    s3_key = item.get("s3Key")
-
     try:
-        s3.delete_object(Bucket=IMAGES_BUCKET, Key=s3_key)        
+        with timer("s3_delete"):
+            deleted, errors = delete_all_versions(s3, IMAGES_BUCKET, image_prefixes(item))
+        metric("objects_deleted", deleted)
     except ClientError as e:
-        code = e.response.get("Error",{}).get("Code")
-        if code not in ("NoSuchKey","404"):
-            print("s3_delete_error", error=str(e), key=s3_key)
-            return http_response(500, {"error":"failed to delete object from storage"})
+        errors = [{"Message": str(e)}]
+    if errors:
+        log("s3_delete_error", level="ERROR", imageId=image_id, errors=errors[:5])
+        return http_response(500, {"error":"failed to delete object from storage"})
 
     try:
-        table.delete_item(Key={"PK": item["PK"], "SK": item["SK"]})
+        with timer("dynamodb_delete"):
+            table.meta.client.transact_write_items(TransactItems=[
+                {"Delete": {"TableName": IMAGES_TABLE, "Key": {"PK": item["PK"], "SK": item["SK"]}}},
+                {"Delete": {"TableName": IMAGES_TABLE, "Key": image_pointer_key(image_id)}},
+            ])
     except Exception as e:
-        print("dynamodb_delete_error", error=str(e), key=item.get("PK"))
+        log("dynamodb_delete_error", level="ERROR", key=item.get("PK"), error=e)
         return http_response(500, {"error":"failed to delete metadata"})
 
     return http_response(200, {"deletedImageId": image_id})
@@ -0,0 +1,170 @@
+import os, json, uuid
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Key
+import aws_clients
+from instrumentation import instrumented, log
+from utils import image_pointer_key, usage_key, iter_version_pages, delete_objects, batch_write, json_default, THUMBNAIL_PREFIX
+
+IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
+IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+WORKER_FUNCTION_NAME = os.environ.get("WORKER_FUNCTION_NAME")
+# The worker hands over to a fresh invocation when less than this is left.
+RESUME_MARGIN_MS = 60_000
+JOB_TTL = 7*24*3600
+ITEMS_PAGE_SIZE = 500
+# Image items (with their image#<imageId> pointers) first, then the content hash items.
+ITEM_SK_PREFIXES = ("createdAt#", "hash#")
+
+table = aws_clients.lazy_table(IMAGES_TABLE)
+s3 = aws_clients.lazy_client("s3", "background")
+lambda_client = aws_clients.lazy_client("lambda")
+
+def http_response(status_code:int, body:dict):
+    return { "statusCode": status_code, "body": json.dumps(body, default=json_default) }
+
+
+def job_key(user_id, job_id):
+    return {"PK": f"user#{user_id}", "SK": f"job#delete#{job_id}"}
+
+
+@instrumented
+def handler(event, context):
+    """
+    Whole-library deletion API.
+    POST /users/{userId}/deletion-jobs creates the job item and starts the worker asynchronously (202 with jobId).
+    GET /users/{userId}/deletion-jobs/{jobId} reports the job status and progress counters.
+    """
+    path = event.get("pathParameters") or {}
+    user_id = path.get("userId")
+    if not user_id:
+        return http_response(400, {"error":"userId required"})
+
+    if event.get("httpMethod") == "GET":
+        job_id = path.get("jobId")
+        if not job_id:
+            return http_response(400, {"error":"jobId required"})
+        try:
+            job = table.get_item(Key=job_key(user_id, job_id), ConsistentRead=True).get("Item")
+        except Exception as e:
+            log("dynamodb_get_error", level="ERROR", jobId=job_id, error=e)
+            return http_response(500, {"error":"failed to fetch job"})
+        if not job:
+            return http_response(404, {"error":"job not found"})
+        return http_response(200, {k: v for k, v in job.items() if k not in ("PK", "SK", "expiresAt")})
+
+    job_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    job = {**job_key(user_id, job_id), "jobId": job_id, "userId": user_id, "status": "RUNNING",
+           "objectsDeleted": 0, "imagesDeleted": 0, "errorCount": 0,
+           "createdAt": now.isoformat(), "expiresAt": int(now.timestamp()) + JOB_TTL}
+    try:
+        table.put_item(Item=job)
+        lambda_client.invoke(FunctionName=WORKER_FUNCTION_NAME, InvocationType="Event",
+                             Payload=json.dumps({"userId": user_id, "jobId": job_id}))
+    except Exception as e:
+        log("deletion_job_start_error", level="ERROR", userId=user_id, error=e)
+        return http_response(500, {"error":"failed to start deletion job"})
+
+    return http_response(202, {"jobId": job_id, "status": "RUNNING"})
+
+
+def record_progress(user_id, job_id, objects=0, images=0, errors=0, status=None):
+    kwargs = {"UpdateExpression": "SET updatedAt = :u ADD objectsDeleted :o, imagesDeleted :i, errorCount :e",
+              "ExpressionAttributeValues": {":u": datetime.now(timezone.utc).isoformat(), ":o": objects, ":i": images, ":e": errors}}
+    if status:
+        kwargs["UpdateExpression"] = kwargs["UpdateExpression"].replace("SET ", "SET #s = :s, ")
+        kwargs["ExpressionAttributeNames"] = {"#s": "status"}
+        kwargs["ExpressionAttributeValues"][":s"] = status
+    table.update_item(Key=job_key(user_id, job_id), **kwargs)
+
+
+def resume(state, context):
+    lambda_client.invoke(FunctionName=context.function_name, InvocationType="Event", Payload=json.dumps(state))
+    return {"resumed": True}
+
+
+def delete_user_objects(state, context):
+    """
+    Objects phase: every version and delete marker under users/<userId>/ and thumbnails/<userId>/,
+    one DeleteObjects per listing page (up to 1000 keys). Returns False when the worker must resume later.
+    """
+    user_id = state["userId"]
+    prefixes = [f"users/{user_id}/", f"{THUMBNAIL_PREFIX}{user_id}/"]
+    while state.get("prefixIndex", 0) < len(prefixes):
+        pages = iter_version_pages(s3, IMAGES_BUCKET, prefixes[state.get("prefixIndex", 0)],
+                                   state.get("keyMarker"), state.get("versionIdMarker"))
+        for objects, key_marker, version_id_marker in pages:
+            deleted, errors = delete_objects(s3, IMAGES_BUCKET, objects) if objects else (0, [])
+            record_progress(user_id, state["jobId"], objects=deleted, errors=len(errors))
+            state.update(keyMarker=key_marker, versionIdMarker=version_id_marker)
+            if key_marker and context.get_remaining_time_in_millis() < RESUME_MARGIN_MS:
+                return False
+        state.update(prefixIndex=state.get("prefixIndex", 0) + 1, keyMarker=None, versionIdMarker=None)
+    return True
+
+
+def delete_user_items(state, context):
+    """
+    Items phase: the user's image items and their pointers, then the content hash items,
+    a page at a time with BatchWriteItem. Returns False when the worker must resume later.
+    """
+    user_id = state["userId"]
+    while state.get("itemPrefixIndex", 0) < len(ITEM_SK_PREFIXES):
+        sk_prefix = ITEM_SK_PREFIXES[state.get("itemPrefixIndex", 0)]
+        qargs = {"KeyConditionExpression": Key("PK").eq(f"user#{user_id}") & Key("SK").begins_with(sk_prefix),
+                 "ProjectionExpression": "PK, SK, imageId", "Limit": ITEMS_PAGE_SIZE}
+        if state.get("lastKey"):
+            qargs["ExclusiveStartKey"] = state["lastKey"]
+        resp = table.query(**qargs)
+        items = resp.get("Items", [])
+
+        requests = []
+        for item in items:
+            requests.append({"DeleteRequest": {"Key": {"PK": item["PK"], "SK": item["SK"]}}})
+            if sk_prefix == "createdAt#":
+                requests.append({"DeleteRequest": {"Key": image_pointer_key(item["imageId"])}})
+        unprocessed = batch_write(table, requests)
+        if sk_prefix == "createdAt#":
+            failed_items = sum(1 for r in unprocessed if r["DeleteRequest"]["Key"]["PK"].startswith("user#"))
+            record_progress(user_id, state["jobId"], images=len(items) - failed_items, errors=len(unprocessed))
+        elif unprocessed:
+            record_progress(user_id, state["jobId"], errors=len(unprocessed))
+
+        if not resp.get("LastEvaluatedKey"):
+            state.update(itemPrefixIndex=state.get("itemPrefixIndex", 0) + 1, lastKey=None)
+        else:
+            # Deleted items drop out of the next query on their own; only skip past ones left behind.
+            state["lastKey"] = resp["LastEvaluatedKey"] if unprocessed else None
+        if context.get_remaining_time_in_millis() < RESUME_MARGIN_MS:
+            return False
+    return True
+
+
+@instrumented
+def job_handler(event, context):
+    """
+    Whole-library deletion worker (invoked asynchronously).
+    Deletes the user's objects first, then the metadata and the user's usage aggregates, recording progress
+    on the job item. Before running out of time it re-invokes itself with its position (phase, listing markers, lastKey).
+    A failure marks the job FAILED and is not raised: an async retry would restart a job clients already saw fail.
+    """
+    state = dict(event)
+    user_id, job_id = state["userId"], state["jobId"]
+    try:
+        if state.get("phase", "objects") == "objects":
+            if not delete_user_objects(state, context):
+                return resume(state, context)
+            state = {"userId": user_id, "jobId": job_id, "phase": "items"}
+
+        if not delete_user_items(state, context):
+            return resume(state, context)
+    except Exception as e:
+        log("deletion_job_error", level="ERROR", userId=user_id, jobId=job_id, error=e)
+        record_progress(user_id, job_id, errors=1, status="FAILED")
+        return {"resumed": False}
+
+    # The usage aggregator does not recreate the item for the stream records of the images deleted above.
+    table.delete_item(Key=usage_key(user_id))
+    job = table.get_item(Key=job_key(user_id, job_id), ConsistentRead=True).get("Item", {})
+    record_progress(user_id, job_id, status="COMPLETED_WITH_ERRORS" if job.get("errorCount") else "COMPLETED")
+    return {"resumed": False}
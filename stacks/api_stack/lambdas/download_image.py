@@ -1,50 +1,90 @@
-import os, json, boto3
-from botocore.config import Config
+import os, json
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
+import aws_clients
+from instrumentation import instrumented, log, metric, timer
+from utils import get_image_item, json_default, image_cache
 
 IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
 IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
 PRESIGNED_EXPIRES = int(os.environ.get("PRESIGNED_EXPIRES", "300"))
+# Cached responses are served for half the URL lifetime, so a cached URL is always valid for at least that long.
+CACHE_TTL = PRESIGNED_EXPIRES // 2
+NEGATIVE_CACHE_TTL = int(os.environ.get("NEGATIVE_CACHE_TTL", "5"))
 
-boto_config = Config(retries={"mode":"standard","max_attempts":3})
-s3 = boto3.client("s3", config=boto_config)
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(IMAGES_TABLE)
+s3 = aws_clients.lazy_client("s3")
+table = aws_clients.lazy_table(IMAGES_TABLE)
 
-def http_response(status_code:int, body:dict):
-    return { "statusCode": status_code, "body": json.dumps(body) }
+def http_response(status_code:int, body:dict, headers:dict=None):
+    response = { "statusCode": status_code, "body": json.dumps(body, default=json_default) }
+    if headers:
+        response["headers"] = headers
+    return response
 
+def is_current(body):
+    """
+    Revalidate a cached response: one strongly consistent GetItem of the item's key and status only.
+    Deletes run in other functions (other containers), so a cached hit is only served while the item still
+    exists with the same status.
+    """
+    metadata = body["metadata"]
+    item = table.get_item(Key={"PK": metadata["PK"], "SK": metadata["SK"]}, ConsistentRead=True,
+                          ProjectionExpression="PK, #s", ExpressionAttributeNames={"#s": "status"}).get("Item")
+    return item is not None and item.get("status") == metadata.get("status")
+
+@instrumented
 def handler(event, context):
     """
     Generates Pre Signed URL to download image with expiration time of 300 sec.
-    Validate image_id exists in DB, fetch S3 Key and Generates Pre Signed URL.
+    Resolve image_id directly on PK/SK (pointer item), fetch S3 Key and Generates Pre Signed URL.
+    Responses (and not found results, briefly) are cached in the warm container; X-Cache tells HIT or MISS.
+    A cached response is revalidated against the item before it is served, which saves the pointer lookup and
+    the presigning; stale entries are dropped and fetched again.
     """
     image_id = event.get("pathParameters",{}).get("imageId")
 
     if not image_id:
         return http_response(400, {"error":"imageId required"})
 
-    try:
-        resp = table.query(IndexName="imageId-index", KeyConditionExpression=Key("imageId").eq(image_id), Limit=1)
+    cached = image_cache.get(image_id)
+    metric("cache_hit", 0 if cached is image_cache.MISSING else 1)
+    if cached is None:
+        return http_response(404, {"error":"image not found"}, {"X-Cache": "HIT"})
+    if cached is not image_cache.MISSING:
+        try:
+            with timer("dynamodb_revalidate"):
+                current = is_current(cached)
+        except Exception as e:
+            log("dynamodb_revalidate_error", level="ERROR", imageId=image_id, error=e)
+            current = False
+        if current:
+            return http_response(200, cached, {"X-Cache": "HIT"})
+        image_cache.invalidate(image_id)
 
+    try:
+        with timer("dynamodb_lookup"):
+            item = get_image_item(table, image_id)
     except Exception as e:
-        print("dynamodb_query_error", error=str(e), imageId=image_id)
+        log("dynamodb_get_error", level="ERROR", imageId=image_id, error=e)
         return http_response(500, {"error":"failed to fetch metadata"})
 
-    items = resp.get("Items", [])
-    if not items:
-        return http_response(404, {"error":"image not found"})
+    if not item:
+        image_cache.set(image_id, None, NEGATIVE_CACHE_TTL)
+        return http_response(404, {"error":"image not found"}, {"X-Cache": "MISS"})
 
-    item = items[0]
     s3_key = item.get("s3Key")
     if not s3_key:
         return http_response(500, {"error":"invalid metadata (missing s3Key)"})
 
     try:
-        url = s3.generate_presigned_url("get_object", Params={"Bucket": IMAGES_BUCKET, "Key": s3_key}, ExpiresIn=PRESIGNED_EXPIRES)
+        with timer("presign"):
+            url = s3.generate_presigned_url("get_object", Params={"Bucket": IMAGES_BUCKET, "Key": s3_key}, ExpiresIn=PRESIGNED_EXPIRES)
     except ClientError as e:
-        print("s3_presign_get_error", error=str(e), key=s3_key)
+        log("s3_presign_get_error", level="ERROR", key=s3_key, error=e)
         return http_response(500, {"error":"failed to create download URL"})
 
-    return http_response(200, {"downloadUrl": url, "metadata": item})
+    body = {"downloadUrl": url, "metadata": item}
+    # PENDING items are about to change, so only settled metadata is cached.
+    if item.get("status") != "PENDING":
+        image_cache.set(image_id, body, CACHE_TTL)
+    log("image_cache_stats", **image_cache.stats())
+    return http_response(200, body, {"X-Cache": "MISS"})
@@ -0,0 +1,221 @@
+import os, io, json, time, uuid
+from botocore.exceptions import ClientError
+import aws_clients
+from instrumentation import instrumented, log
+from utils import get_image_item, UrlSigner, TtlLruCache, THUMBNAIL_PREFIX
+
+IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
+IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+PRESIGNED_EXPIRES = int(os.environ.get("PRESIGNED_EXPIRES", "300"))
+# Requested edges are snapped up to one of these, so only a handful of renditions exist per image.
+ALLOWED_SIZES = [64, 128, 200, 256, 400, 512, 800, 1024, 1600]
+FORMATS = {"jpeg": ("JPEG", "jpg", "image/jpeg", 80), "jpg": ("JPEG", "jpg", "image/jpeg", 80),
+           "webp": ("WEBP", "webp", "image/webp", 75), "png": ("PNG", "png", "image/png", None)}
+# Renditions that fit this box are made from the processor's preview rendition rather than the original.
+SOURCE_RENDITION = "preview"
+SOURCE_RENDITION_MAX = 1024
+DRAFT_REDUCING_GAP = 2
+# Memory bounds for originals read for large boxes (the function has 1024 MB), as in the image processor:
+# headers claiming more than MAX_IMAGE_PIXELS are refused, and after reduced-scale decoding (JPEG draft)
+# an image may need at most MAX_DECODE_PIXELS.
+MAX_SOURCE_BYTES = int(os.environ.get("MAX_SOURCE_BYTES", str(64*1024*1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", "200000000"))
+MAX_DECODE_PIXELS = int(os.environ.get("MAX_DECODE_PIXELS", "40000000"))
+# Coalescing of concurrent first requests: one caller generates under a lock item, the others wait for the object.
+LOCK_TTL = 30
+WAIT_TIMEOUT = 10
+WAIT_INTERVAL = 0.1
+
+s3 = aws_clients.lazy_client("s3")
+table = aws_clients.lazy_table(IMAGES_TABLE)
+# Rendition keys known to exist in S3, so warm requests skip the HEAD.
+rendition_cache = TtlLruCache(int(os.environ.get("RENDITION_CACHE_MAX_ENTRIES", "4096")))
+
+
+class SourceTooLargeError(Exception):
+    """The source is over the byte or pixel limits for resizing on demand."""
+
+
+def http_response(status_code:int, body:dict, headers:dict=None):
+    response = { "statusCode": status_code, "body": json.dumps(body) }
+    if headers:
+        response["headers"] = headers
+    return response
+
+
+def snap(value):
+    """Smallest allowed size that is at least value (the largest allowed size above that)."""
+    return next((size for size in ALLOWED_SIZES if size >= value), ALLOWED_SIZES[-1])
+
+
+def parse_params(params):
+    """
+    Returns (width, height, format key) from w, h and fmt. A missing edge takes the other one (square box).
+    Raises ValueError for invalid values.
+    """
+    fmt = (params.get("fmt") or "jpeg").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {', '.join(sorted(FORMATS))}")
+    w, h = params.get("w"), params.get("h")
+    if not w and not h:
+        raise ValueError("w or h is required")
+    try:
+        width, height = int(w or h), int(h or w)
+    except ValueError:
+        raise ValueError("w and h must be integers")
+    if width <= 0 or height <= 0:
+        raise ValueError("w and h must be positive")
+    return snap(width), snap(height), fmt
+
+
+def thumbnail_key(item, width, height, fmt):
+    user_id = item.get("userId") or item["PK"].split("#", 1)[1]
+    return f"{THUMBNAIL_PREFIX}{user_id}/{item['imageId']}/{width}x{height}.{FORMATS[fmt][1]}"
+
+
+def object_exists(key):
+    if rendition_cache.get(key) is True:
+        return True
+    try:
+        s3.head_object(Bucket=IMAGES_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response.get("Error",{}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    rendition_cache.set(key, True, PRESIGNED_EXPIRES)
+    return True
+
+
+def acquire_lock(key):
+    """
+    Conditional put of a lock item for the rendition; expired locks (crashed generators) can be taken over.
+    The lock carries the table TTL attribute so abandoned ones are cleaned up.
+    Returns the lockId owning the lock, or None when another caller holds it.
+    """
+    now = int(time.time())
+    lock_id = str(uuid.uuid4())
+    try:
+        table.put_item(Item={"PK": f"lock#{key}", "SK": f"lock#{key}", "lockId": lock_id, "expiresAt": now + LOCK_TTL},
+                       ConditionExpression="attribute_not_exists(PK) OR expiresAt < :now",
+                       ExpressionAttributeValues={":now": now})
+        return lock_id
+    except ClientError as e:
+        if e.response.get("Error",{}).get("Code") == "ConditionalCheckFailedException":
+            return None
+        raise
+
+
+def release_lock(key, lock_id):
+    """
+    Delete the lock if it is still ours; a generator that ran past LOCK_TTL may have lost it to another caller.
+    """
+    try:
+        table.delete_item(Key={"PK": f"lock#{key}", "SK": f"lock#{key}"},
+                          ConditionExpression="lockId = :l", ExpressionAttributeValues={":l": lock_id})
+    except ClientError as e:
+        if e.response.get("Error",{}).get("Code") == "ConditionalCheckFailedException":
+            log("lock_lost", level="WARNING", key=key)
+            return
+        raise
+
+
+def render(item, width, height, fmt):
+    """
+    Resize the preview rendition (or the original for large boxes) into the width x height box.
+    JPEG sources are decoded at reduced scale.
+    Raises SourceTooLargeError for sources over MAX_SOURCE_BYTES, MAX_IMAGE_PIXELS or MAX_DECODE_PIXELS,
+    checked before the body is read and before it is decoded.
+    """
+    source_key = item.get("renditions", {}).get(SOURCE_RENDITION)
+    if not source_key or width > SOURCE_RENDITION_MAX or height > SOURCE_RENDITION_MAX:
+        source_key = item["s3Key"]
+    # Pillow is only imported on the first render, so redirects to existing renditions don't pay for it.
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+    resp = s3.get_object(Bucket=IMAGES_BUCKET, Key=source_key)
+    if resp["ContentLength"] > MAX_SOURCE_BYTES:
+        resp["Body"].close()
+        raise SourceTooLargeError(f"{resp['ContentLength']} bytes exceeds the {MAX_SOURCE_BYTES} byte limit")
+    body = resp["Body"].read()
+
+    pil_format, _, _, quality = FORMATS[fmt]
+    try:
+        im = Image.open(io.BytesIO(body))
+    except Image.DecompressionBombError as e:
+        raise SourceTooLargeError(str(e))
+    with im:
+        source_width, source_height = im.size
+        if source_width * source_height > MAX_IMAGE_PIXELS:
+            raise SourceTooLargeError(f"{source_width}x{source_height} exceeds {MAX_IMAGE_PIXELS} pixels")
+        im.draft("RGB", (width * DRAFT_REDUCING_GAP, height * DRAFT_REDUCING_GAP))
+        if im.width * im.height > MAX_DECODE_PIXELS:
+            raise SourceTooLargeError(f"{source_width}x{source_height} {im.format} needs {im.width * im.height} "
+                                      f"decoded pixels, over the {MAX_DECODE_PIXELS} limit")
+        im.thumbnail((width, height))
+        if pil_format == "JPEG" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, format=pil_format, **({"quality": quality} if quality else {}))
+    return buf.getvalue()
+
+
+def wait_for(key):
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        if object_exists(key):
+            return True
+    return False
+
+
+@instrumented
+def handler(event, context):
+    """
+    GET /images/{imageId}/thumbnail?w=&h=&fmt= redirects (302) to a Pre Signed URL of the rendition.
+    Sizes are snapped up to ALLOWED_SIZES. The rendition is generated on first access and stored under
+    thumbnails/<userId>/<imageId>/<w>x<h>.<ext>; concurrent first requests are coalesced on a lock item
+    so only one of them generates it while the others wait for the object.
+    """
+    image_id = (event.get("pathParameters") or {}).get("imageId")
+    if not image_id:
+        return http_response(400, {"error":"imageId required"})
+    try:
+        width, height, fmt = parse_params(event.get("queryStringParameters") or {})
+    except ValueError as e:
+        return http_response(400, {"error": str(e)})
+
+    try:
+        item = get_image_item(table, image_id)
+    except Exception as e:
+        log("dynamodb_get_error", level="ERROR", imageId=image_id, error=e)
+        return http_response(500, {"error":"failed to fetch metadata"})
+    if not item:
+        return http_response(404, {"error":"image not found"})
+    if item.get("status") != "AVAILABLE":
+        return http_response(409, {"error":f"image is {item.get('status')}"})
+
+    key = thumbnail_key(item, width, height, fmt)
+    try:
+        if not object_exists(key):
+            lock_id = acquire_lock(key)
+            if lock_id:
+                try:
+                    if not object_exists(key):
+                        s3.put_object(Bucket=IMAGES_BUCKET, Key=key, Body=render(item, width, height, fmt),
+                                      ContentType=FORMATS[fmt][2])
+                        rendition_cache.set(key, True, PRESIGNED_EXPIRES)
+                finally:
+                    release_lock(key, lock_id)
+            elif not wait_for(key):
+                return http_response(503, {"error":"rendition is being generated"}, {"Retry-After": "1"})
+    except SourceTooLargeError as e:
+        log("thumbnail_source_too_large", level="WARNING", imageId=image_id, key=key, error=e)
+        return http_response(422, {"error": f"image is too large to resize on demand: {e}"})
+    except Exception as e:
+        log("thumbnail_render_error", level="ERROR", imageId=image_id, key=key, error=e)
+        return http_response(500, {"error":"failed to generate thumbnail"})
+
+    url = UrlSigner(IMAGES_BUCKET, PRESIGNED_EXPIRES).presign(key)
+    return http_response(302, {"location": url},
+                         {"Location": url, "Cache-Control": f"private, max-age={PRESIGNED_EXPIRES // 2}"})
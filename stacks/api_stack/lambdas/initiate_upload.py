@@ -1,60 +1,94 @@
-import os, json, uuid, logging
+import os, re, json, uuid
 from datetime import datetime, timezone
-import boto3
-from botocore.config import Config
 from botocore.exceptions import ClientError
-from jsonschema import validate, ValidationError
-
-# LOGGER = logging.getLogger()
-# LOGGER.setLevel(logging.INFO)
+import aws_clients
+from instrumentation import instrumented, log, timer
+from utils import image_pointer_item, batch_write, find_stored_hashes, usage_key
 
 IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
 IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
 PRESIGNED_EXPIRES = int(os.environ.get("PRESIGNED_EXPIRES", "300"))
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "500"))
+MULTIPART_MAX_SIZE = int(os.environ.get("MULTIPART_MAX_SIZE", str(5*1024**3)))
+MULTIPART_PART_SIZE = 16*1024*1024
+MULTIPART_MIN_PART_SIZE = 5*1024*1024
+MULTIPART_MAX_PARTS = 10000
+# PENDING multipart items expire (table TTL) if the upload is never completed; the bucket lifecycle
+# rule aborts the incomplete upload itself.
+MULTIPART_PENDING_TTL = 2*24*3600
+CONTENT_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# Per-user quotas (0: none) on the images PENDING or AVAILABLE and on the bytes stored, checked against the
+# user's aggregate item. The aggregates follow the table stream, so they lag the table by a second or so.
+MAX_IMAGES_PER_USER = int(os.environ.get("MAX_IMAGES_PER_USER", "0"))
+MAX_BYTES_PER_USER = int(os.environ.get("MAX_BYTES_PER_USER", "0"))
+QUOTA_ERROR = "upload quota exceeded"
 
-boto_config = Config(retries={"mode":"standard","max_attempts":3})
-s3 = boto3.client("s3", config=boto_config)
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(IMAGES_TABLE)
+s3 = aws_clients.lazy_client("s3")
+table = aws_clients.lazy_table(IMAGES_TABLE)
 
-ITEM_SCHEMA = {
-    "type": "object",
-    "required": ["imageId","userId","createdAt","s3Key"],
-    "properties": {"imageId":{"type":"string"},"userId":{"type":"string"},"createdAt":{"type":"string"},"s3Key":{"type":"string"},"status":{"type":"string"}},
-    "additionalProperties": True
-}
+# Metadata item schema: required attributes, and attributes that must be strings when present (others are free-form).
+# Checked by hand, which costs nothing at import unlike a JSON Schema library.
+ITEM_REQUIRED = ("imageId", "userId", "createdAt", "s3Key")
+ITEM_STRINGS = ITEM_REQUIRED + ("status",)
 
-def put_item_conditional(item):
-    table.put_item(Item=item, ConditionExpression="attribute_not_exists(imageId)")
 
-def http_response(status_code:int, body:dict):
-    return { "statusCode": status_code, "body": json.dumps(body) }
+class ValidationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
 
-def handler(event, context):
+
+def validate_item(item):
+    """Raises ValidationError when the item does not match the metadata item schema."""
+    for name in ITEM_REQUIRED:
+        if name not in item:
+            raise ValidationError(f"'{name}' is a required property")
+    for name in ITEM_STRINGS:
+        if name in item and not isinstance(item[name], str):
+            raise ValidationError(f"{item[name]!r} is not of type 'string'")
+
+def put_item_conditional(item):
     """
-    Validate request body format and Existance of userId and filename in request body.
-    Generates Pre Signed URL with Server side encryption and Expiration time.
-    Validate Item Schema. Put Item on conditional basis (Avoids Multiple uploads filter with PK and SK).
-    Handles Client  and ServerSide Exceptions.
-    """    
-    try:
-        body = json.loads(event.get("body") or "{}")
-    except Exception:
-        return http_response(400, {"error":"invalid JSON body"})
+    Write the metadata item and its image#<imageId> pointer atomically, both conditional on not existing yet.
+    """
+    with timer("dynamodb_put"):
+        table.meta.client.transact_write_items(TransactItems=[
+            {"Put": {"TableName": IMAGES_TABLE, "Item": item, "ConditionExpression": "attribute_not_exists(imageId)"}},
+            {"Put": {"TableName": IMAGES_TABLE, "Item": image_pointer_item(item), "ConditionExpression": "attribute_not_exists(PK)"}},
+        ])
 
-    user_id = body.get("userId")
-    filename = body.get("filename")
-    content_type = body.get("contentType", "application/octet-stream")
-    max_size = int(body.get("maxSize", 20*1024*1024))
+def remaining_quota(user_id):
+    """
+    Number of uploads the user may still initiate, read from the aggregate item with one GetItem.
+    None when no quota is configured or the lookup fails (uploads are not blocked on it).
+    """
+    if not (MAX_IMAGES_PER_USER or MAX_BYTES_PER_USER):
+        return None
+    try:
+        with timer("dynamodb_quota"):
+            usage = table.get_item(Key=usage_key(user_id)).get("Item", {})
+    except Exception as e:
+        log("dynamodb_quota_lookup_error", level="ERROR", error=e)
+        return None
+    if MAX_BYTES_PER_USER and usage.get("totalBytes", 0) >= MAX_BYTES_PER_USER:
+        return 0
+    if not MAX_IMAGES_PER_USER:
+        return None
+    return max(0, MAX_IMAGES_PER_USER - int(usage.get("pendingImages", 0)) - int(usage.get("availableImages", 0)))
 
-    if not user_id or not filename:
-        return http_response(400, {"error":"userId and filename are required"})
+def http_response(status_code:int, body:dict):
+    return { "statusCode": status_code, "body": json.dumps(body) }
 
+def prepare_upload(user_id, filename, content_type, max_size):
+    """
+    Generates the Pre Signed POST for one file and builds its PENDING metadata item.
+    Raises ClientError (presign) or ValidationError (item schema).
+    """
     image_id = str(uuid.uuid4())
     created_at = datetime.now(timezone.utc).isoformat()
     s3_key = f"users/{user_id}/{image_id}/{filename}"
 
-    try:
+    with timer("presign"):
         presigned_post = s3.generate_presigned_post(
             Bucket=IMAGES_BUCKET,
             Key=s3_key,
@@ -62,9 +96,6 @@ def handler(event, context):
             Conditions=[{"Content-Type": content_type}, ["content-length-range",1,max_size], {"x-amz-server-side-encryption":"AES256"}],
             ExpiresIn=PRESIGNED_EXPIRES,
         )
-    except ClientError as e:
-        print("s3_presign_error", error=str(e))
-        return http_response(500, {"error":"failed to create presigned url"})
 
     item = {
         "PK": f"user#{user_id}",
@@ -74,22 +105,246 @@ def handler(event, context):
         "createdAt": created_at,
         "s3Key": s3_key,
         "status": "PENDING",
+        "userStatus": f"user#{user_id}#PENDING",
     }
+    validate_item(item)
+    return item, presigned_post
+
 
+def parse_content_hash(value):
+    """
+    Optional sha256 (hex) of the file. Returns the normalized hash, None when absent; raises ValueError when malformed.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, str) or not CONTENT_HASH_PATTERN.match(value.lower()):
+        raise ValueError("contentHash must be a sha256 hex digest")
+    return value.lower()
+
+
+def discard_partial_writes(pairs):
+    """
+    Delete both halves of metadata item / pointer pairs that were not fully written, so a failed upload leaves
+    neither an orphan PENDING item nor a dangling pointer. Deleting the half that was never written is a no-op.
+    """
+    deletes = [{"DeleteRequest": {"Key": {"PK": r["PutRequest"]["Item"]["PK"], "SK": r["PutRequest"]["Item"]["SK"]}}}
+               for pair in pairs for r in pair]
     try:
-        validate(instance=item, schema=ITEM_SCHEMA)
+        with timer("dynamodb_put"):
+            leftover = batch_write(table, deletes)
+    except Exception as e:
+        log("dynamodb_batch_delete_error", level="ERROR", error=e)
+        leftover = deletes
+    if leftover:
+        log("dynamodb_partial_writes_left", level="ERROR", keys=[r["DeleteRequest"]["Key"] for r in leftover])
+
+
+def initiate_batch(user_id, files):
+    """
+    Batch form of the upload initiation: presigns every file and writes the PENDING items and pointers
+    with BatchWriteItem (unprocessed items retried). BatchWriteItem has no condition expressions,
+    which is safe here because imageIds are fresh uuid4s. Items and pointers are sent as separate requests,
+    so the half written of a pair that still failed is deleted again (discard_partial_writes).
+    Files whose contentHash the user already stored are reported in duplicates (existing imageId) and get no upload.
+    Files past the user's remaining quota are reported as errors.
+    Errors are reported per file (by index) and do not fail the other files.
+    """
+    uploads, duplicates, errors, writes = [], [], [], []
+    hashes = {}
+    for index, file in enumerate(files):
+        try:
+            hashes[index] = parse_content_hash(file.get("contentHash")) if isinstance(file, dict) else None
+        except ValueError as e:
+            hashes[index] = e
+    try:
+        with timer("dynamodb_lookup"):
+            stored = find_stored_hashes(table, user_id, [h for h in hashes.values() if isinstance(h, str)])
+    except Exception as e:
+        log("dynamodb_hash_lookup_error", level="ERROR", error=e)
+        stored = {}
+    quota = remaining_quota(user_id)
+
+    for index, file in enumerate(files):
+        filename = file.get("filename") if isinstance(file, dict) else None
+        if not filename:
+            errors.append({"index": index, "error": "filename is required"})
+            continue
+        if isinstance(hashes[index], ValueError):
+            errors.append({"index": index, "filename": filename, "error": str(hashes[index])})
+            continue
+        if hashes[index] in stored:
+            duplicates.append({"index": index, "filename": filename, "imageId": stored[hashes[index]]})
+            continue
+        if quota is not None and quota <= 0:
+            errors.append({"index": index, "filename": filename, "error": QUOTA_ERROR})
+            continue
+        try:
+            max_size = int(file.get("maxSize", 20*1024*1024))
+            item, presigned_post = prepare_upload(user_id, filename, file.get("contentType", "application/octet-stream"), max_size)
+        except ValueError:
+            errors.append({"index": index, "filename": filename, "error": "maxSize must be an integer"})
+            continue
+        except ValidationError as e:
+            errors.append({"index": index, "filename": filename, "error": f"schema validation failed: {e.message}"})
+            continue
+        except ClientError as e:
+            log("s3_presign_error", level="ERROR", filename=filename, error=e)
+            errors.append({"index": index, "filename": filename, "error": "failed to create presigned url"})
+            continue
+
+        if quota is not None:
+            quota -= 1
+        uploads.append({"index": index, "filename": filename, "imageId": item["imageId"], "upload": presigned_post})
+        writes.append([{"PutRequest": {"Item": item}}, {"PutRequest": {"Item": image_pointer_item(item)}}])
+
+    try:
+        with timer("dynamodb_put"):
+            unprocessed = batch_write(table, [request for pair in writes for request in pair])
+    except Exception as e:
+        log("dynamodb_batch_write_error", level="ERROR", error=e)
+        unprocessed = [request for pair in writes for request in pair]
+
+    failed_ids = {r["PutRequest"]["Item"].get("imageId") or r["PutRequest"]["Item"]["PK"].split("#", 1)[1] for r in unprocessed}
+    if failed_ids:
+        discard_partial_writes([pair for pair in writes if pair[0]["PutRequest"]["Item"]["imageId"] in failed_ids])
+    for upload in [u for u in uploads if u["imageId"] in failed_ids]:
+        uploads.remove(upload)
+        errors.append({"index": upload["index"], "filename": upload["filename"], "error": "failed to persist metadata"})
+
+    errors.sort(key=lambda e: e["index"])
+    return http_response(200, {"uploads": uploads, "duplicates": duplicates, "errors": errors})
+
+
+def initiate_multipart(user_id, filename, content_type, size, part_size):
+    """
+    Multipart form of the upload initiation for large originals: creates the multipart upload and returns
+    Pre Signed upload_part URLs for every part so the client can send them in parallel.
+    The upload is finished with POST /images/{imageId}/multipart (complete_upload).
+    """
+    part_size = max(part_size, MULTIPART_MIN_PART_SIZE, -(-size // MULTIPART_MAX_PARTS))
+    part_count = -(-size // part_size)
+
+    image_id = str(uuid.uuid4())
+    created_at = datetime.now(timezone.utc)
+    s3_key = f"users/{user_id}/{image_id}/{filename}"
+
+    try:
+        with timer("s3_create_multipart"):
+            upload_id = s3.create_multipart_upload(Bucket=IMAGES_BUCKET, Key=s3_key, ContentType=content_type,
+                                                   ServerSideEncryption="AES256")["UploadId"]
+        with timer("presign"):
+            part_urls = [s3.generate_presigned_url("upload_part",
+                                                   Params={"Bucket": IMAGES_BUCKET, "Key": s3_key, "UploadId": upload_id, "PartNumber": n},
+                                                   ExpiresIn=PRESIGNED_EXPIRES)
+                         for n in range(1, part_count + 1)]
+    except ClientError as e:
+        log("s3_multipart_create_error", level="ERROR", error=e)
+        return http_response(500, {"error":"failed to create multipart upload"})
+
+    item = {
+        "PK": f"user#{user_id}",
+        "SK": f"createdAt#{created_at.isoformat()}#{image_id}",
+        "imageId": image_id,
+        "userId": user_id,
+        "createdAt": created_at.isoformat(),
+        "s3Key": s3_key,
+        "status": "PENDING",
+        "userStatus": f"user#{user_id}#PENDING",
+        "uploadId": upload_id,
+        "expiresAt": int(created_at.timestamp()) + MULTIPART_PENDING_TTL,
+    }
+
+    try:
+        validate_item(item)
+        put_item_conditional(item)
+    except Exception as e:
+        log("dynamodb_put_error", level="ERROR", error=e)
+        s3.abort_multipart_upload(Bucket=IMAGES_BUCKET, Key=s3_key, UploadId=upload_id)
+        return http_response(500, {"error":"failed to persist metadata"})
+
+    return http_response(200, {"imageId": image_id, "uploadId": upload_id, "partSize": part_size,
+                               "parts": [{"partNumber": n, "url": url} for n, url in enumerate(part_urls, start=1)]})
+
+
+@instrumented
+def handler(event, context):
+    """
+    Validate request body format and Existance of userId and filename in request body.
+    Generates Pre Signed URL with Server side encryption and Expiration time.
+    Validate Item Schema. Put Item and its imageId pointer on conditional basis (Avoids Multiple uploads filter with PK and SK).
+    A body with a files list (up to MAX_BATCH_FILES) initiates all of them in one call (initiate_batch).
+    multipart=true with the file size initiates a multipart upload with one Pre Signed URL per part (initiate_multipart).
+    An optional contentHash (sha256 hex) of bytes the user already stored returns the existing imageId with duplicate=true and no upload.
+    Users over MAX_IMAGES_PER_USER / MAX_BYTES_PER_USER get a 403 (per file errors in batches).
+    Handles Client  and ServerSide Exceptions.
+    """    
+    try:
+        body = json.loads(event.get("body") or "{}")
+    except Exception:
+        return http_response(400, {"error":"invalid JSON body"})
+
+    user_id = body.get("userId")
+
+    if "files" in body:
+        files = body["files"]
+        if not user_id or not isinstance(files, list) or not files:
+            return http_response(400, {"error":"userId and a non-empty files list are required"})
+        if len(files) > MAX_BATCH_FILES:
+            return http_response(400, {"error":f"at most {MAX_BATCH_FILES} files per request"})
+        return initiate_batch(user_id, files)
+
+    filename = body.get("filename")
+    content_type = body.get("contentType", "application/octet-stream")
+    max_size = int(body.get("maxSize", 20*1024*1024))
+
+    if not user_id or not filename:
+        return http_response(400, {"error":"userId and filename are required"})
+
+    try:
+        content_hash = parse_content_hash(body.get("contentHash"))
+    except ValueError as e:
+        return http_response(400, {"error": str(e)})
+    if content_hash:
+        try:
+            with timer("dynamodb_lookup"):
+                existing = find_stored_hashes(table, user_id, [content_hash]).get(content_hash)
+        except Exception as e:
+            log("dynamodb_hash_lookup_error", level="ERROR", error=e)
+            existing = None
+        if existing:
+            return http_response(200, {"imageId": existing, "duplicate": True})
+
+    if remaining_quota(user_id) == 0:
+        return http_response(403, {"error": QUOTA_ERROR})
+
+    if body.get("multipart"):
+        try:
+            size = int(body.get("size"))
+            part_size = int(body.get("partSize", MULTIPART_PART_SIZE))
+        except (TypeError, ValueError):
+            return http_response(400, {"error":"size is required for multipart uploads"})
+        if not 0 < size <= MULTIPART_MAX_SIZE:
+            return http_response(400, {"error":f"size must be between 1 and {MULTIPART_MAX_SIZE} bytes"})
+        return initiate_multipart(user_id, filename, content_type, size, part_size)
+
+    try:
+        item, presigned_post = prepare_upload(user_id, filename, content_type, max_size)
+    except ClientError as e:
+        log("s3_presign_error", level="ERROR", error=e)
+        return http_response(500, {"error":"failed to create presigned url"})
     except ValidationError as e:
         return http_response(400, {"error": f"schema validation failed: {e.message}"})
 
     try:
         put_item_conditional(item)
     except ClientError as e:
-        print("dynamodb_put_error", error=str(e))
-        if e.response.get("Error",{}).get("Code") == "ConditionalCheckFailedException":
+        log("dynamodb_put_error", level="ERROR", error=e)
+        reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+        if "ConditionalCheckFailed" in reasons:
             return http_response(409, {"error":"duplicate image id"})
         return http_response(500, {"error":"failed to persist metadata"})
     except Exception as e:
-        print("dynamodb_put_unexpected", error=str(e))
+        log("dynamodb_put_unexpected", level="ERROR", error=e)
         return http_response(500, {"error":"failed to persist metadata"})
 
-    return http_response(200, {"upload": presigned_post, "imageId": image_id})
\ No newline at end of file
+    return http_response(200, {"upload": presigned_post, "imageId": item["imageId"]})
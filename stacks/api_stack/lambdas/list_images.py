@@ -1,19 +1,74 @@
-import os, json, boto3
+import os, re, json
+from datetime import datetime, timezone
 from boto3.dynamodb.conditions import Key
+import aws_clients
+from instrumentation import instrumented, log, metric, timer
+from utils import json_default, UrlSigner
 IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(IMAGES_TABLE)
+IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+PRESIGNED_EXPIRES = int(os.environ.get("PRESIGNED_EXPIRES", "300"))
+table = aws_clients.lazy_table(IMAGES_TABLE)
+
+DEFAULT_LIMIT = 50
+# Larger limits are clamped, so filling a page never reads more than this many items.
+MAX_LIMIT = 100
+FIELD_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+# includeUrls value -> (item attribute, response attribute) of the URLs to presign.
+URL_MODES = {
+    "thumbnail": [("thumbnailKey", "thumbnailUrl")],
+    "all": [("thumbnailKey", "thumbnailUrl"), ("s3Key", "downloadUrl")],
+}
 
 
 def http_response(status_code:int, body:dict):
-    return { "statusCode": status_code, "body": json.dumps(body) }
+    return { "statusCode": status_code, "body": json.dumps(body, default=json_default) }
+
+
+def projection_args(fields, required=()):
+    """
+    Build ProjectionExpression arguments for a comma separated list of attribute names (plus required ones).
+    Returns None when a name is invalid.
+    """
+    names = [f.strip() for f in fields.split(",") if f.strip()]
+    names += [n for n in required if n not in names]
+    if not names or not all(FIELD_NAME.match(n) for n in names):
+        return None
+    placeholders = {f"#f{i}": n for i, n in enumerate(names)}
+    return {"ProjectionExpression": ", ".join(placeholders), "ExpressionAttributeNames": placeholders}
+
+
+def parse_timestamp(value):
+    """
+    Normalise an ISO-8601 timestamp to the UTC isoformat used in createdAt. Naive timestamps are taken as UTC.
+    """
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).isoformat()
+
+
+def sort_key_condition(start, end):
+    """
+    Key condition on SK (createdAt#<iso>#<imageId>) for an optional [start, end] createdAt window.
+    The end bound sorts after every imageId suffix so images created exactly at end are included.
+    """
+    if not start and not end:
+        return Key("SK").begins_with("createdAt#")
+    lower = f"createdAt#{start}" if start else "createdAt#"
+    upper = f"createdAt#{end}#~" if end else "createdAt#~"
+    return Key("SK").between(lower, upper)
 
 
+@instrumented
 def handler(event, context):
     """
     Check userId exists in queryStringParameters.
-    Optinal status Filter (AVILABLE or PENDING).
-    Pagination with 50 records on lastKey.
+    Optinal status Filter (AVILABLE, PENDING or REJECTED) resolved by DynamoDB on the sparse userStatus-index.
+    Optional from/to (ISO-8601) createdAt window and order (asc or desc), applied on the SK key condition.
+    Optional fields (comma separated) to return only those attributes.
+    Optional includeUrls (thumbnail or all) adds Pre Signed thumbnail (and original) URLs to every item,
+    signed locally with one derived signing key for the whole page.
+    Pagination with 50 records (limit, at most MAX_LIMIT) on lastKey; pages are filled up to limit.
     """    
     params = event.get("queryStringParameters") or {}
     user_id = params.get("userId")
@@ -22,7 +77,13 @@ def handler(event, context):
         return http_response(400, {"error":"userId query parameter required"})
 
     status_filter = params.get("status")
-    limit = int(params.get("limit", 50))
+    try:
+        limit = int(params.get("limit") or DEFAULT_LIMIT)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return http_response(400, {"error":"limit must be a positive integer"})
+    limit = min(limit, MAX_LIMIT)
     last_key = None
 
     if params.get("lastKey"):
@@ -30,25 +91,67 @@ def handler(event, context):
             last_key = json.loads(params["lastKey"])
         except Exception:
             return http_response(400, {"error":"invalid lastKey"})
-        
 
     try:
-        qargs = {"KeyConditionExpression": Key("PK").eq(f"user#{user_id}"), "Limit": limit}
-        if last_key:
-            qargs["ExclusiveStartKey"] = last_key
-        resp = table.query(**qargs)
+        start = parse_timestamp(params["from"]) if params.get("from") else None
+        end = parse_timestamp(params["to"]) if params.get("to") else None
+    except ValueError:
+        return http_response(400, {"error":"from and to must be ISO-8601 timestamps"})
+    if start and end and start > end:
+        return http_response(400, {"error":"from must not be after to"})
+
+    order = params.get("order", "asc")
+    if order not in ("asc", "desc"):
+        return http_response(400, {"error":"order must be asc or desc"})
+
+    sk_condition = sort_key_condition(start, end)
+    if status_filter:
+        qargs = {"IndexName": "userStatus-index", "KeyConditionExpression": Key("userStatus").eq(f"user#{user_id}#{status_filter}") & sk_condition}
+    else:
+        qargs = {"KeyConditionExpression": Key("PK").eq(f"user#{user_id}") & sk_condition}
+    qargs["ScanIndexForward"] = order == "asc"
+
+    include_urls = params.get("includeUrls")
+    if include_urls in ("true", "1"):
+        include_urls = "thumbnail"
+    if include_urls and include_urls not in URL_MODES:
+        return http_response(400, {"error":"includeUrls must be thumbnail or all"})
+    url_attrs = URL_MODES.get(include_urls, [])
+
+    if params.get("fields"):
+        projection = projection_args(params["fields"], [attr for attr, _ in url_attrs])
+        if not projection:
+            return http_response(400, {"error":"invalid fields"})
+        qargs.update(projection)
+
+    items = []
+    try:
+        while True:
+            if last_key:
+                qargs["ExclusiveStartKey"] = last_key
+            with timer("dynamodb_query"):
+                resp = table.query(Limit=limit - len(items), **qargs)
+            items.extend(resp.get("Items", []))
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key or len(items) >= limit:
+                break
 
     except Exception as e:
-        print("dynamodb_query_error", error=str(e), userId=user_id)
+        log("dynamodb_query_error", level="ERROR", userId=user_id, error=e)
         return http_response(500, {"error":"failed to query images"})
 
-    items = resp.get("Items", [])
+    metric("items", len(items))
+    if url_attrs:
+        with timer("presign"):
+            signer = UrlSigner(IMAGES_BUCKET, PRESIGNED_EXPIRES)
+            for item in items:
+                for attr, url_attr in url_attrs:
+                    if item.get(attr):
+                        item[url_attr] = signer.presign(item[attr])
 
-    if status_filter:
-        items = [i for i in items if i.get("status")==status_filter]
     result = {"items": items}
 
-    if resp.get("LastEvaluatedKey"):
-        result["lastKey"] = resp["LastEvaluatedKey"]
+    if last_key:
+        result["lastKey"] = last_key
 
-    return http_response(200, result)
\ No newline at end of file
+    return http_response(200, result)
@@ -1,42 +1,294 @@
+import os
 import time
-import random
-import logging
-from botocore import exceptions
-
-LOGGER = logging.getLogger()
-LOGGER.setLevel(logging.INFO)
-
-
-def rate_limit_exp_backoff(backoff_delay=2, retries=5):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-
-            current_attempt = 0
-            current_backoff_delay = backoff_delay
-            while current_attempt < retries:
-                try:
-                    return func(*args, **kwargs)
-                except exceptions.ClientError as error:
-                    error_code = error.response["Error"]["Code"]
-                    if error_code in [
-                        "ProvisionedThroughputExceededException",
-                        "LimitExceededException",
-                        "RequestLimitExceeded",
-                        "ThrottlingException",
-                        "RequestThrottled"
-                    ]:
-                        LOGGER.info("Rate limit exceeded; backing off and retrying ...")
-                        current_attempt += 1
-                        if current_attempt >= retries:
-                            raise error
-                        LOGGER.info(
-                            f"Failed to execute '{func.__name__}'. Retrying in {current_backoff_delay} seconds ..."
-                        )
-                        time.sleep(current_backoff_delay)
-                        current_backoff_delay *= 2 * random.random()
-                    else:
-                        raise
-
-        return wrapper
-
-    return decorator
+import hashlib
+import hmac
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decimal import Decimal
+from functools import lru_cache
+from urllib.parse import quote
+import aws_clients
+import throttling
+# Re-exported: the handlers import the key scheme from utils.
+from image_items import image_pointer_key, image_pointer_item, usage_key, get_image_item, query_image_index
+
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+DELETE_OBJECTS_LIMIT = 1000
+THUMBNAIL_PREFIX = "thumbnails/"
+
+
+def batch_get_items(table, keys, consistent_read=True, max_attempts=5):
+    """
+    Fetch keys with BatchGetItem in chunks of 100, retrying UnprocessedKeys with the throttling backoff.
+    Returns the items found (in no particular order).
+    """
+    items = []
+    for start in range(0, len(keys), BATCH_GET_LIMIT):
+        request = {table.name: {"Keys": keys[start:start + BATCH_GET_LIMIT], "ConsistentRead": consistent_read}}
+        attempt = 0
+        while request:
+            resp = table.meta.client.batch_get_item(RequestItems=request)
+            items.extend(resp.get("Responses", {}).get(table.name, []))
+            request = resp.get("UnprocessedKeys") or None
+            if request:
+                attempt += 1
+                delay = throttling.unprocessed("dynamodb", attempt, max_attempts)
+                if delay is None:
+                    raise RuntimeError(f"unprocessed keys remain after {attempt} attempts")
+                time.sleep(delay)
+    return items
+
+
+def resolve_images(table, image_ids):
+    """
+    Resolve imageIds to metadata items with two BatchGetItems (pointer items, then metadata items).
+    Images without pointer item (not yet backfilled) are looked up on the imageId-index GSI.
+    Returns {imageId: item} for the images found.
+    """
+    pointers = batch_get_items(table, [image_pointer_key(i) for i in image_ids])
+    item_keys = [{"PK": p["itemPK"], "SK": p["itemSK"]} for p in pointers]
+    found = {item["imageId"]: item for item in batch_get_items(table, item_keys)} if item_keys else {}
+
+    pointed = {p["PK"].split("#", 1)[1] for p in pointers}
+    for image_id in image_ids:
+        if image_id not in pointed:
+            item = query_image_index(table, image_id)
+            if item:
+                found[image_id] = item
+    return found
+
+def content_hash_key(user_id, content_hash):
+    return {"PK": f"user#{user_id}", "SK": f"hash#{content_hash}"}
+
+
+def find_stored_hashes(table, user_id, content_hashes):
+    """
+    Map sha256 content hashes to AVAILABLE images of the user holding the same bytes.
+    The hash items written by the image processor are checked against the image they name,
+    so entries left behind by deleted images are ignored.
+    Returns {contentHash: imageId}.
+    """
+    hash_items = batch_get_items(table, [content_hash_key(user_id, h) for h in dict.fromkeys(content_hashes)])
+    if not hash_items:
+        return {}
+    images = resolve_images(table, list({h["imageId"] for h in hash_items}))
+
+    stored = {}
+    for hash_item in hash_items:
+        content_hash = hash_item["SK"].split("#", 1)[1]
+        image = images.get(hash_item["imageId"])
+        if image and image.get("status") == "AVAILABLE" and image.get("contentHash") == content_hash:
+            stored[content_hash] = image["imageId"]
+    return stored
+
+
+def batch_write(table, requests, max_attempts=5):
+    """
+    Send PutRequest/DeleteRequest write requests with BatchWriteItem in chunks of 25,
+    retrying UnprocessedItems with the throttling backoff.
+    Returns the requests still unprocessed after max_attempts or at the invocation deadline
+    (empty when everything was written).
+    """
+    failed = []
+    for start in range(0, len(requests), BATCH_WRITE_LIMIT):
+        pending = requests[start:start + BATCH_WRITE_LIMIT]
+        attempt = 0
+        while pending:
+            resp = table.meta.client.batch_write_item(RequestItems={table.name: pending})
+            pending = resp.get("UnprocessedItems", {}).get(table.name, [])
+            if pending:
+                attempt += 1
+                delay = throttling.unprocessed("dynamodb", attempt, max_attempts)
+                if delay is None:
+                    failed.extend(pending)
+                    break
+                time.sleep(delay)
+    return failed
+
+
+def json_default(value):
+    """
+    json.dumps default for values returned by DynamoDB (numbers come back as Decimal, string sets as set).
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+@lru_cache(maxsize=4)
+def sigv4_signing_key(secret_key, datestamp, region, service="s3"):
+    key = hmac.new(f"AWS4{secret_key}".encode(), datestamp.encode(), hashlib.sha256).digest()
+    for part in (region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+class UrlSigner:
+    """
+    SigV4 query string presigner for S3 GET URLs of one bucket.
+    The signing key (four chained HMACs) is derived once per credentials, day and region and reused for every URL,
+    where generate_presigned_url derives it again for each call. Create one per invocation so rotated
+    credentials are picked up.
+    """
+
+    def __init__(self, bucket, expires, credentials=None, region=None, now=None):
+        session = aws_clients.session()
+        credentials = credentials or session.get_credentials().get_frozen_credentials()
+        self.region = region or session.region_name or "us-east-1"
+        self.host = f"{bucket}.s3.{self.region}.amazonaws.com"
+        self.amz_date = (now or datetime.now(timezone.utc)).strftime("%Y%m%dT%H%M%SZ")
+        datestamp = self.amz_date[:8]
+        self.scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        self.signing_key = sigv4_signing_key(credentials.secret_key, datestamp, self.region)
+
+        params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{credentials.access_key}/{self.scope}",
+            "X-Amz-Date": self.amz_date,
+            "X-Amz-Expires": str(expires),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if credentials.token:
+            params["X-Amz-Security-Token"] = credentials.token
+        self.query = "&".join(f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(params.items()))
+
+    def presign(self, key):
+        path = "/" + quote(key, safe="/-_.~")
+        canonical_request = f"GET\n{path}\n{self.query}\nhost:{self.host}\n\nhost\nUNSIGNED-PAYLOAD"
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", self.amz_date, self.scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+        signature = hmac.new(self.signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return f"https://{self.host}{path}?{self.query}&X-Amz-Signature={signature}"
+
+
+class TtlLruCache:
+    """
+    Bounded LRU cache with a TTL per entry, kept in module scope so it survives between invocations of a warm container.
+    None is a valid (negative) value; get() returns TtlLruCache.MISSING when there is no live entry.
+    """
+    MISSING = object()
+
+    def __init__(self, max_entries, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.negative_hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            if entry[0] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "negativeHits": self.negative_hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+# imageId -> download response body (or None for images known not to exist).
+# Deletes run in other functions, so download_image revalidates hits against the item before serving them.
+image_cache = TtlLruCache(int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "1024")))
+
+
+def image_prefixes(item):
+    """
+    S3 prefixes holding an image's objects: the original (users/<userId>/<imageId>/) and its renditions.
+    The rendition prefix has no trailing slash so it also covers the single thumbnail of images processed
+    before rendition sets (thumbnails/<userId>/<imageId>.jpg); imageIds are uuid4s, so it matches no other image.
+    A thumbnailKey stored outside both is included as its own prefix.
+    """
+    user_id = item.get("userId") or item["s3Key"].split("/")[1]
+    prefixes = [f"users/{user_id}/{item['imageId']}/", f"{THUMBNAIL_PREFIX}{user_id}/{item['imageId']}"]
+    thumbnail_key = item.get("thumbnailKey")
+    if thumbnail_key and not any(thumbnail_key.startswith(prefix) for prefix in prefixes):
+        prefixes.append(thumbnail_key)
+    return prefixes
+
+
+def iter_version_pages(s3, bucket, prefix, key_marker=None, version_id_marker=None):
+    """
+    Yield (objects, next_key_marker, next_version_id_marker) per list_object_versions page under prefix,
+    objects being the {Key, VersionId} of every version and delete marker (at most 1000 per page).
+    The markers are None on the last page and can be used to resume listing.
+    """
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if key_marker:
+        kwargs["KeyMarker"] = key_marker
+        if version_id_marker:
+            kwargs["VersionIdMarker"] = version_id_marker
+    while True:
+        resp = s3.list_object_versions(**kwargs)
+        objects = [{"Key": v["Key"], "VersionId": v["VersionId"]}
+                   for v in resp.get("Versions", []) + resp.get("DeleteMarkers", [])]
+        truncated = resp.get("IsTruncated")
+        next_markers = (resp.get("NextKeyMarker"), resp.get("NextVersionIdMarker")) if truncated else (None, None)
+        yield (objects,) + next_markers
+        if not truncated:
+            return
+        kwargs["KeyMarker"], kwargs["VersionIdMarker"] = next_markers
+
+
+def delete_objects(s3, bucket, objects):
+    """
+    Delete objects ({Key, VersionId}) with DeleteObjects in batches of 1000 keys.
+    Returns (deleted_count, errors).
+    """
+    deleted, errors = 0, []
+    for start in range(0, len(objects), DELETE_OBJECTS_LIMIT):
+        chunk = objects[start:start + DELETE_OBJECTS_LIMIT]
+        resp = s3.delete_objects(Bucket=bucket, Delete={"Objects": chunk, "Quiet": True})
+        chunk_errors = resp.get("Errors", [])
+        deleted += len(chunk) - len(chunk_errors)
+        errors.extend(chunk_errors)
+    return deleted, errors
+
+
+def delete_all_versions(s3, bucket, prefixes):
+    """
+    Permanently delete every version and delete marker under the prefixes (the bucket is versioned, so a
+    plain DeleteObject would only add a delete marker). Keys of all prefixes are packed into DeleteObjects
+    calls of up to 1000 keys. Returns (deleted_count, errors).
+    """
+    deleted, errors, pending = 0, [], []
+    for prefix in prefixes:
+        for objects, _, _ in iter_version_pages(s3, bucket, prefix):
+            pending.extend(objects)
+            if len(pending) >= DELETE_OBJECTS_LIMIT:
+                count, errs = delete_objects(s3, bucket, pending[:DELETE_OBJECTS_LIMIT])
+                deleted, errors, pending = deleted + count, errors + errs, pending[DELETE_OBJECTS_LIMIT:]
+    if pending:
+        count, errs = delete_objects(s3, bucket, pending)
+        deleted, errors = deleted + count, errors + errs
+    return deleted, errors
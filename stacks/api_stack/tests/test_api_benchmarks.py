@@ -0,0 +1,65 @@
+import json
+import boto3
+import pytest
+from stacks import benchmarking
+from stacks.api_stack.lambdas.initiate_upload import handler as initiate_handler
+from stacks.api_stack.lambdas.list_images import handler as list_handler
+from stacks.api_stack.lambdas.download_image import handler as get_image_handler, image_cache
+
+# Images in the benchmarked user's partition; every fifth one is PENDING.
+PARTITION_SIZE = 3000
+
+
+@pytest.fixture
+def large_partition(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    with table.batch_writer() as batch:
+        for i in range(PARTITION_SIZE):
+            status = "PENDING" if i % 5 == 0 else "AVAILABLE"
+            sk = f"createdAt#2025-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}.{i:06d}+00:00#img{i}"
+            batch.put_item(Item={"PK": "user#u1", "SK": sk, "imageId": f"img{i}", "userId": "u1",
+                                 "createdAt": sk.split("#")[1], "status": status, "userStatus": f"user#u1#{status}",
+                                 "s3Key": f"users/u1/img{i}/pic.jpg", "size": 2_000_000, "tags": ["holiday"]})
+            batch.put_item(Item={"PK": f"image#img{i}", "SK": f"image#img{i}", "itemPK": "user#u1", "itemSK": sk})
+
+
+def test_benchmark_initiate_upload(aws_env, benchmark):
+    event = {"body": json.dumps({"userId": "u1", "filename": "pic.jpg", "contentType": "image/jpeg"})}
+    benchmark("initiate_upload.single", lambda: initiate_handler(event, None))
+
+    files = [{"filename": f"p{i}.jpg", "contentType": "image/jpeg"} for i in range(25)]
+    event = {"body": json.dumps({"userId": "u1", "files": files})}
+    benchmark("initiate_upload.batch_25", lambda: initiate_handler(event, None), rounds=10)
+
+
+def test_benchmark_list_images(large_partition, benchmark):
+    def page(**params):
+        return list_handler({"queryStringParameters": {"userId": "u1", **params}}, None)
+
+    def walk():
+        params = {"limit": "100"}
+        while True:
+            body = json.loads(page(**params)["body"])
+            if "lastKey" not in body:
+                return
+            params["lastKey"] = json.dumps(body["lastKey"])
+
+    benchmark("list_images.first_page", lambda: page())
+    benchmark("list_images.page_100", lambda: page(limit="100"))
+    benchmark("list_images.status_page_100", lambda: page(status="PENDING", limit="100"))
+    benchmark("list_images.full_partition", walk, rounds=3)
+
+
+def test_benchmark_download_image(large_partition, benchmark):
+    event = {"pathParameters": {"imageId": "img1"}}
+    benchmark("download_image.miss", lambda: get_image_handler(event, None), setup=image_cache.clear)
+    benchmark("download_image.hit", lambda: get_image_handler(event, None))
+
+
+def test_regressions_flag_slower_and_larger_results():
+    baseline = {"median_ms": 10.0, "peak_kib": 1000.0}
+    assert benchmarking.regressions({"median_ms": 12.0, "peak_kib": 1100.0}, baseline) == []
+    # Sub-millisecond jitter is not a regression however large relatively.
+    assert benchmarking.regressions({"median_ms": 0.6, "peak_kib": 1000.0}, {**baseline, "median_ms": 0.2}) == []
+    assert benchmarking.regressions({"median_ms": 20.0, "peak_kib": 2000.0}, baseline) == [
+        "median_ms 10.0ms -> 20.0ms (+100%)", "peak_kib 1000.0KiB -> 2000.0KiB (+100%)"]
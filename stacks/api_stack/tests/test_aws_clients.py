@@ -0,0 +1,34 @@
+from decimal import Decimal
+from unittest import mock
+from boto3.dynamodb.conditions import Attr, Key
+import aws_clients
+
+
+def test_clients_are_created_on_first_use_and_shared():
+    aws_clients.reset()
+    s3 = aws_clients.lazy_client("s3", "transfer", pool_size=12)
+    assert aws_clients._clients == {}
+
+    assert s3.meta.service_model.service_name == "s3"
+    client = aws_clients.client("s3", "transfer", pool_size=12)
+    assert s3.meta is client.meta
+    assert aws_clients.client("s3") is not client
+    assert client.meta.config.max_pool_connections == 12
+    assert client.meta.config.retries == {"mode": "standard", "total_max_attempts": 1}
+    assert aws_clients.client("sqs", "transfer").meta.config.retries == {"mode": "adaptive", "total_max_attempts": 6}
+    assert client.meta.config.read_timeout == aws_clients.PROFILES["transfer"]["read_timeout"]
+
+
+def test_dynamodb_table_uses_the_low_level_client(aws_env):
+    aws_clients.reset()
+    session = aws_clients.session()
+    with mock.patch.object(session, "resource") as resource:
+        table = aws_clients.dynamodb_table("ImagesTable", "background", pool_size=4)
+        assert aws_clients.dynamodb_table("ImagesTable", "background", pool_size=4) is table
+        table.put_item(Item={"PK": "user#u1", "SK": "createdAt#t#i1", "size": 12, "tags": {"a", "b"}},
+                       ConditionExpression=Attr("PK").not_exists())
+        items = table.query(KeyConditionExpression=Key("PK").eq("user#u1"))["Items"]
+    resource.assert_not_called()
+    assert items == [{"PK": "user#u1", "SK": "createdAt#t#i1", "size": Decimal(12), "tags": {"a", "b"}}]
+    assert table.meta.client is aws_clients.client("dynamodb", "background", pool_size=4)
+
@@ -0,0 +1,33 @@
+import json
+import boto3
+from stacks.api_stack.lambdas.batch_get_images import handler as batch_get_handler
+
+
+def put_image(table, image_id, pointer=True, **extra):
+    item = {"PK":"user#u1","SK":f"createdAt#t#{image_id}","imageId":image_id,"createdAt":"t",
+            "s3Key":f"users/u1/{image_id}/pic.jpg", **extra}
+    table.put_item(Item=item)
+    if pointer:
+        table.put_item(Item={"PK":f"image#{image_id}","SK":f"image#{image_id}","itemPK":item["PK"],"itemSK":item["SK"]})
+
+
+def test_batch_get_images(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    put_image(table, "i1", thumbnailKey="thumbnails/u1/i1/thumbnail.jpg", size=10)
+    put_image(table, "i2")
+    put_image(table, "legacy", pointer=False)
+
+    event = {"body": json.dumps({"imageIds": ["i2", "missing", "i1", "legacy", "i1"]})}
+    resp = batch_get_handler(event, None)
+    assert resp["statusCode"] == 200
+    body = json.loads(resp["body"])
+    assert [i["imageId"] for i in body["images"]] == ["i2", "i1", "legacy"]
+    assert body["notFound"] == ["missing"]
+    assert "thumbnailUrl" in body["images"][1] and "thumbnailUrl" not in body["images"][0]
+    assert all("downloadUrl" in i for i in body["images"])
+
+
+def test_batch_get_images_validation(aws_env):
+    for ids in ([], "i1", [1], [f"i{n}" for n in range(101)]):
+        resp = batch_get_handler({"body": json.dumps({"imageIds": ids})}, None)
+        assert resp["statusCode"] == 400
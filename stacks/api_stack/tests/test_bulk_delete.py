@@ -0,0 +1,49 @@
+import json
+import boto3
+from stacks.api_stack.lambdas.bulk_delete import handler as bulk_delete_handler
+from stacks.api_stack.lambdas.delete_image import handler as delete_handler
+
+
+def put_image(table, s3, user_id, image_id):
+    sk = f"createdAt#t#{image_id}"
+    table.put_item(Item={"PK":f"user#{user_id}","SK":sk,"imageId":image_id,"createdAt":"t","s3Key":f"users/{user_id}/{image_id}/pic.jpg"})
+    table.put_item(Item={"PK":f"image#{image_id}","SK":f"image#{image_id}","itemPK":f"user#{user_id}","itemSK":sk})
+    s3.put_object(Bucket="images-bucket", Key=f"users/{user_id}/{image_id}/pic.jpg", Body=b"data")
+    s3.put_object(Bucket="images-bucket", Key=f"thumbnails/{user_id}/{image_id}/thumbnail.jpg", Body=b"thumb")
+
+
+def test_bulk_delete_removes_items_objects_and_renditions(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    for image_id in ("i1", "i2", "i3"):
+        put_image(table, s3, "u1", image_id)
+
+    resp = bulk_delete_handler({"body": json.dumps({"imageIds": ["i1", "i2", "missing"]})}, None)
+    assert resp["statusCode"] == 200
+    body = json.loads(resp["body"])
+    assert body["deleted"] == ["i1", "i2"]
+    assert body["notFound"] == ["missing"]
+    assert body["failed"] == []
+    assert body["objectsDeleted"] == 4
+
+    assert "Item" not in table.get_item(Key={"PK":"user#u1","SK":"createdAt#t#i1"})
+    assert "Item" not in table.get_item(Key={"PK":"image#i2","SK":"image#i2"})
+    assert "Item" in table.get_item(Key={"PK":"image#i3","SK":"image#i3"})
+    keys = [o["Key"] for o in s3.list_objects_v2(Bucket="images-bucket").get("Contents", [])]
+    assert sorted(keys) == ["thumbnails/u1/i3/thumbnail.jpg", "users/u1/i3/pic.jpg"]
+
+def test_bulk_delete_validates_body(aws_env):
+    assert bulk_delete_handler({"body": json.dumps({"imageIds": []})}, None)["statusCode"] == 400
+    assert bulk_delete_handler({"body": json.dumps({"imageIds": [str(i) for i in range(101)]})}, None)["statusCode"] == 400
+
+def test_delete_image_removes_all_versions(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.put_bucket_versioning(Bucket="images-bucket", VersioningConfiguration={"Status": "Enabled"})
+    put_image(table, s3, "u1", "i1")
+    s3.put_object(Bucket="images-bucket", Key="users/u1/i1/pic.jpg", Body=b"data v2")
+
+    resp = delete_handler({"pathParameters": {"imageId":"i1"}}, None)
+    assert resp["statusCode"] == 200
+    versions = s3.list_object_versions(Bucket="images-bucket")
+    assert not versions.get("Versions") and not versions.get("DeleteMarkers")
@@ -0,0 +1,56 @@
+import json
+import boto3
+from stacks.api_stack.lambdas.initiate_upload import handler as initiate_handler
+from stacks.api_stack.lambdas.complete_upload import handler as complete_handler
+
+PART = 5 * 1024 * 1024
+
+
+def initiate_multipart(size):
+    event = {"body": json.dumps({"userId":"u1","filename":"raw.dng","multipart":True,"size":size})}
+    resp = initiate_handler(event, None)
+    assert resp["statusCode"] == 200
+    return json.loads(resp["body"])
+
+
+def test_multipart_upload_complete(aws_env):
+    upload = initiate_multipart(2 * PART + 10)
+    assert upload["partSize"] == 16 * 1024 * 1024
+    assert len(upload["parts"]) == 1
+
+    upload = json.loads(initiate_handler({"body": json.dumps({"userId":"u1","filename":"raw.dng","multipart":True,
+                                                              "size":2 * PART + 10,"partSize":PART})}, None)["body"])
+    assert [p["partNumber"] for p in upload["parts"]] == [1, 2, 3]
+
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    pointer = table.get_item(Key={"PK": f"image#{upload['imageId']}", "SK": f"image#{upload['imageId']}"})["Item"]
+    item = table.get_item(Key={"PK": pointer["itemPK"], "SK": pointer["itemSK"]})["Item"]
+    assert item["uploadId"] == upload["uploadId"] and "expiresAt" in item
+
+    s3 = boto3.client("s3", region_name="us-east-1")
+    for number, data in ((1, b"a" * PART), (2, b"b" * PART), (3, b"c" * 10)):
+        s3.upload_part(Bucket="images-bucket", Key=item["s3Key"], UploadId=upload["uploadId"], PartNumber=number, Body=data)
+
+    resp = complete_handler({"pathParameters": {"imageId": upload["imageId"]}, "body": json.dumps({"action":"complete"})}, None)
+    assert resp["statusCode"] == 200
+    assert s3.head_object(Bucket="images-bucket", Key=item["s3Key"])["ContentLength"] > 2 * PART
+
+
+def test_multipart_upload_abort(aws_env):
+    upload = initiate_multipart(PART)
+    resp = complete_handler({"pathParameters": {"imageId": upload["imageId"]}, "body": json.dumps({"action":"abort"})}, None)
+    assert resp["statusCode"] == 200
+    s3 = boto3.client("s3", region_name="us-east-1")
+    assert not s3.list_multipart_uploads(Bucket="images-bucket").get("Uploads")
+
+    resp = complete_handler({"pathParameters": {"imageId": upload["imageId"]}, "body": json.dumps({"action":"abort"})}, None)
+    assert resp["statusCode"] == 404
+
+
+def test_multipart_upload_bad_requests(aws_env):
+    for body in ({"multipart":True}, {"multipart":True,"size":0}, {"multipart":True,"size":6 * 1024**3}):
+        resp = initiate_handler({"body": json.dumps({"userId":"u1","filename":"raw.dng", **body})}, None)
+        assert resp["statusCode"] == 400
+
+    resp = complete_handler({"pathParameters": {"imageId": "i1"}, "body": json.dumps({"action":"finish"})}, None)
+    assert resp["statusCode"] == 400
@@ -0,0 +1,43 @@
+import json
+import boto3
+from stacks.api_stack.lambdas.delete_image import handler as delete_handler
+
+
+def test_delete_image_removes_item_and_pointer(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","createdAt":"t","s3Key":"users/u1/i1/pic.jpg"})
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.put_object(Bucket="images-bucket", Key="users/u1/i1/pic.jpg", Body=b"data")
+
+    resp = delete_handler({"pathParameters": {"imageId":"i1"}}, None)
+    assert resp["statusCode"] == 200
+    assert json.loads(resp["body"]) == {"deletedImageId": "i1"}
+    assert "Item" not in table.get_item(Key={"PK":"user#u1","SK":"createdAt#t#i1"})
+    assert "Item" not in table.get_item(Key={"PK":"image#i1","SK":"image#i1"})
+
+def test_delete_image_not_found(aws_env):
+    resp = delete_handler({"pathParameters": {"imageId":"missing"}}, None)
+    assert resp["statusCode"] == 404
+
+def test_delete_image_removes_legacy_thumbnail_versions(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    # Processed before rendition sets: a single thumbnail next to the rendition folders, no renditions map.
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","createdAt":"t","s3Key":"users/u1/i1/pic.jpg",
+                         "thumbnailKey":"thumbnails/u1/i1.jpg"})
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i2","imageId":"i2","createdAt":"t","s3Key":"users/u1/i2/pic.jpg",
+                         "thumbnailKey":"thumbnails/legacy/u1-i2.jpg"})
+    table.put_item(Item={"PK":"image#i2","SK":"image#i2","itemPK":"user#u1","itemSK":"createdAt#t#i2"})
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.put_bucket_versioning(Bucket="images-bucket", VersioningConfiguration={"Status": "Enabled"})
+    for key in ("users/u1/i1/pic.jpg", "thumbnails/u1/i1.jpg", "thumbnails/u1/i1.jpg",
+                "users/u1/i2/pic.jpg", "thumbnails/legacy/u1-i2.jpg", "thumbnails/u1/other.jpg"):
+        s3.put_object(Bucket="images-bucket", Key=key, Body=b"data")
+
+    for image_id in ("i1", "i2"):
+        assert delete_handler({"pathParameters": {"imageId":image_id}}, None)["statusCode"] == 200
+
+    versions = s3.list_object_versions(Bucket="images-bucket")
+    remaining = {v["Key"] for v in versions.get("Versions", []) + versions.get("DeleteMarkers", [])}
+    assert remaining == {"thumbnails/u1/other.jpg"}
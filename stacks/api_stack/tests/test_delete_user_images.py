@@ -0,0 +1,79 @@
+import json
+from types import SimpleNamespace
+from unittest import mock
+import boto3
+from stacks.api_stack.lambdas import delete_user_images
+
+
+def context(remaining_ms=900_000):
+    return SimpleNamespace(function_name="worker", get_remaining_time_in_millis=lambda: remaining_ms)
+
+
+def seed(table, s3, user_id, count):
+    for n in range(count):
+        image_id = f"i{n}"
+        sk = f"createdAt#t{n}#{image_id}"
+        table.put_item(Item={"PK":f"user#{user_id}","SK":sk,"imageId":image_id,"createdAt":f"t{n}"})
+        table.put_item(Item={"PK":f"image#{image_id}","SK":f"image#{image_id}","itemPK":f"user#{user_id}","itemSK":sk})
+        s3.put_object(Bucket="images-bucket", Key=f"users/{user_id}/{image_id}/pic.jpg", Body=b"data")
+        s3.put_object(Bucket="images-bucket", Key=f"thumbnails/{user_id}/{image_id}/thumbnail.jpg", Body=b"thumb")
+
+
+def test_start_job_and_run_worker(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    seed(table, s3, "u1", 3)
+    table.put_item(Item={"PK":"user#u1","SK":"hash#abc","imageId":"i0"})
+    table.put_item(Item={"PK":"user#u1","SK":"usage","availableImages":3,"totalBytes":12})
+    s3.put_object(Bucket="images-bucket", Key="users/u2/keep/pic.jpg", Body=b"other user")
+
+    with mock.patch.object(delete_user_images, "lambda_client") as lambda_client:
+        resp = delete_user_images.handler({"httpMethod":"POST","pathParameters":{"userId":"u1"}}, None)
+        assert resp["statusCode"] == 202
+        job_id = json.loads(resp["body"])["jobId"]
+        payload = json.loads(lambda_client.invoke.call_args.kwargs["Payload"])
+        assert payload == {"userId": "u1", "jobId": job_id}
+
+        assert delete_user_images.job_handler(payload, context()) == {"resumed": False}
+
+    keys = [o["Key"] for o in s3.list_objects_v2(Bucket="images-bucket").get("Contents", [])]
+    assert keys == ["users/u2/keep/pic.jpg"]
+    assert "Item" not in table.get_item(Key={"PK":"image#i0","SK":"image#i0"})
+    assert "Item" not in table.get_item(Key={"PK":"user#u1","SK":"hash#abc"})
+    assert "Item" not in table.get_item(Key={"PK":"user#u1","SK":"usage"})
+
+    resp = delete_user_images.handler({"httpMethod":"GET","pathParameters":{"userId":"u1","jobId":job_id}}, None)
+    job = json.loads(resp["body"])
+    assert job["status"] == "COMPLETED"
+    assert job["objectsDeleted"] == 6
+    assert job["imagesDeleted"] == 3
+
+def test_worker_resumes_when_out_of_time(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    seed(table, s3, "u1", 2)
+    table.put_item(Item=delete_user_images.job_key("u1", "j1"))
+
+    with mock.patch.object(delete_user_images, "lambda_client") as lambda_client, \
+         mock.patch.object(delete_user_images, "ITEMS_PAGE_SIZE", 1):
+        state = {"userId": "u1", "jobId": "j1", "phase": "items"}
+        assert delete_user_images.job_handler(state, context(remaining_ms=1000)) == {"resumed": True}
+        resumed = json.loads(lambda_client.invoke.call_args.kwargs["Payload"])
+        assert resumed["phase"] == "items"
+
+        assert delete_user_images.job_handler(resumed, context()) == {"resumed": False}
+    assert table.query(KeyConditionExpression="PK = :pk", ExpressionAttributeValues={":pk":"user#u1"})["Items"] == [
+        table.get_item(Key=delete_user_images.job_key("u1", "j1"))["Item"]]
+
+def test_worker_failure_is_final(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={**delete_user_images.job_key("u1", "j1"), "status": "RUNNING", "errorCount": 0})
+
+    with mock.patch.object(delete_user_images, "delete_user_objects", side_effect=RuntimeError("boom")):
+        assert delete_user_images.job_handler({"userId": "u1", "jobId": "j1"}, context()) == {"resumed": False}
+    job = table.get_item(Key=delete_user_images.job_key("u1", "j1"))["Item"]
+    assert (job["status"], job["errorCount"]) == ("FAILED", 1)
+
+def test_get_unknown_job(aws_env):
+    resp = delete_user_images.handler({"httpMethod":"GET","pathParameters":{"userId":"u1","jobId":"nope"}}, None)
+    assert resp["statusCode"] == 404
@@ -1,6 +1,7 @@
 import json
 import boto3
-from stacks.api_stack.lambdas.download_image import handler as get_image_handler
+from stacks.api_stack.lambdas.download_image import handler as get_image_handler, image_cache
+from stacks.api_stack.lambdas.delete_image import handler as delete_image_handler
 
 
 def test_get_image_not_found(aws_env):
@@ -11,10 +12,65 @@ def test_get_image_not_found(aws_env):
 def test_get_image_success(aws_env):
     ddb = boto3.resource("dynamodb", region_name="us-east-1")
     table = ddb.Table("ImagesTable")
-    item = {"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","s3Key":"users/u1/i1/pic.jpg"}
+    item = {"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","createdAt":"t","s3Key":"users/u1/i1/pic.jpg"}
     table.put_item(Item=item)
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
     event = {"pathParameters": {"imageId":"i1"}}
     resp = get_image_handler(event, None)
     assert resp["statusCode"] == 200
     data = json.loads(resp["body"])
     assert "downloadUrl" in data
+
+def test_get_image_without_pointer_falls_back_to_index(aws_env):
+    ddb = boto3.resource("dynamodb", region_name="us-east-1")
+    table = ddb.Table("ImagesTable")
+    item = {"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","createdAt":"t","s3Key":"users/u1/i1/pic.jpg"}
+    table.put_item(Item=item)
+    resp = get_image_handler({"pathParameters": {"imageId":"i1"}}, None)
+    assert resp["statusCode"] == 200
+    assert json.loads(resp["body"])["metadata"]["s3Key"] == "users/u1/i1/pic.jpg"
+
+def test_get_image_served_from_cache(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","s3Key":"users/u1/i1/pic.jpg","status":"AVAILABLE"})
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
+    event = {"pathParameters": {"imageId":"i1"}}
+
+    first = get_image_handler(event, None)
+    second = get_image_handler(event, None)
+    assert first["headers"]["X-Cache"] == "MISS"
+    assert second["headers"]["X-Cache"] == "HIT"
+    assert json.loads(second["body"]) == json.loads(first["body"])
+    assert image_cache.stats()["hits"] == 1
+
+    # delete_image does not touch the cache (it runs in another function); the cached hit fails revalidation.
+    assert delete_image_handler(event, None)["statusCode"] == 200
+    resp = get_image_handler(event, None)
+    assert resp["statusCode"] == 404 and resp["headers"]["X-Cache"] == "MISS"
+
+def test_get_image_cached_hit_revalidates_status(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","s3Key":"users/u1/i1/pic.jpg","status":"AVAILABLE"})
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
+    event = {"pathParameters": {"imageId":"i1"}}
+    assert get_image_handler(event, None)["headers"]["X-Cache"] == "MISS"
+
+    table.update_item(Key={"PK":"user#u1","SK":"createdAt#t#i1"}, UpdateExpression="SET #s = :s",
+                      ExpressionAttributeNames={"#s":"status"}, ExpressionAttributeValues={":s":"REJECTED"})
+    resp = get_image_handler(event, None)
+    assert resp["headers"]["X-Cache"] == "MISS"
+    assert json.loads(resp["body"])["metadata"]["status"] == "REJECTED"
+
+def test_get_image_not_found_is_cached(aws_env):
+    event = {"pathParameters": {"imageId":"i1"}}
+    assert get_image_handler(event, None)["headers"]["X-Cache"] == "MISS"
+    assert get_image_handler(event, None)["headers"]["X-Cache"] == "HIT"
+    assert image_cache.stats()["negativeHits"] == 1
+
+def test_get_image_pending_not_cached(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","s3Key":"users/u1/i1/pic.jpg","status":"PENDING"})
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
+    event = {"pathParameters": {"imageId":"i1"}}
+    get_image_handler(event, None)
+    assert get_image_handler(event, None)["headers"]["X-Cache"] == "MISS"
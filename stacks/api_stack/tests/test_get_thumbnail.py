@@ -0,0 +1,98 @@
+import io
+import json
+import threading
+from unittest import mock
+import boto3
+from PIL import Image
+from stacks.api_stack.lambdas import get_thumbnail
+
+
+def put_available_image(size=(1600, 1200)):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#u1","SK":"createdAt#t#i1","imageId":"i1","userId":"u1","createdAt":"t",
+                         "status":"AVAILABLE","s3Key":"users/u1/i1/pic.jpg"})
+    table.put_item(Item={"PK":"image#i1","SK":"image#i1","itemPK":"user#u1","itemSK":"createdAt#t#i1"})
+    buf = io.BytesIO()
+    Image.new("RGB", size, "green").save(buf, format="JPEG")
+    boto3.client("s3", region_name="us-east-1").put_object(Bucket="images-bucket", Key="users/u1/i1/pic.jpg", Body=buf.getvalue())
+
+
+def request(params, image_id="i1"):
+    return get_thumbnail.handler({"pathParameters": {"imageId": image_id}, "queryStringParameters": params}, None)
+
+
+def test_snap_to_allowed_sizes():
+    assert get_thumbnail.parse_params({"w": "150"}) == (200, 200, "jpeg")
+    assert get_thumbnail.parse_params({"w": "90", "h": "300", "fmt": "WEBP"}) == (128, 400, "webp")
+    assert get_thumbnail.parse_params({"w": "99999"})[0] == 1600
+
+
+def test_thumbnail_generated_once_then_redirected(aws_env):
+    get_thumbnail.rendition_cache.clear()
+    put_available_image()
+
+    with mock.patch.object(get_thumbnail, "render", wraps=get_thumbnail.render) as render:
+        first = request({"w": "300", "h": "300", "fmt": "webp"})
+        second = request({"w": "390", "fmt": "webp"})
+    assert render.call_count == 1
+    assert first["statusCode"] == second["statusCode"] == 302
+    assert "thumbnails/u1/i1/400x400.webp" in first["headers"]["Location"]
+
+    obj = boto3.client("s3", region_name="us-east-1").get_object(Bucket="images-bucket", Key="thumbnails/u1/i1/400x400.webp")
+    assert obj["ContentType"] == "image/webp"
+    with Image.open(io.BytesIO(obj["Body"].read())) as im:
+        assert im.format == "WEBP" and im.size == (400, 300)
+
+
+def test_concurrent_first_requests_are_coalesced(aws_env):
+    get_thumbnail.rendition_cache.clear()
+    put_available_image()
+    assert get_thumbnail.acquire_lock("thumbnails/u1/i1/200x200.jpg")
+
+    # Another caller holds the lock: this request waits for the object instead of generating it.
+    def finish_other_generator():
+        boto3.client("s3", region_name="us-east-1").put_object(Bucket="images-bucket", Key="thumbnails/u1/i1/200x200.jpg", Body=b"x")
+    timer = threading.Timer(0.2, finish_other_generator)
+    timer.start()
+    with mock.patch.object(get_thumbnail, "render") as render:
+        resp = request({"w": "200"})
+    timer.join()
+    render.assert_not_called()
+    assert resp["statusCode"] == 302
+
+
+def test_thumbnail_errors(aws_env):
+    assert request({"w": "abc"})["statusCode"] == 400
+    assert request({"fmt": "gif", "w": "10"})["statusCode"] == 400
+    assert request({"w": "10"}, image_id="missing")["statusCode"] == 404
+
+
+def test_release_lock_keeps_a_lock_taken_over_after_expiry(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    key = "thumbnails/u1/i1/200x200.jpg"
+    stale = get_thumbnail.acquire_lock(key)
+    table.update_item(Key={"PK": f"lock#{key}", "SK": f"lock#{key}"}, UpdateExpression="SET expiresAt = :e",
+                      ExpressionAttributeValues={":e": 0})
+    current = get_thumbnail.acquire_lock(key)
+    assert current and current != stale
+
+    # The generator that ran past LOCK_TTL must not release the new owner's lock.
+    get_thumbnail.release_lock(key, stale)
+    assert table.get_item(Key={"PK": f"lock#{key}", "SK": f"lock#{key}"})["Item"]["lockId"] == current
+    get_thumbnail.release_lock(key, current)
+    assert "Item" not in table.get_item(Key={"PK": f"lock#{key}", "SK": f"lock#{key}"})
+
+
+def test_oversize_original_is_refused(aws_env):
+    get_thumbnail.rendition_cache.clear()
+    put_available_image()
+
+    with mock.patch.object(get_thumbnail, "MAX_SOURCE_BYTES", 100):
+        assert request({"w": "1600"})["statusCode"] == 422
+    with mock.patch.object(get_thumbnail, "MAX_DECODE_PIXELS", 1_000_000):
+        resp = request({"w": "1600"})
+    assert resp["statusCode"] == 422
+    assert "decoded pixels" in json.loads(resp["body"])["error"]
+
+    # The lock was released, so the rendition can still be generated within the limits.
+    assert request({"w": "1600"})["statusCode"] == 302
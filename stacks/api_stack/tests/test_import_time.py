@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+LAMBDAS = os.path.join(os.path.dirname(__file__), "..", "lambdas")
+LAYER = os.path.join(os.path.dirname(__file__), "..", "..", "shared", "python_layer")
+HANDLERS = ["initiate_upload", "list_images", "download_image", "batch_get_images", "complete_upload",
+            "delete_image", "bulk_delete", "delete_user_images", "get_thumbnail"]
+# Cold init (import plus building the clients the module binds) in a fresh interpreter, in seconds.
+# Loose enough for a shared CI runner; the module checks below catch the usual regressions exactly.
+COLD_INIT_BUDGET = float(os.environ.get("COLD_INIT_BUDGET", "1.0"))
+# Never imported on the synchronous paths at init.
+HEAVY_MODULES = ["jsonschema", "PIL"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+import aws_clients
+built = len(aws_clients._clients)
+for value in list(vars(module).values()):
+    if isinstance(value, aws_clients.Lazy):
+        value._factory(*value._args)
+print(json.dumps({"import": imported - start, "init": time.perf_counter() - start, "clientsAtImport": built,
+                  "heavy": [name for name in sys.argv[2:] if name in sys.modules]}))
+"""
+
+
+def cold_init(module):
+    env = dict(os.environ, IMAGES_TABLE="ImagesTable", IMAGES_BUCKET="images-bucket", AWS_DEFAULT_REGION="us-east-1",
+               PYTHONPATH=os.pathsep.join([LAMBDAS, LAYER]))
+    out = subprocess.run([sys.executable, "-c", PROBE, module] + HEAVY_MODULES, env=env, cwd=LAMBDAS,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out)
+
+
+@pytest.mark.parametrize("module", HANDLERS)
+def test_handler_cold_init_budget(module):
+    result = cold_init(module)
+    assert result["heavy"] == []
+    assert result["clientsAtImport"] == 0
+    if result["init"] > COLD_INIT_BUDGET:
+        # One retry absorbs a noisy neighbour; a real regression is slow both times.
+        result = cold_init(module)
+    assert result["init"] <= COLD_INIT_BUDGET, f"{module} cold init took {result['init']:.3f}s (import {result['import']:.3f}s)"
@@ -10,7 +10,132 @@ def test_initiate_upload_success(aws_env):
     body = json.loads(resp["body"])
     assert "upload" in body and "imageId" in body
 
+def test_initiate_upload_writes_pointer(aws_env):
+    event = {"body": json.dumps({"userId":"user123","filename":"pic.jpg"})}
+    image_id = json.loads(initiate_handler(event, None)["body"])["imageId"]
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    pointer = table.get_item(Key={"PK": f"image#{image_id}", "SK": f"image#{image_id}"})["Item"]
+    assert pointer["itemPK"] == "user#user123"
+    item = table.get_item(Key={"PK": pointer["itemPK"], "SK": pointer["itemSK"]})["Item"]
+    assert item["imageId"] == image_id and item["status"] == "PENDING"
+
 def test_initiate_upload_bad_request(aws_env):
     event = {"body": json.dumps({"userId":"user123"})}
     resp = initiate_handler(event, None)
     assert resp["statusCode"] == 400
+
+def test_initiate_upload_batch(aws_env):
+    files = [{"filename":"a.jpg","contentType":"image/jpeg"}, {"contentType":"image/png"}] + \
+            [{"filename":f"p{i}.png","contentType":"image/png"} for i in range(30)]
+    resp = initiate_handler({"body": json.dumps({"userId":"user123","files":files})}, None)
+    assert resp["statusCode"] == 200
+    body = json.loads(resp["body"])
+    assert body["errors"] == [{"index": 1, "error": "filename is required"}]
+    assert len(body["uploads"]) == 31
+    assert body["uploads"][0]["upload"]["fields"]["Content-Type"] == "image/jpeg"
+
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    for upload in body["uploads"]:
+        image_id = upload["imageId"]
+        pointer = table.get_item(Key={"PK": f"image#{image_id}", "SK": f"image#{image_id}"})["Item"]
+        item = table.get_item(Key={"PK": pointer["itemPK"], "SK": pointer["itemSK"]})["Item"]
+        assert item["s3Key"].endswith("/" + upload["filename"])
+
+def test_initiate_upload_batch_bad_request(aws_env):
+    for body in ({"userId":"user123","files":[]}, {"files":[{"filename":"a.jpg"}]},
+                 {"userId":"user123","files":[{"filename":"a.jpg"}] * 501}):
+        resp = initiate_handler({"body": json.dumps(body)}, None)
+        assert resp["statusCode"] == 400
+
+def put_stored_image(table, user_id, image_id, content_hash, status="AVAILABLE"):
+    sk = f"createdAt#t#{image_id}"
+    table.put_item(Item={"PK":f"user#{user_id}","SK":sk,"imageId":image_id,"createdAt":"t","status":status,"contentHash":content_hash})
+    table.put_item(Item={"PK":f"image#{image_id}","SK":f"image#{image_id}","itemPK":f"user#{user_id}","itemSK":sk})
+    table.put_item(Item={"PK":f"user#{user_id}","SK":f"hash#{content_hash}","imageId":image_id})
+
+def test_initiate_upload_known_content_hash_skips_upload(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    put_stored_image(table, "user123", "i1", "a" * 64)
+
+    resp = initiate_handler({"body": json.dumps({"userId":"user123","filename":"pic.jpg","contentHash":"A" * 64})}, None)
+    assert resp["statusCode"] == 200
+    assert json.loads(resp["body"]) == {"imageId": "i1", "duplicate": True}
+
+    # Another user's bytes are never matched.
+    resp = initiate_handler({"body": json.dumps({"userId":"other","filename":"pic.jpg","contentHash":"a" * 64})}, None)
+    assert "upload" in json.loads(resp["body"])
+
+def test_initiate_upload_stale_content_hash_uploads(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#user123","SK":f"hash#{'b' * 64}","imageId":"deleted"})
+
+    resp = initiate_handler({"body": json.dumps({"userId":"user123","filename":"pic.jpg","contentHash":"b" * 64})}, None)
+    assert "upload" in json.loads(resp["body"])
+    resp = initiate_handler({"body": json.dumps({"userId":"user123","filename":"pic.jpg","contentHash":"nope"})}, None)
+    assert resp["statusCode"] == 400
+
+def test_initiate_upload_batch_duplicates(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    put_stored_image(table, "user123", "i1", "a" * 64)
+    put_stored_image(table, "user123", "i2", "c" * 64, status="PENDING")
+
+    files = [{"filename":"a.jpg","contentHash":"a" * 64}, {"filename":"c.jpg","contentHash":"c" * 64},
+             {"filename":"d.jpg"}, {"filename":"e.jpg","contentHash":"bad"}]
+    body = json.loads(initiate_handler({"body": json.dumps({"userId":"user123","files":files})}, None)["body"])
+    assert body["duplicates"] == [{"index": 0, "filename": "a.jpg", "imageId": "i1"}]
+    assert [u["index"] for u in body["uploads"]] == [1, 2]
+    assert [e["index"] for e in body["errors"]] == [3]
+
+def test_initiate_upload_enforces_the_image_quota(aws_env, monkeypatch):
+    from stacks.api_stack.lambdas import initiate_upload
+    monkeypatch.setattr(initiate_upload, "MAX_IMAGES_PER_USER", 3)
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#user123","SK":"usage","pendingImages":1,"availableImages":1,"rejectedImages":4})
+
+    files = [{"filename":f"p{i}.png","contentType":"image/png"} for i in range(2)]
+    body = json.loads(initiate_handler({"body": json.dumps({"userId":"user123","files":files})}, None)["body"])
+    assert [u["index"] for u in body["uploads"]] == [0]
+    assert body["errors"] == [{"index": 1, "filename": "p1.png", "error": "upload quota exceeded"}]
+
+    table.put_item(Item={"PK":"user#user123","SK":"usage","pendingImages":2,"availableImages":1})
+    resp = initiate_handler({"body": json.dumps({"userId":"user123","filename":"pic.jpg"})}, None)
+    assert resp["statusCode"] == 403
+    assert initiate_handler({"body": json.dumps({"userId":"other","filename":"pic.jpg"})}, None)["statusCode"] == 200
+
+def test_initiate_upload_enforces_the_bytes_quota(aws_env, monkeypatch):
+    from stacks.api_stack.lambdas import initiate_upload
+    monkeypatch.setattr(initiate_upload, "MAX_BYTES_PER_USER", 1000)
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK":"user#user123","SK":"usage","availableImages":1,"totalBytes":1000})
+
+    resp = initiate_handler({"body": json.dumps({"userId":"user123","filename":"a.jpg","multipart":True,"size":10**7})}, None)
+    assert resp["statusCode"] == 403
+
+def test_initiate_upload_quota_counts_only_files_that_get_an_upload(aws_env, monkeypatch):
+    from stacks.api_stack.lambdas import initiate_upload
+    monkeypatch.setattr(initiate_upload, "MAX_IMAGES_PER_USER", 2)
+    files = [{"filename":"a.png","maxSize":"big"}, {"filename":"b.png"}, {"filename":"c.png"}, {"filename":"d.png"}]
+    body = json.loads(initiate_handler({"body": json.dumps({"userId":"user123","files":files})}, None)["body"])
+    assert [u["index"] for u in body["uploads"]] == [1, 2]
+    assert [(e["index"], e["error"]) for e in body["errors"]] == [(0, "maxSize must be an integer"),
+                                                                  (3, "upload quota exceeded")]
+
+def test_initiate_upload_batch_discards_half_written_pairs(aws_env, monkeypatch):
+    from stacks.api_stack.lambdas import initiate_upload
+    write = initiate_upload.batch_write
+
+    def pointer_of_first_file_unprocessed(table, requests):
+        if "DeleteRequest" in requests[0]:
+            return write(table, requests)
+        write(table, requests[:1] + requests[2:])
+        return requests[1:2]
+
+    monkeypatch.setattr(initiate_upload, "batch_write", pointer_of_first_file_unprocessed)
+    files = [{"filename":"a.png"}, {"filename":"b.png"}]
+    body = json.loads(initiate_handler({"body": json.dumps({"userId":"user123","files":files})}, None)["body"])
+    assert body["errors"] == [{"index": 0, "filename": "a.png", "error": "failed to persist metadata"}]
+
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    items = table.scan()["Items"]
+    assert {i.get("imageId") or i["PK"].split("#", 1)[1] for i in items} == {body["uploads"][0]["imageId"]}
+    assert len(items) == 2
@@ -0,0 +1,76 @@
+import json
+from types import SimpleNamespace
+import instrumentation
+from instrumentation import instrumented, log, metric, timer
+from stacks.api_stack.lambdas.list_images import handler as list_handler
+
+
+def records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_log_writes_one_json_line(capsys):
+    log("s3_get_error", level="ERROR", key="users/u1/i1/pic.jpg", error=ValueError("boom"))
+    assert records(capsys) == [{"level": "ERROR", "event": "s3_get_error", "key": "users/u1/i1/pic.jpg", "error": "boom"}]
+
+
+def test_instrumented_handler_writes_an_emf_record(capsys):
+    @instrumented
+    def handler(event, context):
+        log("working", imageId="i1")
+        with timer("dynamodb_lookup"):
+            pass
+        metric("items", 3)
+        metric("items", 4)
+        return {"statusCode": 200, "body": json.dumps({"ok": True})}
+
+    instrumentation._cold_start = True
+    context = SimpleNamespace(aws_request_id="req-1")
+    handler({"body": "abcd"}, context)
+    handler({"body": "abcd"}, context)
+    first_log, first, _, second = records(capsys)
+
+    assert first_log == {"level": "INFO", "event": "working", "handler": "test_instrumentation.handler",
+                         "requestId": "req-1", "imageId": "i1"}
+    directive = first["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == instrumentation.NAMESPACE
+    assert directive["Dimensions"] == [["Handler"]]
+    assert {m["Name"]: m["Unit"] for m in directive["Metrics"]} == {
+        "cold_start": "Count", "request_bytes": "Bytes", "dynamodb_lookup": "Milliseconds", "items": "Count",
+        "duration": "Milliseconds", "response_bytes": "Bytes"}
+    assert first["Handler"] == "test_instrumentation.handler"
+    assert first["requestId"] == "req-1"
+    assert (first["cold_start"], second["cold_start"]) == (1, 0)
+    assert first["request_bytes"] == 4
+    assert first["response_bytes"] == len('{"ok": true}')
+    assert first["items"] == [3, 4]
+    assert first["duration"] >= first["dynamodb_lookup"] >= 0
+
+
+def test_metrics_outside_an_invocation_are_ignored(capsys):
+    with timer("presign"):
+        metric("items", 1)
+    assert capsys.readouterr().out == ""
+
+
+def test_handler_stages_are_reported(aws_env, capsys):
+    resp = list_handler({"queryStringParameters": {"userId": "u1"}}, SimpleNamespace(aws_request_id="req-2"))
+    assert resp["statusCode"] == 200
+    record = records(capsys)[-1]
+    assert record["Handler"] == "list_images.handler"
+    assert record["items"] == 0
+    assert {"dynamodb_query", "duration"} <= {m["Name"] for m in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+
+
+def test_overlapping_invocations_each_write_a_record(capsys):
+    @instrumented
+    def inner(event, context):
+        return {"statusCode": 200, "body": "{}"}
+
+    @instrumented
+    def outer(event, context):
+        inner({}, SimpleNamespace(aws_request_id="req-inner"))
+        return {"statusCode": 200, "body": "{}"}
+
+    outer({}, SimpleNamespace(aws_request_id="req-outer"))
+    assert [r["requestId"] for r in records(capsys)] == ["req-inner", "req-outer"]
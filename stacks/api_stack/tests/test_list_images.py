@@ -0,0 +1,96 @@
+import json
+import boto3
+from unittest import mock
+from stacks.api_stack.lambdas import list_images
+from stacks.api_stack.lambdas.list_images import handler as list_handler
+
+
+def put_images(count, pending_every=5):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    for i in range(count):
+        status = "PENDING" if i % pending_every == 0 else "AVAILABLE"
+        table.put_item(Item={"PK":"user#u1","SK":f"createdAt#2025-01-01T00:00:{i:02d}+00:00#img{i}",
+                             "imageId":f"img{i}","userId":"u1","status":status,"userStatus":f"user#u1#{status}",
+                             "s3Key":f"users/u1/img{i}/pic.jpg","size":1024})
+
+
+def test_list_images_requires_user(aws_env):
+    resp = list_handler({"queryStringParameters": {}}, None)
+    assert resp["statusCode"] == 400
+
+def test_list_images_status_filter_fills_page(aws_env):
+    put_images(30)
+    resp = list_handler({"queryStringParameters": {"userId":"u1","status":"PENDING","limit":"4"}}, None)
+    assert resp["statusCode"] == 200
+    body = json.loads(resp["body"])
+    assert [i["imageId"] for i in body["items"]] == ["img0", "img5", "img10", "img15"]
+    assert "lastKey" in body
+
+    resp = list_handler({"queryStringParameters": {"userId":"u1","status":"PENDING","limit":"4",
+                                                   "lastKey": json.dumps(body["lastKey"])}}, None)
+    body = json.loads(resp["body"])
+    assert [i["imageId"] for i in body["items"]] == ["img20", "img25"]
+    assert "lastKey" not in body
+
+def test_list_images_projection(aws_env):
+    put_images(3)
+    resp = list_handler({"queryStringParameters": {"userId":"u1","fields":"imageId,status,size"}}, None)
+    body = json.loads(resp["body"])
+    assert body["items"][0] == {"imageId":"img0","status":"PENDING","size":1024}
+
+def test_list_images_invalid_fields(aws_env):
+    resp = list_handler({"queryStringParameters": {"userId":"u1","fields":"imageId,#bad"}}, None)
+    assert resp["statusCode"] == 400
+
+def test_list_images_time_window_newest_first(aws_env):
+    put_images(30)
+    resp = list_handler({"queryStringParameters": {"userId":"u1","from":"2025-01-01T00:00:10Z",
+                                                   "to":"2025-01-01T00:00:14+00:00","order":"desc"}}, None)
+    body = json.loads(resp["body"])
+    assert [i["imageId"] for i in body["items"]] == ["img14", "img13", "img12", "img11", "img10"]
+
+def test_list_images_time_window_with_status(aws_env):
+    put_images(30)
+    resp = list_handler({"queryStringParameters": {"userId":"u1","status":"PENDING","from":"2025-01-01T00:00:05",
+                                                   "order":"desc"}}, None)
+    body = json.loads(resp["body"])
+    assert [i["imageId"] for i in body["items"]] == ["img25", "img20", "img15", "img10", "img5"]
+
+def test_list_images_invalid_window(aws_env):
+    for params in ({"from":"yesterday"}, {"from":"2025-01-02T00:00:00","to":"2025-01-01T00:00:00"}, {"order":"up"}):
+        resp = list_handler({"queryStringParameters": {"userId":"u1", **params}}, None)
+        assert resp["statusCode"] == 400
+
+def test_list_images_include_urls(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    put_images(2)
+    table.update_item(Key={"PK":"user#u1","SK":"createdAt#2025-01-01T00:00:01+00:00#img1"},
+                      UpdateExpression="SET thumbnailKey = :t", ExpressionAttributeValues={":t":"thumbnails/u1/img1/thumbnail.jpg"})
+
+    resp = list_handler({"queryStringParameters": {"userId":"u1","includeUrls":"true","fields":"imageId"}}, None)
+    items = json.loads(resp["body"])["items"]
+    assert "thumbnailUrl" not in items[0]
+    assert "/thumbnails/u1/img1/thumbnail.jpg?" in items[1]["thumbnailUrl"]
+    assert "downloadUrl" not in items[1]
+
+    resp = list_handler({"queryStringParameters": {"userId":"u1","includeUrls":"all"}}, None)
+    items = json.loads(resp["body"])["items"]
+    assert "/users/u1/img0/pic.jpg?" in items[0]["downloadUrl"]
+    assert "X-Amz-Signature=" in items[1]["thumbnailUrl"]
+
+def test_list_images_invalid_include_urls(aws_env):
+    resp = list_handler({"queryStringParameters": {"userId":"u1","includeUrls":"original"}}, None)
+    assert resp["statusCode"] == 400
+
+def test_list_images_limit_is_clamped(aws_env):
+    put_images(5)
+    with mock.patch.object(list_images, "MAX_LIMIT", 3):
+        resp = list_handler({"queryStringParameters": {"userId":"u1","limit":"1000000"}}, None)
+    body = json.loads(resp["body"])
+    assert [i["imageId"] for i in body["items"]] == ["img0", "img1", "img2"]
+    assert "lastKey" in body
+
+def test_list_images_invalid_limit(aws_env):
+    for limit in ("abc", "0", "-5", "1.5"):
+        resp = list_handler({"queryStringParameters": {"userId":"u1","limit":limit}}, None)
+        assert resp["statusCode"] == 400
@@ -0,0 +1,100 @@
+import json
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+import aws_clients
+import throttling
+from instrumentation import instrumented
+from conftest import TABLE_NAME
+
+
+class Raw:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def throttle_first(client, times):
+    """Answer the first `times` requests of the client with a DynamoDB throttle."""
+    sent = []
+
+    def respond(request, **kwargs):
+        sent.append(request)
+        if len(sent) <= times:
+            body = json.dumps({"__type": "com.amazonaws.dynamodb.v20120810#ProvisionedThroughputExceededException",
+                               "message": "Rate exceeded"}).encode()
+            return AWSResponse(request.url, 400, {"Content-Type": "application/x-amz-json-1.0"}, Raw(body))
+
+    client.meta.events.register_first("before-send.dynamodb", respond)
+    return sent
+
+
+def test_bucket_is_open_until_throttled_then_paces_at_half_the_sending_rate():
+    now = [0.0]
+    bucket = throttling.TokenBucket(min_rate=2, clock=lambda: now[0])
+    now[0] = 0.5
+    assert [bucket.reserve() for _ in range(20)] == [0.0] * 20
+
+    bucket.throttled()
+    assert bucket.rate == 20
+    assert bucket.reserve() == pytest.approx(0.05)
+    assert bucket.reserve() == pytest.approx(0.1)
+    bucket.succeeded()
+    assert bucket.rate == pytest.approx(20.05)
+
+    bucket.throttled()
+    assert bucket.rate == pytest.approx(10.025)
+    for _ in range(5):
+        bucket.throttled()
+    assert bucket.rate == 2
+
+
+def test_backoff_is_full_jitter_capped_and_within_the_deadline():
+    with mock.patch("throttling.random.uniform", side_effect=lambda low, high: high):
+        assert throttling.backoff(1, "interactive") == pytest.approx(0.05)
+        assert throttling.backoff(10, "interactive") == 0.5
+        assert throttling.backoff(10, "background") == 5.0
+
+        throttling.set_deadline(SimpleNamespace(get_remaining_time_in_millis=lambda: 600))
+        assert throttling.backoff(1, "interactive") == pytest.approx(0.05)
+        assert throttling.backoff(10, "interactive") is None
+        assert throttling.unprocessed("dynamodb", 1, 5) is not None
+        assert throttling.unprocessed("dynamodb", 5, 5) is None
+    assert throttling.counters()["throttles_absorbed"] == 1
+    assert throttling.counters()["throttles_surfaced"] == 1
+
+
+def test_throttled_calls_are_retried_and_slow_the_service_down(aws_env):
+    aws_clients.reset()
+    client = aws_clients.client("dynamodb")
+    sent = throttle_first(client, 2)
+
+    client.get_item(TableName=TABLE_NAME, Key={"PK": "user#u1", "SK": "s"})
+    assert len(sent) == 3
+    assert throttling.counters()["throttles_absorbed"] == 2
+    assert throttling.limiter("dynamodb").enabled
+    assert not throttling.limiter("s3").enabled
+
+
+def test_throttles_past_the_attempts_are_surfaced_and_reported(aws_env, capsys):
+    aws_clients.reset()
+    client = aws_clients.client("dynamodb")
+    sent = throttle_first(client, 100)
+
+    @instrumented
+    def handler(event, context):
+        try:
+            client.get_item(TableName=TABLE_NAME, Key={"PK": "user#u1", "SK": "s"})
+        except ClientError as e:
+            return {"statusCode": 503, "body": json.dumps({"error": e.response["Error"]["Code"]})}
+
+    resp = handler({}, SimpleNamespace(aws_request_id="req-1", get_remaining_time_in_millis=lambda: 30000))
+    assert resp["statusCode"] == 503
+    assert len(sent) == aws_clients.PROFILES["interactive"]["max_attempts"] + 1
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert record["throttles_absorbed"] == aws_clients.PROFILES["interactive"]["max_attempts"]
+    assert record["throttles_surfaced"] == 1
@@ -0,0 +1,58 @@
+from datetime import datetime, timezone
+from unittest import mock
+from urllib.parse import parse_qs, quote, urlsplit
+from botocore.auth import S3SigV4QueryAuth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from stacks.api_stack.lambdas.utils import UrlSigner, TtlLruCache, batch_write
+
+
+def test_url_signer_matches_botocore():
+    credentials = Credentials("AKIDEXAMPLE", "secret/key+x", "session/token+=")
+    now = datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    signer = UrlSigner("images-bucket", 300, credentials=credentials.get_frozen_credentials(),
+                       region="eu-west-1", now=now)
+
+    for key in ("users/u1/i1/pic.jpg", "users/u 1/i2/pïc+(1).jpg"):
+        url = signer.presign(key)
+        request = AWSRequest(method="GET", url=f"https://images-bucket.s3.eu-west-1.amazonaws.com/{quote(key, safe='/~')}")
+        with mock.patch("botocore.auth.get_current_datetime", return_value=now.replace(tzinfo=None)):
+            S3SigV4QueryAuth(credentials, "s3", "eu-west-1", expires=300).add_auth(request)
+
+        assert urlsplit(url).path == urlsplit(request.url).path
+        assert parse_qs(urlsplit(url).query) == parse_qs(urlsplit(request.url).query)
+
+
+def test_ttl_lru_cache_expiry_and_eviction():
+    now = [0.0]
+    cache = TtlLruCache(2, clock=lambda: now[0])
+    cache.set("a", 1, ttl=10)
+    cache.set("b", None, ttl=1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+
+    now[0] = 2
+    assert cache.get("b") is TtlLruCache.MISSING
+
+    cache.set("c", 3, ttl=10)
+    cache.set("d", 4, ttl=10)
+    assert cache.get("a") is TtlLruCache.MISSING
+    assert cache.stats() == {"size": 2, "hits": 1, "negativeHits": 1, "misses": 2, "evictions": 1}
+
+
+def test_batch_write_retries_unprocessed_items():
+    requests = [{"PutRequest": {"Item": {"PK": f"p{i}", "SK": "s"}}} for i in range(30)]
+    table = mock.Mock()
+    table.name = "ImagesTable"
+    table.meta.client.batch_write_item.side_effect = [
+        {"UnprocessedItems": {"ImagesTable": requests[:2]}},
+        {"UnprocessedItems": {}},
+        {"UnprocessedItems": {"ImagesTable": requests[25:]}},
+        {"UnprocessedItems": {"ImagesTable": requests[25:]}},
+    ]
+    with mock.patch("stacks.api_stack.lambdas.utils.time.sleep"):
+        failed = batch_write(table, requests, max_attempts=2)
+
+    assert failed == requests[25:]
+    sent = [call.kwargs["RequestItems"]["ImagesTable"] for call in table.meta.client.batch_write_item.call_args_list]
+    assert [len(batch) for batch in sent] == [25, 2, 5, 5]
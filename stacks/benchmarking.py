@@ -0,0 +1,137 @@
+"""
+Per-call latency and allocation benchmarks of the lambda handlers, run on the moto fixtures of the tests.
+
+Benchmarks are tests using the benchmark fixture (stacks/conftest.py) and are skipped unless BENCHMARK is set:
+  BENCHMARK=run      measure and write the results to BENCHMARK_RESULTS (default benchmark-results.json)
+  BENCHMARK=record   measure and merge the results into the baseline (BENCHMARK_BASELINE)
+  BENCHMARK=compare  measure and fail every benchmark slower or allocating more than the baseline allows
+
+Timings against moto measure our code plus the emulated service calls, so baselines only compare with runs
+on the same machine; record one before a performance change and compare after it. Allocations are what
+tracemalloc sees (Python objects and buffers such as object bodies), not Pillow's pixel memory.
+"""
+import io
+import os
+import json
+import time
+import platform
+import tracemalloc
+
+MODE = os.environ.get("BENCHMARK", "").lower()
+MODES = ("run", "record", "compare")
+BASELINE = os.environ.get("BENCHMARK_BASELINE", os.path.join(os.path.dirname(__file__), "benchmark_baseline.json"))
+RESULTS = os.environ.get("BENCHMARK_RESULTS", "benchmark-results.json")
+# A benchmark regresses when its median time or allocation peak grows by more than TOLERANCE (relative)
+# and by more than the absolute floor, so sub-millisecond jitter is not reported.
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", "0.25"))
+MIN_DELTA_MS = 0.5
+MIN_DELTA_KIB = 64
+
+
+def synthetic_image(size, fmt, **options):
+    """
+    An encoded image of smooth gradients with sensor-like noise, so encoders and decoders do realistic work.
+    """
+    from PIL import Image
+    base = Image.merge("RGB", [Image.linear_gradient("L").resize(size),
+                               Image.radial_gradient("L").resize(size),
+                               Image.linear_gradient("L").rotate(90).resize(size)])
+    noise = Image.effect_noise(size, 24).convert("RGB")
+    buf = io.BytesIO()
+    Image.blend(base, noise, 0.15).save(buf, format=fmt, **options)
+    return buf.getvalue()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+def measure(fn, setup=None, rounds=20, warmup=1):
+    """
+    Call fn(*setup()) warmup + rounds times (setup is not timed), then once more under tracemalloc.
+    Returns the latency distribution in milliseconds and the allocation peak / retained size of one call in KiB.
+    """
+    def call():
+        args = setup() if setup else None
+        start = time.perf_counter()
+        fn(*(args or ()))
+        return (time.perf_counter() - start) * 1000
+
+    for _ in range(warmup):
+        call()
+    times = [call() for _ in range(rounds)]
+
+    args = setup() if setup else None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        fn(*(args or ()))
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "rounds": rounds,
+        "median_ms": round(percentile(times, 50), 3),
+        "p95_ms": round(percentile(times, 95), 3),
+        "min_ms": round(min(times), 3),
+        "mean_ms": round(sum(times) / len(times), 3),
+        "peak_kib": round((peak - before) / 1024, 1),
+        "retained_kib": round((current - before) / 1024, 1),
+    }
+
+
+def regressions(result, baseline):
+    """Human-readable regressions of one result against its baseline entry (empty when within tolerance)."""
+    found = []
+    for field, floor, unit in (("median_ms", MIN_DELTA_MS, "ms"), ("peak_kib", MIN_DELTA_KIB, "KiB")):
+        new, old = result[field], baseline.get(field)
+        if old is not None and new > old * (1 + TOLERANCE) and new - old > floor:
+            found.append(f"{field} {old}{unit} -> {new}{unit} (+{(new - old) / old:.0%})" if old else
+                         f"{field} {old}{unit} -> {new}{unit}")
+    return found
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get("benchmarks", {})
+    except FileNotFoundError:
+        return {}
+
+
+def write(path, benchmarks):
+    with open(path, "w") as f:
+        json.dump({"python": platform.python_version(), "machine": platform.machine(), "benchmarks": benchmarks},
+                  f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+class Runner:
+    """The benchmark fixture: runner(name, fn, setup=None, rounds=20) measures and checks one benchmark."""
+
+    def __init__(self, mode, baseline, results):
+        self.mode = mode
+        self.baseline = baseline
+        self.results = results
+
+    def __call__(self, name, fn, setup=None, rounds=20, warmup=1):
+        result = measure(fn, setup, rounds, warmup)
+        self.results[name] = result
+        if self.mode == "compare":
+            if name not in self.baseline:
+                raise AssertionError(f"{name}: no baseline entry in {BASELINE} (record one with BENCHMARK=record)")
+            found = regressions(result, self.baseline[name])
+            assert not found, f"{name} regressed: " + "; ".join(found)
+        return result
+
+
+def finish(mode, results):
+    """Write the session's results: merged into the baseline when recording, to RESULTS otherwise."""
+    if not results:
+        return
+    if mode == "record":
+        write(BASELINE, {**load(BASELINE), **results})
+    else:
+        write(RESULTS, results)
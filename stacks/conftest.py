@@ -0,0 +1,21 @@
+import os
+import pytest
+from stacks import benchmarking
+
+# Newer botocore sends PutObject bodies aws-chunked with a CRC checksum, which moto 4 stores verbatim past
+# the first MiB, corrupting larger originals. Only compute checksums where an operation requires them.
+os.environ.setdefault("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+
+_results = {}
+
+
+@pytest.fixture
+def benchmark():
+    """Handler benchmarks (see stacks/benchmarking.py); skipped unless BENCHMARK=run|record|compare."""
+    if benchmarking.MODE not in benchmarking.MODES:
+        pytest.skip("benchmarks run with BENCHMARK=run|record|compare")
+    return benchmarking.Runner(benchmarking.MODE, benchmarking.load(benchmarking.BASELINE), _results)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    benchmarking.finish(benchmarking.MODE, _results)
@@ -1,4 +1,21 @@
 IMAGES_DYNAMODB_TABLE_NAME="images-table"
 IMAGES_S3_BUCKET_NAME= "monty-cloud-images-bucket"
 IMAGE_SERVICE_QUEUE_NAME="image-service-queue"
-IMAGE_SERVICE_DLQ_QUEUE_NAME="image-service-dlq-queue"
\ No newline at end of file
+IMAGE_SERVICE_DLQ_QUEUE_NAME="image-service-dlq-queue"
+IMAGE_SERVICE_FAST_QUEUE_NAME="image-service-fast-queue"
+IMAGE_SERVICE_FAST_DLQ_QUEUE_NAME="image-service-fast-dlq-queue"
+USAGE_AGGREGATOR_DLQ_QUEUE_NAME="usage-aggregator-dlq-queue"
+# Per-user upload quotas enforced by initiate_upload (0: no quota).
+MAX_IMAGES_PER_USER=0
+MAX_BYTES_PER_USER=0
+# Originals up to this size are processed on the low-latency lane.
+FAST_LANE_MAX_BYTES=1024*1024
+# Processing lanes: queue settings (timeouts in seconds) and the image processor function consuming each queue.
+# Heavy lane: high-throughput batching for big originals.
+# Fast lane: no batching window so small images become AVAILABLE right away.
+PROCESSING_LANES = {
+    "heavy": {"function_name": "image_processor_lambda", "timeout": 300, "memory_size": 1536, "max_workers": 8,
+              "batch_size": 10, "max_batching_window": 30, "max_concurrency": 10, "max_receive_count": 5},
+    "fast": {"function_name": "image_processor_fast_lambda", "timeout": 60, "memory_size": 512, "max_workers": 4,
+             "batch_size": 4, "max_batching_window": None, "max_concurrency": 50, "max_receive_count": 5},
+}
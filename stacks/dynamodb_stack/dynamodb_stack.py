@@ -23,6 +23,8 @@ class DynamoDBStack(Stack):
         encryption=dynamodb.TableEncryption.AWS_MANAGED,
         point_in_time_recovery=True,
         removal_policy=RemovalPolicy.RETAIN,
+        # Feeds the usage aggregator (s3_stack), which keeps the per-user aggregate items.
+        stream=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES,
         )
 
 
@@ -32,4 +34,12 @@ class DynamoDBStack(Stack):
         sort_key=dynamodb.Attribute(name="createdAt", type=dynamodb.AttributeType.STRING),
         projection_type=dynamodb.ProjectionType.ALL,
         )
+
+        # Sparse index: only image metadata items carry userStatus (user#<userId>#<status>).
+        table.add_global_secondary_index(
+        index_name="userStatus-index",
+        partition_key=dynamodb.Attribute(name="userStatus", type=dynamodb.AttributeType.STRING),
+        sort_key=dynamodb.Attribute(name="SK", type=dynamodb.AttributeType.STRING),
+        projection_type=dynamodb.ProjectionType.ALL,
+        )
         return table
\ No newline at end of file
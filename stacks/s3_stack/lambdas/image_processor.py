@@ -1,45 +1,427 @@
-import os, json, boto3
+import os, json
+import time, uuid, hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
 from PIL import Image
 import io
-from boto3.dynamodb.conditions import Key
+import aws_clients
+from image_items import get_image_item
+from instrumentation import instrumented, log, timer
 
 IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
 IMAGES_BUCKET = os.environ.get("IMAGES_BUCKET")
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "8"))
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "8"))
+# How long a worker owns an image it is processing; at least the function timeout.
+PROCESSING_LEASE_SECONDS = int(os.environ.get("PROCESSING_LEASE_SECONDS", "300"))
 
-S3 = boto3.client("s3")
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(IMAGES_TABLE)
+# Record workers and rendition uploads use S3 at the same time.
+S3 = aws_clients.lazy_client("s3", "transfer", pool_size=MAX_WORKERS + UPLOAD_WORKERS)
 
-THUMBNAIL_SIZE = (400,400)
 THUMBNAIL_PREFIX = "thumbnails/"
+THUMBNAIL_SIZE = (400, 400)
+# Decode JPEGs at the smallest DCT scale that still leaves this factor of headroom over the target.
+DRAFT_REDUCING_GAP = 2
+SMALL_JPEG_MAX_BYTES = 100 * 1024
 
-dynamodb = boto3.resource("dynamodb")
-s3 = boto3.client('s3')
-IMAGES_TABLE = os.environ["IMAGES_TABLE"]
-BUCKET = os.environ['IMAGES_BUCKET']
+# Renditions generated for every upload. Override with a JSON list in THUMBNAIL_RENDITIONS.
+# Other sizes and formats are generated on first access by GET /images/{imageId}/thumbnail, from the preview.
+DEFAULT_RENDITIONS = [
+    {"name": "preview", "size": [1024, 1024], "format": "JPEG", "quality": 82},
+    {"name": "thumbnail", "size": [400, 400], "format": "JPEG", "quality": 80},
+]
+RENDITIONS = json.loads(os.environ["THUMBNAIL_RENDITIONS"]) if os.environ.get("THUMBNAIL_RENDITIONS") else DEFAULT_RENDITIONS
+# Rendition exposed as the item's thumbnailKey.
+THUMBNAIL_RENDITION = os.environ.get("THUMBNAIL_RENDITION", "thumbnail")
+FORMAT_INFO = {"JPEG": ("jpg", "image/jpeg"), "WEBP": ("webp", "image/webp"), "PNG": ("png", "image/png")}
+READ_CHUNK_SIZE = 1024*1024
+
+# Memory bounds (the function has 512 MB). Originals are spooled to /tmp above SPOOL_MEMORY_BYTES.
+# Headers claiming more than MAX_IMAGE_PIXELS are rejected without decoding; after reduced-scale
+# decoding (JPEG draft) an image may still need at most MAX_DECODE_PIXELS, and all worker threads
+# together decode at most DECODE_BUDGET_PIXELS at a time.
+SPOOL_MEMORY_BYTES = int(os.environ.get("SPOOL_MEMORY_BYTES", str(8*1024*1024)))
+TMP_DIR = os.environ.get("TMP_DIR", tempfile.gettempdir())
+MAX_SOURCE_BYTES = int(os.environ.get("MAX_SOURCE_BYTES", str(1024**3)))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", "200000000"))
+DECODE_BUDGET_PIXELS = int(os.environ.get("DECODE_BUDGET_PIXELS", "60000000"))
+MAX_DECODE_PIXELS = min(int(os.environ.get("MAX_DECODE_PIXELS", "40000000")), DECODE_BUDGET_PIXELS)
+# Pillow's own decompression bomb check, aligned with the header limit.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# The first bytes of the original are fetched with a ranged GET to sniff the format and dimensions
+# before paying for the full transfer.
+SNIFF_BYTES = int(os.environ.get("SNIFF_BYTES", str(64*1024)))
+MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", "JPEG"), (b"\x89PNG\r\n\x1a\n", "PNG"), (b"GIF87a", "GIF"), (b"GIF89a", "GIF"),
+    (b"II*\x00", "TIFF"), (b"MM\x00*", "TIFF"), (b"BM", "BMP"), (b"%PDF", "PDF"),
+]
+SUPPORTED_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp",
+                     "TIFF": "image/tiff", "BMP": "image/bmp"}
+
+# Shared across invocations of a warm container; rendition uploads of all records go through it.
+upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+
+def get_table():
+    """Table on the DynamoDB client shared by all worker threads."""
+    return aws_clients.dynamodb_table(IMAGES_TABLE, "background", pool_size=MAX_WORKERS)
+
+
+class LeaseHeldError(Exception):
+    """Another worker is processing the image; the message is retried after the lease runs out."""
+
+
+def acquire_lease(table, item):
+    """
+    Claim the image before any S3 I/O: a conditional update that only succeeds while the item is PENDING
+    and no other worker holds an unexpired lease. Returns the lease id.
+    """
+    lease_id = str(uuid.uuid4())
+    now = int(time.time())
+    try:
+        table.update_item(Key={"PK": item["PK"], "SK": item["SK"]},
+                          UpdateExpression="SET leaseId = :l, leaseExpiresAt = :exp",
+                          ConditionExpression="#s = :pending AND (attribute_not_exists(leaseExpiresAt) OR leaseExpiresAt < :now)",
+                          ExpressionAttributeNames={"#s":"status"},
+                          ExpressionAttributeValues={":l":lease_id, ":exp":now + PROCESSING_LEASE_SECONDS, ":now":now, ":pending":"PENDING"})
+    except ClientError as e:
+        if e.response.get("Error",{}).get("Code") == "ConditionalCheckFailedException":
+            raise LeaseHeldError(item.get("imageId"))
+        raise
+    return lease_id
+
+
+def release_lease(table, item, lease_id):
+    """
+    Give the image back after a failed attempt so the retry does not wait for the lease to expire.
+    """
+    try:
+        table.update_item(Key={"PK": item["PK"], "SK": item["SK"]},
+                          UpdateExpression="REMOVE leaseId, leaseExpiresAt",
+                          ConditionExpression="leaseId = :l",
+                          ExpressionAttributeValues={":l":lease_id})
+    except ClientError as e:
+        log("lease_release_error", level="ERROR", imageId=item.get("imageId"), error=e)
+
+
+class ImageRejectedError(Exception):
+    """The original cannot be processed within the memory bounds (or is not an image we can decode safely)."""
+
+
+class DecodeBudget:
+    """
+    Pixels decoded concurrently across worker threads. reserve() blocks until the image fits.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.available = capacity
+        self._cond = threading.Condition()
+
+    def reserve(self, pixels):
+        pixels = min(pixels, self.capacity)
+        with self._cond:
+            self._cond.wait_for(lambda: self.available >= pixels)
+            self.available -= pixels
+        return _Reservation(self, pixels)
+
+    def release(self, pixels):
+        with self._cond:
+            self.available += pixels
+            self._cond.notify_all()
+
+
+class _Reservation:
+    def __init__(self, budget, pixels):
+        self.budget, self.pixels = budget, pixels
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.budget.release(self.pixels)
+
+
+decode_budget = DecodeBudget(DECODE_BUDGET_PIXELS)
 
-THUMBNAIL_SIZE = (400, 400)
 
 def generate_thumbnail_bytes(image_bytes):
     """
-    Generate cpmpressed imgage"
+    Generate compressed thumbnail image (the JPEG thumbnail rendition only).
+    """
+    rendition = {"name": THUMBNAIL_RENDITION, "size": THUMBNAIL_SIZE, "format": "JPEG", "quality": 80}
+    return generate_renditions(image_bytes, [rendition])[THUMBNAIL_RENDITION][0]
+
+
+def encode_rendition(im, fmt, quality):
+    if fmt == "JPEG" and im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    elif fmt == "WEBP" and im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA")
+    buf = io.BytesIO()
+    with timer("encode"):
+        im.save(buf, format=fmt, quality=quality)
+    return buf.getvalue()
+
+
+def fit(im, box):
+    """
+    Downscaled copy of im fitting box with its aspect ratio kept (the resampling of Image.thumbnail), or im itself
+    when it already fits. The image it is made from is left untouched.
+    """
+    if im.width <= box[0] and im.height <= box[1]:
+        return im
+    scale = min(box[0] / im.width, box[1] / im.height)
+    size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+    return im.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+
+def generate_renditions(source, renditions=None, source_format=None):
+    """
+    Generate all renditions from one decode. source is the original as bytes or a seekable file (spooled body),
+    source_format the format already sniffed from its header (only that decoder is tried).
+    Dimensions are checked from the header before anything is decoded (ImageRejectedError above MAX_IMAGE_PIXELS).
+    JPEGs are decoded at reduced scale (draft) for the largest rendition so the full resolution is never decompressed;
+    what remains to decode must fit MAX_DECODE_PIXELS and is reserved on the shared decode budget.
+    Renditions are produced as a cascade, largest first, each one downscaled from the previous rendition when
+    that rendition's box holds the next one in both dimensions, otherwise from the decoded source.
+    A small JPEG that already fits a JPEG rendition box is used as is without re-encoding.
+    Returns {name: (bytes, format)}.
+    """
+    renditions = sorted(renditions or RENDITIONS, key=lambda r: r["size"][0] * r["size"][1], reverse=True)
+    largest = renditions[0]["size"]
+    result = {}
+
+    fp = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    fp.seek(0, io.SEEK_END)
+    source_bytes = fp.tell()
+    fp.seek(0)
+
+    try:
+        im = Image.open(fp, formats=[source_format] if source_format else None)
+    except Image.DecompressionBombError as e:
+        raise ImageRejectedError(str(e))
+
+    with im:
+        source_size = im.size
+        if source_size[0] * source_size[1] > MAX_IMAGE_PIXELS:
+            raise ImageRejectedError(f"{source_size[0]}x{source_size[1]} exceeds {MAX_IMAGE_PIXELS} pixels")
+        passthrough = im.format == "JPEG" and source_bytes <= SMALL_JPEG_MAX_BYTES
+
+        im.draft("RGB", (largest[0] * DRAFT_REDUCING_GAP, largest[1] * DRAFT_REDUCING_GAP))
+        decode_pixels = im.width * im.height
+        if decode_pixels > MAX_DECODE_PIXELS:
+            raise ImageRejectedError(f"{source_size[0]}x{source_size[1]} {im.format} needs {decode_pixels} decoded pixels, "
+                                     f"over the {MAX_DECODE_PIXELS} limit")
+
+        with decode_budget.reserve(decode_pixels):
+            with timer("decode"):
+                im.load()
+            current, current_box = im, None
+            for rendition in renditions:
+                width, height = rendition["size"]
+                fmt = rendition["format"].upper()
+                if passthrough and fmt == "JPEG" and source_size[0] <= width and source_size[1] <= height:
+                    fp.seek(0)
+                    result[rendition["name"]] = (source if isinstance(source, bytes) else fp.read(), fmt)
+                    continue
+
+                if current_box and (width > current_box[0] or height > current_box[1]):
+                    current = im
+                current, current_box = fit(current, (width, height)), (width, height)
+                result[rendition["name"]] = (encode_rendition(current, fmt, rendition.get("quality", 80)), fmt)
+
+    return result
+
+
+def rendition_key(user_id, image_id, name, fmt):
+    return f"{THUMBNAIL_PREFIX}{user_id}/{image_id}/{name}.{FORMAT_INFO[fmt][0]}"
+
+
+def upload_renditions(bucket, user_id, image_id, renditions):
+    """
+    Upload renditions in parallel. Returns {name: key} of the renditions stored.
+    """
+    futures = {}
+    for name, (data, fmt) in renditions.items():
+        key = rendition_key(user_id, image_id, name, fmt)
+        future = upload_pool.submit(S3.put_object, Bucket=bucket, Key=key, Body=data,
+                                    ContentType=FORMAT_INFO[fmt][1], ACL="private")
+        futures[future] = (name, key)
+
+    keys = {}
+    for future, (name, key) in futures.items():
+        try:
+            future.result()
+            keys[name] = key
+        except Exception as e:
+            log("rendition_upload_error", level="ERROR", key=key, error=e)
+    return keys
+
+
+def spool_and_hash(body, head=b""):
     """
-    with Image.open(io.BytesIO(image_bytes)) as im:
-        im.thumbnail(THUMBNAIL_SIZE)
-        buf = io.BytesIO()
-        im.save(buf, format="JPEG", quality=80)
-        buf.seek(0)
-        return buf.read()
-    
-    
+    Stream head followed by a body (None when head is the whole object) into a temporary file
+    (kept in memory up to SPOOL_MEMORY_BYTES, then on /tmp), hashing as it goes.
+    Returns (file positioned at 0, sha256 hex digest); the caller closes the file.
+    """
+    digest = hashlib.sha256(head)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES, dir=TMP_DIR)
+    try:
+        spool.write(head)
+        for chunk in body.iter_chunks(chunk_size=READ_CHUNK_SIZE) if body is not None else ():
+            digest.update(chunk)
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+def sniff_format(head):
+    """
+    Detect the file format from its magic bytes. Returns the format name or None when it is not recognized.
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head[4:8] == b"ftyp":
+        return head[8:12].decode("ascii", "replace").strip().upper()
+    for magic, fmt in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def inspect_header(head, size):
+    """
+    Decide from the first bytes of the original (and its total size) whether it is worth downloading.
+    Returns (format, (width, height) or None when the header does not fit in the sniffed bytes).
+    Raises ImageRejectedError for oversize objects, non-images, unsupported formats, invalid headers and oversize dimensions.
+    """
+    if size > MAX_SOURCE_BYTES:
+        raise ImageRejectedError(f"{size} bytes exceeds the {MAX_SOURCE_BYTES} byte limit")
+    fmt = sniff_format(head)
+    if fmt is None:
+        raise ImageRejectedError("not an image")
+    if fmt not in SUPPORTED_FORMATS:
+        raise ImageRejectedError(f"unsupported format {fmt}")
+
+    try:
+        with Image.open(io.BytesIO(head), formats=[fmt]) as im:
+            dimensions = im.size
+    except Image.DecompressionBombError as e:
+        raise ImageRejectedError(str(e))
+    except Exception as e:
+        if len(head) < size:
+            # Header larger than the sniffed bytes (e.g. big EXIF block); checked again when decoding.
+            return fmt, None
+        # The whole object was sniffed, so there is nothing more to read: magic bytes without a valid header.
+        raise ImageRejectedError(f"invalid {fmt} header: {e}")
+
+    width, height = dimensions
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageRejectedError(f"{width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels")
+    # Only JPEG can be decoded at reduced scale.
+    if fmt != "JPEG" and width * height > MAX_DECODE_PIXELS:
+        raise ImageRejectedError(f"{width}x{height} {fmt} needs {width * height} decoded pixels, "
+                                 f"over the {MAX_DECODE_PIXELS} limit")
+    return fmt, dimensions
+
+
+def object_size(resp):
+    """Total object size from a ranged GET response (Content-Range: bytes 0-N/TOTAL)."""
+    content_range = resp.get("ContentRange")
+    return int(content_range.rsplit("/", 1)[1]) if content_range else resp["ContentLength"]
+
+
+def reject_image(table, item, lease_id, reason):
+    """
+    Mark the image REJECTED with the reason, so clients see why it never becomes AVAILABLE.
+    """
+    try:
+        table.update_item(Key={"PK": item["PK"], "SK": item["SK"]},
+                          UpdateExpression="SET #s = :s, #us = :us, rejectReason = :r REMOVE expiresAt, uploadId, leaseId, leaseExpiresAt",
+                          ConditionExpression="#s = :pending AND leaseId = :l",
+                          ExpressionAttributeNames={"#s":"status","#us":"userStatus"},
+                          ExpressionAttributeValues={":s":"REJECTED", ":us":f"{item['PK']}#REJECTED", ":r":reason, ":pending":"PENDING", ":l":lease_id})
+    except ClientError as e:
+        if e.response.get("Error",{}).get("Code") == "ConditionalCheckFailedException":
+            log("conditional_check_failed_lease_lost", level="WARNING", imageId=item["imageId"])
+            return
+        release_lease(table, item, lease_id)
+        raise
+
+
+def hash_index_key(content_hash):
+    return {"PK": f"hash#{content_hash}", "SK": f"hash#{content_hash}"}
+
+
+def copy_renditions(bucket, user_id, image_id, source_keys):
+    """
+    Server-side copy of another image's renditions (same content hash) into this image's prefix.
+    Each image owns its renditions, so deleting the source later does not affect the copy.
+    Returns {name: key}, or None when any copy failed (e.g. the source was deleted).
+    """
+    futures = {}
+    for name, source_key in source_keys.items():
+        key = f"{THUMBNAIL_PREFIX}{user_id}/{image_id}/{source_key.rsplit('/', 1)[-1]}"
+        future = upload_pool.submit(S3.copy_object, Bucket=bucket, Key=key, CopySource={"Bucket": bucket, "Key": source_key})
+        futures[future] = (name, key)
+
+    keys = {}
+    for future, (name, key) in futures.items():
+        try:
+            future.result()
+            keys[name] = key
+        except Exception as e:
+            log("rendition_copy_error", level="ERROR", key=key, error=e)
+            return None
+    return keys
+
+
+def reuse_renditions(table, bucket, user_id, image_id, content_hash):
+    """
+    Look the content hash up in the hash index and copy the renditions recorded there.
+    Returns {name: key}, or None when the bytes were not seen before or the index entry is stale.
+    """
+    index = table.get_item(Key=hash_index_key(content_hash)).get("Item")
+    if not index or set(index.get("renditions", {})) != {r["name"] for r in RENDITIONS}:
+        return None
+    return copy_renditions(bucket, user_id, image_id, index["renditions"])
+
+
+def record_content_hash(table, item, content_hash, rendition_keys):
+    """
+    Best effort: point the hash index at this image's renditions and record the hash in the user's partition
+    (used by initiate_upload to let clients skip uploading bytes they already stored).
+    """
+    items = [{"PK": item["PK"], "SK": f"hash#{content_hash}", "imageId": item["imageId"]}]
+    # Only a complete set of renditions is worth reusing.
+    if set(rendition_keys) == {r["name"] for r in RENDITIONS}:
+        items.append({**hash_index_key(content_hash), "sourceImageId": item["imageId"], "renditions": rendition_keys})
+    try:
+        with table.batch_writer() as batch:
+            for hash_item in items:
+                batch.put_item(Item=hash_item)
+    except ClientError as e:
+        log("hash_index_write_error", level="ERROR", imageId=item["imageId"], error=e)
+
+
 def process_s3_event(s3_rec):
     """
     Read s3 event record, validate record having user id and image id.
-    Check Initiate img Meta data exists or not (Pending).
-    S3 Head object of key.
-    Get S3 Object,  Generate Thumnail and save in thumbnails/ folder in S3.
-    Update DB record with attributes (Status, Size and Thumbnail Key)
+    Check Initiate img Meta data exists or not (Pending), resolved directly on PK/SK through the image pointer item.
+    Events for images that are no longer Pending are dropped, and a lease on the item keeps concurrent duplicates
+    from processing the same image; both happen before any S3 request.
+    Get the first SNIFF_BYTES of the S3 Object with a ranged GET and check the format (magic bytes) and dimensions from the header:
+    non-images, unsupported formats and originals over the size, pixel or decode limits are marked REJECTED with a rejectReason
+    without downloading the rest. Otherwise GET the remaining bytes, hashing the body while it streams to a spool file.
+    Content type comes from the sniffed format.
+    Bytes seen before reuse the renditions recorded in the hash index (server-side copies);
+    otherwise Generate renditions and save them in thumbnails/ folder in S3 (originals that fail to decode are REJECTED).
+    Update DB record with attributes (Status, Size, Content Type, Content Hash, Renditions and Thumbnail Key)
 
     """
     bucket = s3_rec["s3"]["bucket"]["name"]
@@ -47,79 +429,148 @@ def process_s3_event(s3_rec):
     parts = key.split("/")
 
     if len(parts) < 3:
-        print("invalid_s3_key_format", key=key)
+        log("invalid_s3_key_format", level="WARNING", key=key)
         return
     user_id = parts[1]
     image_id = parts[2]
+    table = get_table()
+
+    with timer("dynamodb_lookup"):
+        item = get_image_item(table, image_id)
+    if not item:
+        log("metadata_not_found", level="WARNING", imageId=image_id, key=key)
+        return
 
-    resp = table.query(IndexName="imageId-index", KeyConditionExpression=Key("imageId").eq(image_id), Limit=1)
-    items = resp.get("Items", [])
-    if not items:
-        print("metadata_not_found", imageId=image_id, key=key)
+    # Duplicate and redriven events stop here, before any S3 I/O.
+    if item.get("status") != "PENDING":
+        log("already_processed", imageId=image_id, status=item.get("status"))
         return
-    item = items[0]
+    if item.get("leaseExpiresAt", 0) >= time.time():
+        raise LeaseHeldError(image_id)
+    lease_id = acquire_lease(table, item)
 
     try:
-        head = S3.head_object(Bucket=bucket, Key=key)
+        with timer("s3_get"):
+            head_obj = S3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{SNIFF_BYTES - 1}")
+            head = head_obj["Body"].read()
     except ClientError as e:
-        print("s3_head_error", error=str(e), key=key)
+        if e.response.get("Error",{}).get("Code") == "InvalidRange":
+            reject_image(table, item, lease_id, "empty object")
+            return
+        log("s3_get_error", level="ERROR", key=key, error=e)
+        release_lease(table, item, lease_id)
         raise
 
-    size = head.get("ContentLength", 0)
+    size = object_size(head_obj)
     try:
-        obj = S3.get_object(Bucket=bucket, Key=key)
-        body = obj["Body"].read()
+        fmt, dimensions = inspect_header(head, size)
+    except ImageRejectedError as e:
+        log("image_rejected", level="WARNING", imageId=image_id, reason=e)
+        reject_image(table, item, lease_id, str(e))
+        return
+    # The sniffed format, not what the client declared.
+    content_type = SUPPORTED_FORMATS[fmt]
+
+    try:
+        with timer("s3_get"):
+            rest = None
+            if size > len(head):
+                rest = S3.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(head)}-", IfMatch=head_obj["ETag"])["Body"]
+            spool, content_hash = spool_and_hash(rest, head)
     except ClientError as e:
-        print("s3_get_error", error=str(e), key=key)
+        log("s3_get_error", level="ERROR", key=key, error=e)
+        release_lease(table, item, lease_id)
         raise
 
-    try:
-        thumb_bytes = generate_thumbnail_bytes(body)
-        thumb_key = f"{THUMBNAIL_PREFIX}{user_id}/{image_id}.jpg"
-        S3.put_object(Bucket=bucket, Key=thumb_key, Body=thumb_bytes, ContentType="image/jpeg", ACL="private")
-    except Exception as e:
-        print("thumbnail_error", error=str(e), imageId=image_id)
-        thumb_key = None
+    with spool:
+        rendition_keys = reuse_renditions(table, bucket, user_id, image_id, content_hash)
+        if rendition_keys is None:
+            try:
+                renditions = generate_renditions(spool, source_format=fmt)
+                with timer("s3_put"):
+                    rendition_keys = upload_renditions(bucket, user_id, image_id, renditions)
+            except ImageRejectedError as e:
+                log("image_rejected", level="WARNING", imageId=image_id, reason=e)
+                reject_image(table, item, lease_id, str(e))
+                return
+            except OSError as e:
+                # Pillow reports unidentified (UnidentifiedImageError), truncated and corrupt data as OSError.
+                log("image_rejected", level="WARNING", imageId=image_id, reason=e)
+                reject_image(table, item, lease_id, f"cannot decode {fmt}: {e}")
+                return
+            except Exception as e:
+                log("thumbnail_error", level="ERROR", imageId=image_id, error=e)
+                rendition_keys = {}
+        else:
+            log("renditions_reused", imageId=image_id, contentHash=content_hash)
+    thumb_key = rendition_keys.get(THUMBNAIL_RENDITION)
 
     try:
-        table.update_item(Key={"PK": item["PK"], "SK": item["SK"]},
-                          UpdateExpression="SET #s = :s, #size = :sz, #thumb = :t",
-                          ConditionExpression="#s = :pending",
-                          ExpressionAttributeNames={"#s":"status","#size":"size","#thumb":"thumbnailKey"},
-                          ExpressionAttributeValues={":s":"AVAILABLE", ":sz":size, ":t":thumb_key, ":pending":"PENDING"})
+        with timer("dynamodb_update"):
+            table.update_item(Key={"PK": item["PK"], "SK": item["SK"]},
+                              UpdateExpression="SET #s = :s, #us = :us, #size = :sz, #ct = :ct, #thumb = :t, #r = :r, #h = :h REMOVE expiresAt, uploadId, leaseId, leaseExpiresAt",
+                              ConditionExpression="#s = :pending AND leaseId = :l",
+                              ExpressionAttributeNames={"#s":"status","#us":"userStatus","#size":"size","#ct":"contentType","#thumb":"thumbnailKey","#r":"renditions","#h":"contentHash"},
+                              ExpressionAttributeValues={":s":"AVAILABLE", ":us":f"{item['PK']}#AVAILABLE", ":sz":size, ":ct":content_type, ":t":thumb_key, ":r":rendition_keys, ":h":content_hash, ":pending":"PENDING", ":l":lease_id})
     except ClientError as e:
         if e.response.get("Error",{}).get("Code") == "ConditionalCheckFailedException":
-            print("conditional_check_failed_already_processed", imageId=image_id)
+            log("conditional_check_failed_lease_lost", level="WARNING", imageId=image_id)
             return
-        print("dynamodb_update_error", error=str(e), imageId=image_id)
+        log("dynamodb_update_error", level="ERROR", imageId=image_id, error=e)
+        release_lease(table, item, lease_id)
         raise
 
+    record_content_hash(table, item, content_hash, rendition_keys)
 
-def handler(event, context):
+
+def parse_sqs_record(rec):
     """
-    Lambda Handler for each record read from Queue.
-    Validates request body type and process to process_s3_event function"
+    Returns the S3 event records carried by one SQS message, or None when the body is not a valid S3 notification.
+    """
+    body = rec.get("body")
+    try:
+        payload = json.loads(body)
+    except Exception:
+        payload = body if isinstance(body, dict) else None
+
+    if not payload:
+        return None
+    return payload.get("Records", [])
+
 
+@instrumented
+def handler(event, context):
+    """
+    Lambda Handler for the batch read from Queue.
+    S3 records of all messages are processed concurrently on a bounded worker pool.
+    Returns the messageIds whose records failed (batchItemFailures) so only those messages are retried.
     """
     records = event.get("Records", [])
     if not records:
-        print("no_records")
-        return {"statusCode":400}
-    
-    for rec in records:
-        body = rec.get("body")
-        try:
-            payload = json.loads(body)
-        except Exception:
-            payload = body if isinstance(body, dict) else None
+        log("no_records")
+        return {"batchItemFailures": []}
+
+    failed_ids = []
+    futures = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for rec in records:
+            message_id = rec.get("messageId")
+            s3_records = parse_sqs_record(rec)
+            if s3_records is None:
+                log("invalid_sqs_body", level="WARNING", messageId=message_id)
+                failed_ids.append(message_id)
+                continue
 
-        if not payload:
-            print("invalid_sqs_body", body=body)
-            raise Exception("invalid SQS body")
-        
-        s3_records = payload.get("Records", [])
+            for s3_rec in s3_records:
+                futures[pool.submit(process_s3_event, s3_rec)] = message_id
 
-        for s3_rec in s3_records:
-            process_s3_event(s3_rec)
+        for future in as_completed(futures):
+            message_id = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log("record_processing_failed", level="ERROR", messageId=message_id, error=e)
+                if message_id not in failed_ids:
+                    failed_ids.append(message_id)
 
-    return {"statusCode":200}
\ No newline at end of file
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_ids]}
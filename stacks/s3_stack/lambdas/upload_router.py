@@ -0,0 +1,62 @@
+import os, json, time
+import aws_clients
+from instrumentation import instrumented, log
+
+FAST_QUEUE_URL = os.environ.get("FAST_QUEUE_URL")
+HEAVY_QUEUE_URL = os.environ.get("HEAVY_QUEUE_URL")
+# Originals up to this size go to the low-latency lane.
+FAST_LANE_MAX_BYTES = int(os.environ.get("FAST_LANE_MAX_BYTES", str(1024*1024)))
+# Formats that are slow to decode whatever their size.
+HEAVY_EXTENSIONS = {"tif", "tiff", "psd", "heic", "heif", "dng"}
+SEND_BATCH_LIMIT = 10
+SEND_ATTEMPTS = 3
+
+sqs = aws_clients.lazy_client("sqs")
+
+
+def classify(s3_rec):
+    """
+    Pick the processing lane from the notification itself (object size and key extension), without calling S3.
+    Records without a size go to the heavy lane.
+    """
+    obj = s3_rec.get("s3", {}).get("object", {})
+    size = obj.get("size")
+    extension = obj.get("key", "").rsplit(".", 1)[-1].lower()
+    if size is None or size > FAST_LANE_MAX_BYTES or extension in HEAVY_EXTENSIONS:
+        return "heavy"
+    return "fast"
+
+
+def send_records(queue_url, records):
+    """
+    Forward S3 records to a lane queue, one record per message (the body the processor expects from S3 notifications),
+    with SendMessageBatch. Failed entries are retried; raises when some still fail so the invocation is retried.
+    """
+    for start in range(0, len(records), SEND_BATCH_LIMIT):
+        entries = [{"Id": str(i), "MessageBody": json.dumps({"Records": [rec]})}
+                   for i, rec in enumerate(records[start:start + SEND_BATCH_LIMIT])]
+        for attempt in range(SEND_ATTEMPTS):
+            failed = {f["Id"] for f in sqs.send_message_batch(QueueUrl=queue_url, Entries=entries).get("Failed", [])}
+            entries = [e for e in entries if e["Id"] in failed]
+            if not entries:
+                break
+            time.sleep(0.1 * 2 ** attempt)
+        else:
+            raise RuntimeError(f"{len(entries)} records could not be sent to {queue_url}")
+
+
+@instrumented
+def handler(event, context):
+    """
+    Lambda Handler for S3 object created notifications.
+    Routes every record to the fast or the heavy processing lane queue.
+    Re-delivered records are harmless: the image processor drops events for images it already processed.
+    """
+    lanes = {"fast": [], "heavy": []}
+    for rec in event.get("Records", []):
+        lanes[classify(rec)].append(rec)
+
+    send_records(FAST_QUEUE_URL, lanes["fast"])
+    send_records(HEAVY_QUEUE_URL, lanes["heavy"])
+    log("records_routed", fast=len(lanes["fast"]), heavy=len(lanes["heavy"]))
+    return {lane: len(records) for lane, records in lanes.items()}
@@ -0,0 +1,109 @@
+import os
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+import aws_clients
+from image_items import usage_key
+from instrumentation import instrumented, log, metric, timer
+
+IMAGES_TABLE = os.environ.get("IMAGES_TABLE")
+# Stream sequence numbers are numeric strings of up to 40 digits, compared as zero-padded strings.
+SEQUENCE_DIGITS = 40
+
+table = aws_clients.lazy_table(IMAGES_TABLE, "background")
+deserializer = TypeDeserializer()
+
+
+def image(record, name):
+    """NewImage / OldImage of a stream record as a plain item, None when absent or not an image metadata item."""
+    raw = record["dynamodb"].get(name)
+    if not raw or not raw.get("SK", {}).get("S", "").startswith("createdAt#"):
+        return None
+    return {k: deserializer.deserialize(v) for k, v in raw.items()}
+
+
+def status_attribute(status):
+    return f"{status.lower()}Images"
+
+
+def usage_delta(record):
+    """
+    Change of the user's aggregates made by one stream record: {attribute: delta} for the image counts by status
+    and totalBytes, and the createdAt of a new image (or None). Returns (None, {}, None) for other items.
+    """
+    old, new = image(record, "OldImage"), image(record, "NewImage")
+    if old is None and new is None:
+        return None, {}, None
+    deltas = {}
+    for item, sign in ((old, -1), (new, 1)):
+        if item is not None:
+            status = status_attribute(item.get("status", "PENDING"))
+            deltas[status] = deltas.get(status, 0) + sign
+            deltas["totalBytes"] = deltas.get("totalBytes", 0) + sign * item.get("size", 0)
+    user_id = (new or old)["PK"].split("#", 1)[1]
+    created_at = new["createdAt"] if old is None else None
+    return user_id, {k: v for k, v in deltas.items() if v}, created_at
+
+
+def apply(user_id, deltas, created_at, sequence, recorded_at, created=True):
+    """
+    Add the deltas to the user#<userId> / usage item with atomic counters. The item keeps the last sequence number
+    applied and the update is conditional on a greater one, so records redelivered after a partial batch are skipped.
+    Changes to existing images (created False) need the item to exist: it is gone after a whole-library deletion,
+    whose REMOVE records must not bring it back with negative counts, and is missing for libraries older than the
+    stream until scripts/recount_usage.py seeds it.
+    Records from before the item's recountedAt (the stream record time, whole seconds) are already in its counts.
+    Returns False for a skipped record.
+    """
+    names = {f"#a{i}": name for i, name in enumerate(deltas)}
+    values = {f":a{i}": value for i, value in enumerate(deltas.values())}
+    values[":seq"] = sequence.zfill(SEQUENCE_DIGITS)
+    values[":at"] = Decimal(str(recorded_at))
+    sets = ["lastSequence = :seq"]
+    if created_at:
+        sets.append("lastUploadAt = :t")
+        values[":t"] = created_at
+    try:
+        table.update_item(Key=usage_key(user_id),
+                          UpdateExpression="ADD " + ", ".join(f"#a{i} :a{i}" for i in range(len(deltas))) + " SET " + ", ".join(sets),
+                          ConditionExpression=("(attribute_not_exists(lastSequence) OR lastSequence < :seq)" if created
+                                               else "lastSequence < :seq")
+                                              + " AND (attribute_not_exists(recountedAt) OR recountedAt <= :at)",
+                          ExpressionAttributeNames=names,
+                          ExpressionAttributeValues=values)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
+
+
+@instrumented
+def handler(event, context):
+    """
+    Lambda Handler for the images table stream (NEW_AND_OLD_IMAGES).
+    Keeps per-user aggregates (image counts by status, total bytes, last upload) from the inserts, status and size
+    changes and deletions of image metadata items; other items and changes (leases, renditions) are ignored.
+    Records are applied in order; the first failure stops the batch and is reported so the stream resumes from it.
+    """
+    applied = skipped = 0
+    failures = []
+    for record in event.get("Records", []):
+        sequence = record["dynamodb"]["SequenceNumber"]
+        user_id, deltas, created_at = usage_delta(record)
+        if not deltas:
+            continue
+        try:
+            with timer("dynamodb_update"):
+                if apply(user_id, deltas, created_at, sequence, record["dynamodb"]["ApproximateCreationDateTime"],
+                         created=created_at is not None):
+                    applied += 1
+                else:
+                    skipped += 1
+        except Exception as e:
+            log("usage_update_error", level="ERROR", userId=user_id, sequence=sequence, error=e)
+            failures.append({"itemIdentifier": sequence})
+            break
+    metric("applied", applied)
+    metric("duplicates", skipped)
+    return {"batchItemFailures": failures}
@@ -1,26 +1,42 @@
 import os
-from aws_cdk import (Stack, RemovalPolicy, Duration, aws_s3 as s3, 
+from aws_cdk import (Stack, RemovalPolicy, Duration, Size, aws_s3 as s3, 
                      aws_lambda as _lambda, aws_sqs as sqs, aws_s3_notifications as s3n, aws_logs,
                      aws_lambda_event_sources as lambda_event_sources)
 from constructs import Construct
 from aws_cdk.aws_lambda_event_sources import SqsEventSource
 from aws_cdk.aws_lambda_python_alpha import PythonFunction, PythonLayerVersion
-from stacks.constants import IMAGES_S3_BUCKET_NAME, IMAGE_SERVICE_QUEUE_NAME, IMAGE_SERVICE_DLQ_QUEUE_NAME
+from stacks.constants import (IMAGES_S3_BUCKET_NAME, IMAGE_SERVICE_QUEUE_NAME, IMAGE_SERVICE_DLQ_QUEUE_NAME,
+                             IMAGE_SERVICE_FAST_QUEUE_NAME, IMAGE_SERVICE_FAST_DLQ_QUEUE_NAME, FAST_LANE_MAX_BYTES,
+                             PROCESSING_LANES, USAGE_AGGREGATOR_DLQ_QUEUE_NAME)
 
 class S3Stack(Stack):
     def __init__(self, scope: Construct, id: str, table, **kwargs):
         super().__init__(scope, id, **kwargs)
 
         self.bucket = self.create_bucket()
-        self.dlq, self.queue = self.create_queue()
+        # Heavy lane (the original queue) and low-latency lane for small originals.
+        # The visibility timeout of each queue is its consumer's function timeout.
+        self.dlq, self.queue = self.create_queue("ImageProcessor", IMAGE_SERVICE_QUEUE_NAME, IMAGE_SERVICE_DLQ_QUEUE_NAME,
+                                                 PROCESSING_LANES["heavy"])
+        self.fast_dlq, self.fast_queue = self.create_queue("ImageProcessorFast", IMAGE_SERVICE_FAST_QUEUE_NAME,
+                                                           IMAGE_SERVICE_FAST_DLQ_QUEUE_NAME, PROCESSING_LANES["fast"])
 
-        self.bucket.add_event_notification(
-                s3.EventType.OBJECT_CREATED_PUT,
-                s3n.SqsDestination(self.queue),
-                s3.NotificationKeyFilter(prefix="users/")
-                )
+        # Shared modules (aws_clients, instrumentation, throttling) and third-party packages for the router, both
+        # processors and the usage aggregator, from the source directory the API stack's layer is built from as well.
+        lambda_layer = self.img_lambda_processor_layer()
+        self.router_lambda = self.upload_router_lambda(lambda_layer)
+        for event_type in (s3.EventType.OBJECT_CREATED_PUT, s3.EventType.OBJECT_CREATED_COMPLETE_MULTIPART_UPLOAD):
+            self.bucket.add_event_notification(
+                    event_type,
+                    s3n.LambdaDestination(self.router_lambda),
+                    s3.NotificationKeyFilter(prefix="users/")
+                    )
 
-        self.img_processor_lambda = self.img_lambda_processor(table)
+        # Lane settings live in PROCESSING_LANES, shared with scripts/emulate_pipeline.py.
+        self.img_processor_lambda = self.img_lambda_processor(table, lambda_layer, self.queue, PROCESSING_LANES["heavy"])
+        self.img_processor_fast_lambda = self.img_lambda_processor(table, lambda_layer, self.fast_queue,
+                                                                   PROCESSING_LANES["fast"])
+        self.usage_lambda = self.usage_aggregator_lambda(table, lambda_layer)
 
     def create_bucket(self):
         bucket = s3.Bucket(self, 
@@ -30,72 +46,148 @@ class S3Stack(Stack):
                             encryption=s3.BucketEncryption.S3_MANAGED,
                             versioned=True,
                             removal_policy=RemovalPolicy.DESTROY,
-                            auto_delete_objects=True)
+                            auto_delete_objects=True,
+                            lifecycle_rules=[s3.LifecycleRule(
+                                id="abort-stale-multipart-uploads",
+                                abort_incomplete_multipart_upload_after=Duration.days(1))])
         return bucket
         
         
-    def create_queue(self):
+    def create_queue(self, id, queue_name, dlq_name, lane):
         dlq = sqs.Queue(self, 
-                        "ImageProcessorDLQ",
-                        queue_name=IMAGE_SERVICE_DLQ_QUEUE_NAME, 
+                        f"{id}DLQ",
+                        queue_name=dlq_name, 
                         retention_period=Duration.days(14))
 
         queue = sqs.Queue(self, 
-                        "ImageProcessorQueue",
-                        queue_name=IMAGE_SERVICE_QUEUE_NAME,
-                        visibility_timeout=Duration.seconds(300),
+                        f"{id}Queue",
+                        queue_name=queue_name,
+                        visibility_timeout=Duration.seconds(lane["timeout"]),
                         retention_period=Duration.days(4),
-                        dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dlq),
+                        dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=lane["max_receive_count"], queue=dlq),
                         )
         return dlq, queue
 
-   
-        
-    def img_lambda_processor(self, table):
+    def upload_router_lambda(self, lambda_layer):
+        # Classifies S3 notifications by size; only aws_clients comes from the layer.
+        router_lambda = _lambda.Function(
+            self,
+            "upload_router_lambda",
+            function_name="upload_router_lambda",
+            description="Lambda function to route new uploads to the fast or heavy processing lane",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            code=_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), "lambdas")),
+            handler="upload_router.handler",
+            layers=[lambda_layer],
+            timeout=Duration.seconds(30),
+            memory_size=128,
+            log_retention=aws_logs.RetentionDays.ONE_MONTH,
+            retry_attempts=2,
+            # A failed notification has the same {"Records": [...]} shape as a lane message, so it can be redriven to the heavy queue.
+            dead_letter_queue=self.dlq,
+            environment={
+                "FAST_QUEUE_URL": self.fast_queue.queue_url,
+                "HEAVY_QUEUE_URL": self.queue.queue_url,
+                "FAST_LANE_MAX_BYTES": str(FAST_LANE_MAX_BYTES)
+            },
+        )
+        self.queue.grant_send_messages(router_lambda)
+        self.fast_queue.grant_send_messages(router_lambda)
+        return router_lambda
+
+    def usage_aggregator_lambda(self, table, lambda_layer):
+        # Keeps the per-user aggregate items (counts by status, bytes, last upload) from the table stream.
+        usage_lambda = _lambda.Function(
+            self,
+            "usage_aggregator_lambda",
+            function_name="usage_aggregator_lambda",
+            description="Lambda function to keep per-user image aggregates from the images table stream",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            code=_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), "lambdas")),
+            handler="usage_aggregator.handler",
+            layers=[lambda_layer],
+            timeout=Duration.seconds(60),
+            memory_size=256,
+            log_retention=aws_logs.RetentionDays.ONE_MONTH,
+            environment={"IMAGES_TABLE": table.table_name},
+        )
+        table.grant_read_write_data(usage_lambda)
 
-        lambda_layer = PythonLayerVersion(
+        # Records still failing after the retries are sent (as stream pointers) to the DLQ; the aggregates of
+        # their users need a recount.
+        self.usage_dlq = sqs.Queue(self, "UsageAggregatorDLQ", queue_name=USAGE_AGGREGATOR_DLQ_QUEUE_NAME,
+                                   retention_period=Duration.days(14))
+        usage_lambda.add_event_source(lambda_event_sources.DynamoEventSource(
+                table,
+                starting_position=_lambda.StartingPosition.TRIM_HORIZON,
+                batch_size=100,
+                max_batching_window=Duration.seconds(1),
+                retry_attempts=10,
+                on_failure=lambda_event_sources.SqsDlq(self.usage_dlq),
+                report_batch_item_failures=True
+            )
+        )
+        return usage_lambda
+
+    def img_lambda_processor_layer(self):
+        return PythonLayerVersion(
             self,
             id=f"img-lambda-processor-layer",
             layer_version_name=f"img-lambda-processor-layer",
-            entry=os.path.join(os.path.dirname(__file__), "lambdas", "python_layer"),            
+            entry=os.path.join(os.path.dirname(__file__), "..", "shared", "python_layer"),
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_11],
             bundling={
                     "image": _lambda.Runtime.PYTHON_3_11.bundling_image
                 }            
         )  
+        
+    def img_lambda_processor(self, table, lambda_layer, queue, lane):
+        function_name = lane["function_name"]
+        timeout = Duration.seconds(lane["timeout"])
+        memory_size = lane["memory_size"]
 
         # Image Processor Lambda
         img_processor_lambda =PythonFunction(
             self,  
-            f"image_processor_lambda",
-            function_name="image_processor_lambda",
+            function_name,
+            function_name=function_name,
             description="Lambda function to Update image status",
             runtime=_lambda.Runtime.PYTHON_3_11,                      
             entry=os.path.join(os.path.dirname(__file__), "lambdas"),
             index="image_processor.py",
             architecture=_lambda.Architecture.X86_64,
             layers=[lambda_layer],
-            timeout=Duration.seconds(300),
+            timeout=timeout,
             log_retention=aws_logs.RetentionDays.ONE_MONTH,
-            memory_size=512,
+            memory_size=memory_size,
+            ephemeral_storage_size=Size.gibibytes(2),
             environment={
                 "IMAGES_TABLE": table.table_name,
                 "IMAGES_BUCKET": self.bucket.bucket_name,
-                "QUEUE_URL": self.queue.queue_url            
+                "QUEUE_URL": queue.queue_url,
+                "MAX_WORKERS": str(lane["max_workers"]),
+                # Matches the function timeout so a lease never outlives the worker holding it by much.
+                "PROCESSING_LEASE_SECONDS": str(int(timeout.to_seconds())),
+                # Bodies are spooled to /tmp; MAX_WORKERS originals of this size must fit the ephemeral storage.
+                "MAX_SOURCE_BYTES": str(256*1024*1024),
+                # Decoded pixels in flight across worker threads, roughly a third of the memory size at 3 bytes per pixel.
+                "DECODE_BUDGET_PIXELS": str(memory_size * 120_000)
             },
         )
 
         # Permissions
         self.bucket.grant_read_write(img_processor_lambda)
         table.grant_read_write_data(img_processor_lambda)
-        self.queue.grant_consume_messages(img_processor_lambda)
+        queue.grant_consume_messages(img_processor_lambda)
 
 
         # S3 Event 
         img_processor_lambda.add_event_source(lambda_event_sources.SqsEventSource(
-                queue=self.queue,
-                batch_size=10,
-                max_batching_window=Duration.seconds(30)
+                queue=queue,
+                batch_size=lane["batch_size"],
+                max_batching_window=Duration.seconds(lane["max_batching_window"]) if lane["max_batching_window"] else None,
+                max_concurrency=lane["max_concurrency"],
+                report_batch_item_failures=True
             )
         )
         
@@ -1,4 +1,5 @@
 import os
+import sys
 import boto3
 import pytest
 from moto import mock_s3, mock_dynamodb
@@ -6,10 +7,16 @@ from moto import mock_s3, mock_dynamodb
 TABLE_NAME = "ImagesTable"
 BUCKET_NAME = "images-bucket"
 
-@pytest.fixture(scope="session", autouse=True)
-def set_env_vars():
-    os.environ["IMAGES_TABLE"] = TABLE_NAME
-    os.environ["IMAGES_BUCKET"] = BUCKET_NAME
+# Lambda modules read their configuration and build boto3 clients at import
+# time, which happens during collection - before any fixture runs.
+os.environ["IMAGES_TABLE"] = TABLE_NAME
+os.environ["IMAGES_BUCKET"] = BUCKET_NAME
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+# The layer's modules are on the path of every function in Lambda.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "shared", "python_layer"))
 
 @pytest.fixture
 def aws_env():
@@ -20,11 +27,15 @@ def aws_env():
         dynamodb.create_table(
             TableName=TABLE_NAME,
             KeySchema=[{"AttributeName":"PK","KeyType":"HASH"},{"AttributeName":"SK","KeyType":"RANGE"}],
-            AttributeDefinitions=[{"AttributeName":"PK","AttributeType":"S"},{"AttributeName":"SK","AttributeType":"S"},{"AttributeName":"imageId","AttributeType":"S"},{"AttributeName":"createdAt","AttributeType":"S"}],
+            AttributeDefinitions=[{"AttributeName":"PK","AttributeType":"S"},{"AttributeName":"SK","AttributeType":"S"},{"AttributeName":"imageId","AttributeType":"S"},{"AttributeName":"createdAt","AttributeType":"S"},{"AttributeName":"userStatus","AttributeType":"S"}],
             GlobalSecondaryIndexes=[{
                 "IndexName":"imageId-index",
                 "KeySchema":[{"AttributeName":"imageId","KeyType":"HASH"},{"AttributeName":"createdAt","KeyType":"RANGE"}],
                 "Projection":{"ProjectionType":"ALL"}
+            },{
+                "IndexName":"userStatus-index",
+                "KeySchema":[{"AttributeName":"userStatus","KeyType":"HASH"},{"AttributeName":"SK","KeyType":"RANGE"}],
+                "Projection":{"ProjectionType":"ALL"}
             }],
             BillingMode="PAY_PER_REQUEST",
         )
@@ -1,7 +1,11 @@
 import json
 import io
+import hashlib
+import threading
 import boto3
 import pytest
+import time
+from unittest import mock
 from PIL import Image
 
 from stacks.s3_stack.lambdas import image_processor as handler
@@ -12,15 +16,15 @@ def sample_s3_event():
     return {
         "s3": {
             "bucket": {"name": "images-bucket"},
-            "object": {"key": "users/123/image123.jpg"}
+            "object": {"key": "users/123/image123/pic.jpg"}
         }
     }
 
 
-def create_test_image_bytes():
-    img = Image.new("RGB", (800, 800), "blue")
+def create_test_image_bytes(size=(800, 800), fmt="JPEG", mode="RGB"):
+    img = Image.new(mode, size, "blue")
     buf = io.BytesIO()
-    img.save(buf, format="JPEG")
+    img.save(buf, format=fmt)
     buf.seek(0)
     return buf.read()
 
@@ -32,6 +36,48 @@ def test_generate_thumbnail_bytes(aws_env):
     assert len(thumb) > 0
 
 
+def test_generate_thumbnail_bytes_large_jpeg_is_downscaled():
+    thumb = handler.generate_thumbnail_bytes(create_test_image_bytes(size=(6000, 4000)))
+    with Image.open(io.BytesIO(thumb)) as im:
+        assert im.format == "JPEG"
+        assert im.size == (400, 267)
+
+
+def test_generate_thumbnail_bytes_small_jpeg_not_reencoded():
+    img_bytes = create_test_image_bytes(size=(300, 200))
+    assert handler.generate_thumbnail_bytes(img_bytes) is img_bytes
+
+
+def test_generate_renditions_cascade():
+    renditions = handler.generate_renditions(create_test_image_bytes(size=(3000, 2000)))
+    assert set(renditions) == {r["name"] for r in handler.RENDITIONS}
+    for rendition in handler.RENDITIONS:
+        data, fmt = renditions[rendition["name"]]
+        with Image.open(io.BytesIO(data)) as im:
+            assert im.format == fmt
+            assert im.width == rendition["size"][0]
+            assert im.height <= rendition["size"][1]
+
+
+def test_generate_renditions_boxes_that_are_not_nested():
+    renditions = [{"name": "banner", "size": (1000, 300), "format": "PNG"},
+                  {"name": "square", "size": (400, 400), "format": "PNG"},
+                  {"name": "icon", "size": (100, 100), "format": "PNG"}]
+    result = handler.generate_renditions(create_test_image_bytes(size=(1000, 1000), fmt="PNG"), renditions)
+    sizes = {}
+    for name, (data, fmt) in result.items():
+        with Image.open(io.BytesIO(data)) as im:
+            sizes[name] = im.size
+    assert sizes == {"banner": (300, 300), "square": (400, 400), "icon": (100, 100)}
+
+
+def test_generate_thumbnail_bytes_rgba_png():
+    thumb = handler.generate_thumbnail_bytes(create_test_image_bytes(size=(800, 600), fmt="PNG", mode="RGBA"))
+    with Image.open(io.BytesIO(thumb)) as im:
+        assert im.format == "JPEG"
+        assert im.size == (400, 300)
+
+
 def test_process_s3_event_happy_path(aws_env, sample_s3_event):
     # Insert metadata into DynamoDB
     db = boto3.resource("dynamodb", region_name="us-east-1")
@@ -43,24 +89,30 @@ def test_process_s3_event_happy_path(aws_env, sample_s3_event):
         "createdAt": "2025-01-01T00:00:00Z",
         "status": "PENDING"
     })
+    table.put_item(Item={"PK": "image#image123", "SK": "image#image123",
+                         "itemPK": "USER#123", "itemSK": "IMAGE#image123"})
 
     # Upload an image to S3
     s3 = boto3.client("s3", region_name="us-east-1")
     s3.put_object(Bucket="images-bucket",
-                  Key="users/123/image123.jpg",
+                  Key="users/123/image123/pic.jpg",
                   Body=create_test_image_bytes())
 
     # Call function
     handler.process_s3_event(sample_s3_event)
 
     # Verify thumbnail uploaded
-    resp = s3.list_objects_v2(Bucket="images-bucket", Prefix="thumbnails/123/image123.jpg")
-    assert "Contents" in resp
+    resp = s3.list_objects_v2(Bucket="images-bucket", Prefix="thumbnails/123/image123/")
+    assert len(resp["Contents"]) == len(handler.RENDITIONS)
 
     # Verify DynamoDB update
     updated = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})
     assert updated["Item"]["status"] == "AVAILABLE"
-    assert updated["Item"]["thumbnailKey"].startswith("thumbnails/123/")
+    assert updated["Item"]["userStatus"] == "USER#123#AVAILABLE"
+    assert updated["Item"]["size"] > 0
+    assert updated["Item"]["thumbnailKey"] == "thumbnails/123/image123/thumbnail.jpg"
+    assert updated["Item"]["renditions"]["preview"] == "thumbnails/123/image123/preview.jpg"
+    assert "leaseId" not in updated["Item"]
 
 
 def test_process_s3_event_invalid_key(aws_env):
@@ -86,7 +138,7 @@ def test_handler_with_sqs_event(aws_env):
 
     s3 = boto3.client("s3", region_name="us-east-1")
     s3.put_object(Bucket="images-bucket",
-                  Key="users/123/image123.jpg",
+                  Key="users/123/image123/pic.jpg",
                   Body=create_test_image_bytes())
 
     sqs_event = {
@@ -94,11 +146,294 @@ def test_handler_with_sqs_event(aws_env):
             {"body": json.dumps({
                 "Records": [
                     {"s3": {"bucket": {"name": "images-bucket"},
-                            "object": {"key": "users/123/image123.jpg"}}}
+                            "object": {"key": "users/123/image123/pic.jpg"}}}
                 ]
             })}
         ]
     }
 
     resp = handler.handler(sqs_event, None)
-    assert resp["statusCode"] == 200
+    assert resp == {"batchItemFailures": []}
+
+
+def test_handler_reports_only_failed_messages(aws_env):
+    db = boto3.resource("dynamodb", region_name="us-east-1")
+    table = db.Table("ImagesTable")
+    table.put_item(Item={
+        "PK": "USER#123",
+        "SK": "IMAGE#image123",
+        "imageId": "image123",
+        "createdAt": "2025-01-01T00:00:00Z",
+        "status": "PENDING"
+    })
+
+    table.put_item(Item={
+        "PK": "USER#123",
+        "SK": "IMAGE#image456",
+        "imageId": "image456",
+        "createdAt": "2025-01-01T00:00:00Z",
+        "status": "PENDING"
+    })
+
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.put_object(Bucket="images-bucket",
+                  Key="users/123/image123/pic.jpg",
+                  Body=create_test_image_bytes())
+
+    def s3_message(message_id, key):
+        return {"messageId": message_id,
+                "body": json.dumps({"Records": [{"s3": {"bucket": {"name": "images-bucket"},
+                                                        "object": {"key": key}}}]})}
+
+    sqs_event = {
+        "Records": [
+            s3_message("ok", "users/123/image123/pic.jpg"),
+            s3_message("missing-object", "users/123/image456/other.jpg"),
+            {"messageId": "bad-body", "body": ""},
+        ]
+    }
+
+    resp = handler.handler(sqs_event, None)
+    failed = sorted(f["itemIdentifier"] for f in resp["batchItemFailures"])
+    assert failed == ["bad-body", "missing-object"]
+
+    updated = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})
+    assert updated["Item"]["status"] == "AVAILABLE"
+    # The failed attempt gave its lease back so the retry can start right away.
+    missing = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image456"})["Item"]
+    assert missing["status"] == "PENDING"
+    assert "leaseId" not in missing
+
+
+def test_process_s3_event_duplicate_skips_s3(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK": "USER#123", "SK": "IMAGE#image123", "imageId": "image123",
+                         "createdAt": "2025-01-01T00:00:00Z", "status": "AVAILABLE"})
+
+    with mock.patch.object(handler, "S3") as s3:
+        assert handler.process_s3_event(sample_s3_event) is None
+    s3.get_object.assert_not_called()
+
+
+def test_process_s3_event_lease_held(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK": "USER#123", "SK": "IMAGE#image123", "imageId": "image123",
+                         "createdAt": "2025-01-01T00:00:00Z", "status": "PENDING",
+                         "leaseId": "other-worker", "leaseExpiresAt": int(time.time()) + 60})
+
+    with mock.patch.object(handler, "S3") as s3:
+        with pytest.raises(handler.LeaseHeldError):
+            handler.process_s3_event(sample_s3_event)
+    s3.get_object.assert_not_called()
+
+
+def test_process_s3_event_takes_over_expired_lease(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK": "USER#123", "SK": "IMAGE#image123", "imageId": "image123",
+                         "createdAt": "2025-01-01T00:00:00Z", "status": "PENDING",
+                         "leaseId": "crashed-worker", "leaseExpiresAt": int(time.time()) - 1})
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.put_object(Bucket="images-bucket", Key="users/123/image123/pic.jpg", Body=create_test_image_bytes())
+
+    handler.process_s3_event(sample_s3_event)
+    assert table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]["status"] == "AVAILABLE"
+
+
+def test_process_s3_event_reuses_renditions_for_known_bytes(aws_env):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    image_bytes = create_test_image_bytes()
+    for user_id, image_id in (("123", "first"), ("456", "second")):
+        table.put_item(Item={"PK": f"user#{user_id}", "SK": f"createdAt#t#{image_id}", "imageId": image_id,
+                             "createdAt": "t", "status": "PENDING"})
+        table.put_item(Item={"PK": f"image#{image_id}", "SK": f"image#{image_id}",
+                             "itemPK": f"user#{user_id}", "itemSK": f"createdAt#t#{image_id}"})
+        s3.put_object(Bucket="images-bucket", Key=f"users/{user_id}/{image_id}/pic.jpg", Body=image_bytes)
+
+    def event(user_id, image_id):
+        return {"s3": {"bucket": {"name": "images-bucket"}, "object": {"key": f"users/{user_id}/{image_id}/pic.jpg"}}}
+
+    handler.process_s3_event(event("123", "first"))
+    with mock.patch.object(handler, "generate_renditions") as generate:
+        handler.process_s3_event(event("456", "second"))
+    generate.assert_not_called()
+
+    first = table.get_item(Key={"PK": "user#123", "SK": "createdAt#t#first"})["Item"]
+    second = table.get_item(Key={"PK": "user#456", "SK": "createdAt#t#second"})["Item"]
+    assert second["status"] == "AVAILABLE"
+    assert second["contentHash"] == first["contentHash"]
+    assert second["thumbnailKey"] == "thumbnails/456/second/thumbnail.jpg"
+    resp = s3.list_objects_v2(Bucket="images-bucket", Prefix="thumbnails/456/second/")
+    assert len(resp["Contents"]) == len(handler.RENDITIONS)
+    assert table.get_item(Key={"PK": "user#456", "SK": f"hash#{first['contentHash']}"})["Item"]["imageId"] == "second"
+
+
+def test_process_s3_event_stale_hash_index_regenerates(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    image_bytes = create_test_image_bytes()
+    content_hash = hashlib.sha256(image_bytes).hexdigest()
+    table.put_item(Item={**handler.hash_index_key(content_hash), "sourceImageId": "gone",
+                         "renditions": {r["name"]: f"thumbnails/9/gone/{r['name']}.jpg" for r in handler.RENDITIONS}})
+    table.put_item(Item={"PK": "USER#123", "SK": "IMAGE#image123", "imageId": "image123",
+                         "createdAt": "2025-01-01T00:00:00Z", "status": "PENDING"})
+    s3.put_object(Bucket="images-bucket", Key="users/123/image123/pic.jpg", Body=image_bytes)
+
+    handler.process_s3_event(sample_s3_event)
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["thumbnailKey"] == "thumbnails/123/image123/thumbnail.jpg"
+    assert table.get_item(Key=handler.hash_index_key(content_hash))["Item"]["sourceImageId"] == "image123"
+
+
+def test_generate_renditions_rejects_oversize_header():
+    with mock.patch.object(handler, "MAX_IMAGE_PIXELS", 1000):
+        with pytest.raises(handler.ImageRejectedError):
+            handler.generate_renditions(create_test_image_bytes(size=(100, 100)))
+
+
+def test_generate_renditions_decode_limit_after_draft():
+    renditions = [{"name": "grid", "size": [200, 200], "format": "JPEG", "quality": 75}]
+    with mock.patch.object(handler, "MAX_DECODE_PIXELS", 1_000_000):
+        # JPEG decodes at 1/4 scale (750x750), PNG has no reduced-scale decoding.
+        assert "grid" in handler.generate_renditions(create_test_image_bytes(size=(3000, 3000)), renditions)
+        with pytest.raises(handler.ImageRejectedError):
+            handler.generate_renditions(create_test_image_bytes(size=(3000, 3000), fmt="PNG"), renditions)
+
+
+def test_decode_budget_blocks_until_released():
+    budget = handler.DecodeBudget(10)
+    first = budget.reserve(8)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(budget.reserve(5)))
+    waiter.start()
+    waiter.join(0.1)
+    assert not acquired
+    first.__exit__(None, None, None)
+    waiter.join(1)
+    assert acquired and budget.available == 5
+
+
+def test_process_s3_event_oversize_image_rejected(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    table.put_item(Item={"PK": "USER#123", "SK": "IMAGE#image123", "imageId": "image123",
+                         "createdAt": "2025-01-01T00:00:00Z", "status": "PENDING"})
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.put_object(Bucket="images-bucket", Key="users/123/image123/pic.jpg", Body=create_test_image_bytes(fmt="PNG"))
+
+    # Small spool threshold so the body goes through /tmp.
+    with mock.patch.object(handler, "MAX_IMAGE_PIXELS", 1000), mock.patch.object(handler, "SPOOL_MEMORY_BYTES", 1024):
+        assert handler.process_s3_event(sample_s3_event) is None
+
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["status"] == "REJECTED"
+    assert item["userStatus"] == "USER#123#REJECTED"
+    assert "exceeds 1000 pixels" in item["rejectReason"]
+    assert "leaseId" not in item
+
+
+def test_sniff_format():
+    assert handler.sniff_format(create_test_image_bytes()) == "JPEG"
+    assert handler.sniff_format(create_test_image_bytes(fmt="PNG")) == "PNG"
+    assert handler.sniff_format(create_test_image_bytes(fmt="WEBP")) == "WEBP"
+    assert handler.sniff_format(b"\x00\x00\x00\x18ftypheic\x00\x00") == "HEIC"
+    assert handler.sniff_format(b"<html></html>") is None
+
+
+def put_pending_image(table, s3, body, content_type="application/octet-stream"):
+    table.put_item(Item={"PK": "USER#123", "SK": "IMAGE#image123", "imageId": "image123",
+                         "createdAt": "2025-01-01T00:00:00Z", "status": "PENDING"})
+    s3.put_object(Bucket="images-bucket", Key="users/123/image123/pic.jpg", Body=body, ContentType=content_type)
+
+
+def test_process_s3_event_non_image_rejected_after_ranged_get(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    put_pending_image(table, s3, b"<html>" + b"x" * 200_000, content_type="image/jpeg")
+
+    with mock.patch.object(handler.S3, "get_object", wraps=handler.S3.get_object) as get_object:
+        handler.process_s3_event(sample_s3_event)
+    assert get_object.call_count == 1
+    assert get_object.call_args.kwargs["Range"] == f"bytes=0-{handler.SNIFF_BYTES - 1}"
+
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["status"] == "REJECTED"
+    assert item["rejectReason"] == "not an image"
+
+
+def test_process_s3_event_unsupported_format_rejected(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    put_pending_image(table, s3, b"\x00\x00\x00\x18ftypheic" + b"\x00" * 1000)
+
+    handler.process_s3_event(sample_s3_event)
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["rejectReason"] == "unsupported format HEIC"
+
+
+def test_process_s3_event_fetches_rest_after_header(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    image_bytes = create_test_image_bytes(size=(1200, 900))
+    put_pending_image(table, s3, image_bytes, content_type="text/plain")
+
+    with mock.patch.object(handler, "SNIFF_BYTES", 1024):
+        handler.process_s3_event(sample_s3_event)
+
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["status"] == "AVAILABLE"
+    assert item["contentType"] == "image/jpeg"
+    assert item["size"] == len(image_bytes)
+    assert item["contentHash"] == hashlib.sha256(image_bytes).hexdigest()
+
+
+def test_process_s3_event_empty_object_rejected(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    put_pending_image(table, s3, b"")
+
+    handler.process_s3_event(sample_s3_event)
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["status"] == "REJECTED"
+
+
+@pytest.mark.parametrize("body", [b"BM this is a text file, not a bitmap", b"\xff\xd8\xff" + bytes(range(256)) * 4])
+def test_process_s3_event_magic_bytes_without_valid_header_rejected(aws_env, sample_s3_event, body):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    put_pending_image(table, s3, body)
+
+    handler.process_s3_event(sample_s3_event)
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["status"] == "REJECTED"
+    assert item["rejectReason"].startswith("invalid ")
+    assert "contentType" not in item
+
+
+def test_process_s3_event_undecodable_body_rejected(aws_env, sample_s3_event):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    # Valid header in the sniffed bytes, truncated scan data after them.
+    image_bytes = create_test_image_bytes(size=(1200, 900))
+    put_pending_image(table, s3, image_bytes[:len(image_bytes) // 2])
+
+    with mock.patch.object(handler, "SNIFF_BYTES", 1024):
+        handler.process_s3_event(sample_s3_event)
+
+    item = table.get_item(Key={"PK": "USER#123", "SK": "IMAGE#image123"})["Item"]
+    assert item["status"] == "REJECTED"
+    assert item["rejectReason"].startswith("cannot decode JPEG")
+    assert "thumbnailKey" not in item
+
+
+def test_handler_reports_stage_latencies(aws_env, sample_s3_event, capsys):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    put_pending_image(table, s3, create_test_image_bytes(size=(1200, 900)))
+
+    handler.handler({"Records": [{"body": json.dumps({"Records": [sample_s3_event]})}]}, None)
+
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert record["Handler"] == "image_processor.handler"
+    stages = {m["Name"] for m in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    assert {"dynamodb_lookup", "s3_get", "decode", "encode", "s3_put", "dynamodb_update", "duration"} <= stages
+    assert len(record["encode"]) == len(handler.RENDITIONS)
@@ -0,0 +1,40 @@
+import boto3
+import pytest
+from stacks.benchmarking import synthetic_image
+from stacks.s3_stack.lambdas import image_processor as handler
+
+# Originals at the sizes users upload: a 12 MP phone photo, a screenshot and a web export.
+CORPUS = {
+    "jpeg_12mp": ((4032, 3024), "JPEG", {"quality": 90}),
+    "png_1080p": ((1920, 1080), "PNG", {}),
+    "webp_3mp": ((2048, 1536), "WEBP", {"quality": 85}),
+}
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return {name: synthetic_image(size, fmt, **options) for name, (size, fmt, options) in CORPUS.items()}
+
+
+@pytest.mark.parametrize("name", sorted(CORPUS))
+def test_benchmark_process_s3_event(aws_env, benchmark, corpus, name):
+    table = boto3.resource("dynamodb", region_name="us-east-1").Table("ImagesTable")
+    s3 = boto3.client("s3", region_name="us-east-1")
+    key = f"users/u1/{name}/original"
+    s3.put_object(Bucket="images-bucket", Key=key, Body=corpus[name])
+    event = {"s3": {"bucket": {"name": "images-bucket"}, "object": {"key": key}}}
+
+    def pending():
+        # Every round processes a fresh upload: PENDING again and no renditions to reuse for its bytes.
+        table.put_item(Item={"PK": "user#u1", "SK": f"createdAt#2025-01-01T00:00:00+00:00#{name}",
+                             "imageId": name, "createdAt": "2025-01-01T00:00:00+00:00", "status": "PENDING"})
+        for item in table.scan(ProjectionExpression="PK, SK")["Items"]:
+            if item["PK"].startswith("hash#"):
+                table.delete_item(Key=item)
+
+    def process():
+        handler.process_s3_event(event)
+        assert table.get_item(Key={"PK": "user#u1", "SK": f"createdAt#2025-01-01T00:00:00+00:00#{name}"})[
+            "Item"]["status"] == "AVAILABLE"
+
+    benchmark(f"process_s3_event.{name}", process, setup=pending, rounds=5)
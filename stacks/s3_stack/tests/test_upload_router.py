@@ -0,0 +1,47 @@
+import json
+import boto3
+import pytest
+from unittest import mock
+from moto import mock_sqs
+
+from stacks.s3_stack.lambdas import upload_router as router
+
+
+def s3_record(key, size):
+    obj = {"key": key}
+    if size is not None:
+        obj["size"] = size
+    return {"s3": {"bucket": {"name": "images-bucket"}, "object": obj}}
+
+
+def test_classify():
+    assert router.classify(s3_record("users/1/a/avatar.png", 20_000)) == "fast"
+    assert router.classify(s3_record("users/1/a/photo.jpg", 40*1024*1024)) == "heavy"
+    assert router.classify(s3_record("users/1/a/scan.tiff", 20_000)) == "heavy"
+    assert router.classify(s3_record("users/1/a/unknown.jpg", None)) == "heavy"
+
+
+def test_handler_routes_records_to_lane_queues():
+    with mock_sqs():
+        sqs = boto3.client("sqs", region_name="us-east-1")
+        fast_url = sqs.create_queue(QueueName="fast")["QueueUrl"]
+        heavy_url = sqs.create_queue(QueueName="heavy")["QueueUrl"]
+        records = [s3_record(f"users/1/i{n}/small.jpg", 1000) for n in range(12)] + [s3_record("users/1/big/big.jpg", 10**8)]
+
+        with mock.patch.object(router, "sqs", sqs), mock.patch.object(router, "FAST_QUEUE_URL", fast_url), \
+             mock.patch.object(router, "HEAVY_QUEUE_URL", heavy_url):
+            assert router.handler({"Records": records}, None) == {"fast": 12, "heavy": 1}
+
+        heavy = sqs.receive_message(QueueUrl=heavy_url, MaxNumberOfMessages=10)["Messages"]
+        assert json.loads(heavy[0]["Body"]) == {"Records": [records[-1]]}
+        fast = sqs.get_queue_attributes(QueueUrl=fast_url, AttributeNames=["ApproximateNumberOfMessages"])
+        assert fast["Attributes"]["ApproximateNumberOfMessages"] == "12"
+
+
+def test_send_records_raises_when_entries_keep_failing():
+    client = mock.Mock()
+    client.send_message_batch.return_value = {"Failed": [{"Id": "0"}]}
+    with mock.patch.object(router, "sqs", client), mock.patch.object(router.time, "sleep"):
+        with pytest.raises(RuntimeError):
+            router.send_records("queue-url", [s3_record("users/1/a/a.jpg", 10)])
+    assert client.send_message_batch.call_count == router.SEND_ATTEMPTS
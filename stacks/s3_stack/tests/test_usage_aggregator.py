@@ -0,0 +1,126 @@
+from unittest import mock
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from scripts import recount_usage
+from stacks.s3_stack.lambdas import usage_aggregator as aggregator
+from conftest import TABLE_NAME
+
+serializer = TypeSerializer()
+
+
+def stream_record(sequence, old=None, new=None, at=1_700_000_000):
+    event_name = "INSERT" if old is None else "REMOVE" if new is None else "MODIFY"
+    images = {name: {k: serializer.serialize(v) for k, v in item.items()}
+              for name, item in (("OldImage", old), ("NewImage", new)) if item is not None}
+    return {"eventName": event_name,
+            "dynamodb": {"SequenceNumber": str(sequence), "ApproximateCreationDateTime": at, **images}}
+
+
+def image_item(image_id, status, **attributes):
+    return {"PK": "user#u1", "SK": f"createdAt#2025-01-0{image_id}#i{image_id}", "imageId": f"i{image_id}",
+            "createdAt": f"2025-01-0{image_id}", "status": status, **attributes}
+
+
+def images_table():
+    return boto3.resource("dynamodb", region_name="us-east-1").Table(TABLE_NAME)
+
+
+def usage():
+    item = images_table().get_item(Key={"PK": "user#u1", "SK": "usage"}).get("Item", {})
+    return {k: v for k, v in item.items() if k not in ("PK", "SK", "lastSequence", "recountedAt")}
+
+
+def lifecycle():
+    pending, leased = image_item(1, "PENDING"), image_item(1, "PENDING", leaseId="l1")
+    available = image_item(1, "AVAILABLE", size=1500)
+    return [
+        stream_record(100, new=pending),
+        stream_record(110, old=pending, new=leased),
+        stream_record(120, old=leased, new=available),
+        stream_record(130, new=image_item(2, "PENDING")),
+        stream_record(140, new={"PK": "user#u1", "SK": "hash#" + "a" * 64, "imageId": "i1"}),
+        stream_record(150, old=image_item(2, "PENDING"), new=image_item(2, "REJECTED", size=10)),
+        stream_record(160, old=available),
+    ]
+
+
+def test_aggregates_follow_the_image_lifecycle(aws_env):
+    records = lifecycle()
+    assert aggregator.handler({"Records": records[:3]}, None) == {"batchItemFailures": []}
+    assert usage() == {"pendingImages": 0, "availableImages": 1, "totalBytes": 1500, "lastUploadAt": "2025-01-01"}
+
+    aggregator.handler({"Records": records[3:]}, None)
+    assert usage() == {"pendingImages": 0, "availableImages": 0, "rejectedImages": 1, "totalBytes": 10,
+                       "lastUploadAt": "2025-01-02"}
+
+
+def test_redelivered_records_are_applied_once(aws_env):
+    records = lifecycle()
+    aggregator.handler({"Records": records[:4]}, None)
+    aggregator.handler({"Records": records}, None)
+    assert usage()["totalBytes"] == 10
+    assert usage()["rejectedImages"] == 1
+
+
+def test_first_failure_stops_the_batch(aws_env):
+    records = lifecycle()
+    apply = aggregator.apply
+    with mock.patch.object(aggregator, "apply",
+                           side_effect=lambda *args, **kwargs: apply(*args, **kwargs) if args[3] != "130" else 1 / 0):
+        assert aggregator.handler({"Records": records}, None) == {"batchItemFailures": [{"itemIdentifier": "130"}]}
+    assert usage() == {"pendingImages": 0, "availableImages": 1, "totalBytes": 1500, "lastUploadAt": "2025-01-01"}
+
+    aggregator.handler({"Records": records[3:]}, None)
+    assert usage()["rejectedImages"] == 1
+
+
+def test_removals_do_not_recreate_a_deleted_usage_item(aws_env):
+    records = lifecycle()
+    aggregator.handler({"Records": records[:3]}, None)
+    images_table().delete_item(Key={"PK": "user#u1", "SK": "usage"})
+
+    aggregator.handler({"Records": records[6:]}, None)
+    assert usage() == {}
+
+
+def recount(**kwargs):
+    return recount_usage.recount(TABLE_NAME, clock=lambda: 1_700_000_100.5, sleep=lambda seconds: None,
+                                 table=images_table(), **kwargs)
+
+
+def test_recount_seeds_libraries_older_than_the_stream(aws_env):
+    table = images_table()
+    old = [image_item(1, "AVAILABLE", size=1500), image_item(2, "AVAILABLE", size=500), image_item(3, "PENDING")]
+    for item in old:
+        table.put_item(Item=item)
+    # Without a usage item, changes to images the stream never counted are dropped instead of going negative.
+    aggregator.handler({"Records": [stream_record(90, old=old[1])]}, None)
+    assert usage() == {}
+    table.delete_item(Key={"PK": old[1]["PK"], "SK": old[1]["SK"]})
+
+    assert recount() == (1, [])
+    assert usage() == {"availableImages": 1, "pendingImages": 1, "totalBytes": 1500, "lastUploadAt": "2025-01-03"}
+
+    # In flight during the recount (already counted), then after it.
+    aggregator.handler({"Records": [stream_record(100, old=old[1], at=1_700_000_100),
+                                    stream_record(110, old=old[0], at=1_700_000_101)]}, None)
+    assert usage() == {"availableImages": 0, "pendingImages": 1, "totalBytes": 0, "lastUploadAt": "2025-01-03"}
+
+
+def test_recount_retries_users_the_stream_updated_meanwhile(aws_env):
+    table = images_table()
+    table.put_item(Item=image_item(1, "AVAILABLE", size=1500))
+    count_images = recount_usage.count_images
+    calls = []
+
+    def stream_applies_a_record_first(table, partition):
+        calls.append(partition)
+        if len(calls) == 1:
+            aggregator.handler({"Records": [stream_record(100, new=image_item(2, "PENDING"), at=1_700_000_101)]}, None)
+            table.put_item(Item=image_item(2, "PENDING"))
+        return count_images(table, partition)
+
+    with mock.patch.object(recount_usage, "count_images", side_effect=stream_applies_a_record_first):
+        assert recount() == (1, [])
+    assert len(calls) == 2
+    assert usage() == {"availableImages": 1, "pendingImages": 1, "totalBytes": 1500, "lastUploadAt": "2025-01-02"}
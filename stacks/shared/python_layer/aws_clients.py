@@ -0,0 +1,162 @@
+"""
+Process-wide boto3 clients shared by every lambda.
+
+Clients are created on first use and then reused for the life of the container, so connection pools
+(and their TLS sessions) survive across invocations. Each call path picks a profile with its own
+timeouts and retry budget; the pool size follows the caller's worker concurrency.
+
+Modules bind their clients at import with lazy_client / lazy_table; nothing is built until the first call.
+DynamoDB and S3 clients retry and pace their calls with the adaptive limiter in throttling instead of botocore's retries.
+"""
+import os
+import threading
+from types import SimpleNamespace
+import boto3
+from boto3.dynamodb.table import BatchWriter
+from boto3.dynamodb.transform import TransformationInjector, copy_dynamodb_params
+from botocore.config import Config
+import throttling
+
+# Call path profiles.
+# interactive: synchronous requests behind API Gateway (29 s integration timeout), fail fast.
+# background: queue consumers and async jobs, more patience and retries.
+# transfer: S3 object bodies, long reads.
+PROFILES = {
+    "interactive": {"connect_timeout": 1, "read_timeout": 5, "max_attempts": 3},
+    "background": {"connect_timeout": 2, "read_timeout": 20, "max_attempts": 8},
+    "transfer": {"connect_timeout": 2, "read_timeout": 60, "max_attempts": 5},
+}
+DEFAULT_POOL_SIZE = int(os.environ.get("AWS_CLIENT_POOL_SIZE", "10"))
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_tables = {}
+
+
+def session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = boto3.session.Session()
+    return _session
+
+
+def client_config(profile="interactive", pool_size=None):
+    settings = PROFILES[profile]
+    return Config(connect_timeout=settings["connect_timeout"],
+                  read_timeout=settings["read_timeout"],
+                  retries={"mode": "adaptive", "max_attempts": settings["max_attempts"]},
+                  max_pool_connections=pool_size or DEFAULT_POOL_SIZE,
+                  tcp_keepalive=True)
+
+
+def client(service, profile="interactive", pool_size=None):
+    """
+    The process-wide client for a service and call path profile. pool_size should match the number of
+    threads using the client concurrently. DynamoDB clients take and return Python types (see Table).
+    """
+    key = (service, profile, pool_size or DEFAULT_POOL_SIZE)
+    existing = _clients.get(key)
+    if existing is None:
+        with _lock:
+            existing = _clients.get(key)
+            if existing is None:
+                config = client_config(profile, pool_size)
+                if service in throttling.SERVICES:
+                    config = config.merge(Config(retries={"mode": "standard", "total_max_attempts": 1}))
+                existing = session().client(service, config=config)
+                if service in throttling.SERVICES:
+                    throttling.install(existing, service, profile, PROFILES[profile]["max_attempts"] + 1)
+                if service == "dynamodb":
+                    _register_document_handlers(existing)
+                _clients[key] = existing
+    return existing
+
+
+def _register_document_handlers(dynamodb):
+    """
+    Make a low-level DynamoDB client take and return Python types and accept Key/Attr conditions,
+    with the same event handlers the boto3 Table resource installs, without loading the resource model.
+    """
+    injector = TransformationInjector()
+    events = dynamodb.meta.events
+    events.register("provide-client-params.dynamodb", copy_dynamodb_params, unique_id="dynamodb-create-params-copy")
+    events.register("before-parameter-build.dynamodb", injector.inject_condition_expressions,
+                    unique_id="dynamodb-condition-expression")
+    events.register("before-parameter-build.dynamodb", injector.inject_attribute_value_input,
+                    unique_id="dynamodb-attr-value-input")
+    events.register("after-call.dynamodb", injector.inject_attribute_value_output, unique_id="dynamodb-attr-value-output")
+
+
+class Table:
+    """
+    The part of the boto3 Table resource the lambdas use, as calls on the process-wide DynamoDB client.
+    It holds no state besides the name, so worker threads can share it.
+    """
+
+    def __init__(self, name, dynamodb):
+        self.name = name
+        self.meta = SimpleNamespace(client=dynamodb)
+
+    def get_item(self, **kwargs):
+        return self.meta.client.get_item(TableName=self.name, **kwargs)
+
+    def put_item(self, **kwargs):
+        return self.meta.client.put_item(TableName=self.name, **kwargs)
+
+    def update_item(self, **kwargs):
+        return self.meta.client.update_item(TableName=self.name, **kwargs)
+
+    def delete_item(self, **kwargs):
+        return self.meta.client.delete_item(TableName=self.name, **kwargs)
+
+    def query(self, **kwargs):
+        return self.meta.client.query(TableName=self.name, **kwargs)
+
+    def scan(self, **kwargs):
+        return self.meta.client.scan(TableName=self.name, **kwargs)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return BatchWriter(self.name, self.meta.client, overwrite_by_pkeys=overwrite_by_pkeys)
+
+
+def dynamodb_table(name, profile="interactive", pool_size=None):
+    """
+    Table on the process-wide DynamoDB client of the profile (items in and out are Python types, as with
+    the resource). Creating it is free, unlike boto3.resource("dynamodb").
+    """
+    key = (name, profile, pool_size or DEFAULT_POOL_SIZE)
+    table = _tables.get(key)
+    if table is None:
+        table = _tables.setdefault(key, Table(name, client("dynamodb", profile, pool_size)))
+    return table
+
+
+class Lazy:
+    """Module-level stand-in for a client or table; every attribute access goes to factory(*args)."""
+
+    def __init__(self, factory, *args):
+        self._factory = factory
+        self._args = args
+
+    def __getattr__(self, name):
+        return getattr(self._factory(*self._args), name)
+
+
+def lazy_client(service, profile="interactive", pool_size=None):
+    return Lazy(client, service, profile, pool_size)
+
+
+def lazy_table(name, profile="interactive", pool_size=None):
+    return Lazy(dynamodb_table, name, profile, pool_size)
+
+
+def reset():
+    """Forget every client (tests switching credentials or endpoints)."""
+    global _session
+    with _lock:
+        _clients.clear()
+        _tables.clear()
+        _session = None
@@ -0,0 +1,52 @@
+"""
+Key scheme of the image metadata items, shared by the API and the image processor.
+
+Image items live in the user#<userId> partition under createdAt#<createdAt>#<imageId>; an image#<imageId> pointer
+item holds their PK/SK so an imageId resolves with strongly consistent GetItems.
+"""
+from boto3.dynamodb.conditions import Key
+
+
+def image_pointer_key(image_id):
+    """
+    Key of the image#<imageId> pointer item, which holds the PK/SK of the image metadata item.
+    """
+    return {"PK": f"image#{image_id}", "SK": f"image#{image_id}"}
+
+
+def image_pointer_item(item):
+    pointer = {**image_pointer_key(item["imageId"]), "itemPK": item["PK"], "itemSK": item["SK"]}
+    if item.get("userId"):
+        pointer["userId"] = item["userId"]
+    return pointer
+
+
+def usage_key(user_id):
+    """
+    Key of the user's aggregate item, kept from the table stream by the usage aggregator (s3_stack) with
+    <status>Images counts (pendingImages, availableImages, ...), totalBytes and lastUploadAt.
+    Libraries older than the stream are seeded by scripts/recount_usage.py.
+    """
+    return {"PK": f"user#{user_id}", "SK": "usage"}
+
+
+def get_image_item(table, image_id):
+    """
+    Resolve image metadata by imageId with strongly consistent GetItems (pointer item, then metadata item).
+    Items written before pointer items existed fall back to the imageId-index GSI until they are backfilled
+    (scripts/backfill_images_table.py).
+    Returns None when the image does not exist.
+    """
+    pointer = table.get_item(Key=image_pointer_key(image_id), ConsistentRead=True).get("Item")
+    if pointer:
+        return table.get_item(Key={"PK": pointer["itemPK"], "SK": pointer["itemSK"]}, ConsistentRead=True).get("Item")
+    return query_image_index(table, image_id)
+
+
+def query_image_index(table, image_id):
+    """
+    Legacy lookup of an image without pointer item on the (eventually consistent) imageId-index GSI.
+    """
+    resp = table.query(IndexName="imageId-index", KeyConditionExpression=Key("imageId").eq(image_id), Limit=1)
+    items = resp.get("Items", [])
+    return items[0] if items else None
@@ -0,0 +1,123 @@
+"""
+Structured logs and per-stage latency metrics for every lambda.
+
+log() writes one JSON object per line. Handlers wrapped with @instrumented collect stage timers (timer()) and
+other values (metric()) during the invocation, and write them at the end as one CloudWatch Embedded Metric
+Format record. CloudWatch turns that log line into metrics without any API call. Each record also carries a
+cold start marker and the request and response payload sizes.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+import throttling
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ImageService")
+# EMF accepts at most 100 values per metric in one record.
+MAX_VALUES = 100
+
+_lock = threading.Lock()
+_cold_start = True
+_invocation = None
+
+
+def log(event, level="INFO", **fields):
+    """One JSON log line: level, event name, request id of the current invocation and the fields."""
+    record = {"level": level, "event": event}
+    if _invocation:
+        record.update(_invocation["context"])
+    record.update(fields)
+    print(json.dumps(record, default=str))
+
+
+def metric(name, value, unit="Count"):
+    """Record a value for the current invocation (ignored outside an instrumented handler)."""
+    invocation = _invocation
+    if invocation is None:
+        return
+    with _lock:
+        units, values = invocation["units"], invocation["values"]
+        units.setdefault(name, unit)
+        values.setdefault(name, [])
+        if len(values[name]) < MAX_VALUES:
+            values[name].append(value)
+
+
+@contextmanager
+def timer(stage):
+    """Time a stage (milliseconds); safe to use from worker threads, each use adds one value."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric(stage, round((time.perf_counter() - start) * 1000, 3), "Milliseconds")
+
+
+def payload_bytes(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return len(json.dumps(value, default=str))
+
+
+def emf_record(name, units, values, timestamp=None):
+    """Embedded Metric Format record of the collected values, with the handler name as the only dimension."""
+    return {
+        "_aws": {
+            "Timestamp": int((timestamp or time.time()) * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [["Handler"]],
+                "Metrics": [{"Name": metric_name, "Unit": unit} for metric_name, unit in units.items()],
+            }],
+        },
+        "Handler": name,
+        **{metric_name: vals[0] if len(vals) == 1 else vals for metric_name, vals in values.items()},
+    }
+
+
+def instrumented(handler):
+    """
+    Decorator for lambda handlers: times the whole invocation (duration), marks the first invocation of the
+    container (cold_start), measures the API request and response body sizes and writes the EMF record.
+    It also sets the throttling deadline from the context and reports the throttles absorbed and surfaced.
+    """
+    name = f"{handler.__module__.rsplit('.', 1)[-1]}.{handler.__name__}"
+
+    @wraps(handler)
+    def wrapper(event, context):
+        global _cold_start, _invocation
+        invocation = {"units": {}, "values": {},
+                      "context": {"handler": name, "requestId": getattr(context, "aws_request_id", None)}}
+        _invocation = invocation
+        throttling.set_deadline(context)
+        throttled = throttling.counters()
+        metric("cold_start", 1 if _cold_start else 0)
+        _cold_start = False
+        if isinstance(event, dict) and "body" in event:
+            metric("request_bytes", payload_bytes(event.get("body")), "Bytes")
+        response = None
+        try:
+            with timer("duration"):
+                response = handler(event, context)
+            return response
+        finally:
+            if isinstance(response, dict) and "body" in response:
+                metric("response_bytes", payload_bytes(response.get("body")), "Bytes")
+            for counter, total in throttling.counters().items():
+                if counter.startswith("throttles_") and total > throttled[counter]:
+                    metric(counter, total - throttled[counter])
+            # Lambda runs one invocation at a time per container. Where invocations overlap in one process
+            # (the local pipeline emulator) values may land in another invocation's record, but each
+            # invocation still writes its own.
+            with _lock:
+                if _invocation is invocation:
+                    _invocation = None
+            record = emf_record(name, invocation["units"], invocation["values"])
+            record["requestId"] = invocation["context"]["requestId"]
+            print(json.dumps(record))
+
+    return wrapper
@@ -0,0 +1,197 @@
+"""
+Adaptive client-side throttling and retries for the DynamoDB and S3 clients.
+
+aws_clients installs these hooks on every DynamoDB and S3 client it builds; botocore's own retries are off
+for those services, so this module alone decides what is retried and how fast requests go out:
+
+- One token bucket per service, shared by all clients and threads of the process. It lets everything
+  through until the service throttles. Then it sends at half the rate measured when the throttle came
+  (multiplicative decrease) and adds about one request per second, every second, while calls succeed
+  (additive increase).
+- Throttles and transient failures (5xx, connection errors, timeouts) are retried with full-jitter
+  exponential backoff: sleep uniform(0, min(max_delay, base_delay * 2 ** attempt)), per call path profile.
+- No wait or retry goes past the invocation deadline, which @instrumented sets from
+  context.get_remaining_time_in_millis() minus DEADLINE_RESERVE_MS. A throttle that does not fit is raised
+  to the handler, which can still answer within its budget.
+
+counters() has the throttles absorbed (retried) and surfaced (raised), the transient retries and the time
+spent waiting for tokens, for the life of the container.
+"""
+import os
+import time
+import random
+import threading
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+SERVICES = ("dynamodb", "s3")
+THROTTLE_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded",
+                  "LimitExceededException", "RequestThrottled", "Throttling", "ThrottledException",
+                  "TooManyRequestsException", "SlowDown", "RequestThrottledException"}
+TRANSIENT_STATUS = {500, 502, 503, 504}
+# Per call path profile (see aws_clients.PROFILES): first backoff ceiling and largest sleep, in seconds.
+BACKOFF = {
+    "interactive": {"base_delay": 0.025, "max_delay": 0.5},
+    "background": {"base_delay": 0.05, "max_delay": 5.0},
+    "transfer": {"base_delay": 0.1, "max_delay": 5.0},
+}
+# Time kept back from the invocation deadline for the handler to answer.
+DEADLINE_RESERVE = int(os.environ.get("DEADLINE_RESERVE_MS", "500")) / 1000
+MIN_RATE = float(os.environ.get("THROTTLE_MIN_RATE", "2"))
+DECREASE = 0.5
+
+_lock = threading.Lock()
+_limiters = {}
+_counters = {"throttles_absorbed": 0, "throttles_surfaced": 0, "transient_retries": 0, "token_wait_ms": 0}
+_deadline = None
+
+
+class TokenBucket:
+    """Send rate of one service: open until the first throttle, then AIMD on the fill rate (requests/s)."""
+
+    def __init__(self, min_rate=MIN_RATE, clock=time.monotonic):
+        self.min_rate = min_rate
+        self.clock = clock
+        self.enabled = False
+        self.rate = None
+        self.tokens = 0.0
+        self._lock = threading.Lock()
+        self._refilled = clock()
+        self._window_start = clock()
+        self._window_sent = 0
+        self.measured = 0.0
+
+    def _measure(self, now):
+        elapsed = now - self._window_start
+        if elapsed >= 1:
+            self.measured = (self.measured + self._window_sent / elapsed) / 2 if self.measured else self._window_sent / elapsed
+            self._window_start, self._window_sent = now, 0
+
+    def reserve(self):
+        """Take a token. Returns how long the caller must wait for it (0 while the bucket is open)."""
+        with self._lock:
+            now = self.clock()
+            self._measure(now)
+            self._window_sent += 1
+            if not self.enabled:
+                return 0.0
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def throttled(self):
+        with self._lock:
+            now = self.clock()
+            current = self._window_sent / max(now - self._window_start, 1e-3)
+            sending = max(self.measured, min(current, self.rate or current))
+            self.rate = max(self.min_rate, sending * DECREASE)
+            if not self.enabled:
+                self.enabled, self.tokens, self._refilled = True, 0.0, now
+
+    def succeeded(self):
+        with self._lock:
+            if self.enabled:
+                self.rate += 1 / self.rate
+
+
+def limiter(service):
+    bucket = _limiters.get(service)
+    if bucket is None:
+        with _lock:
+            bucket = _limiters.setdefault(service, TokenBucket())
+    return bucket
+
+
+def set_deadline(context):
+    """Deadline of the current invocation from the Lambda context (None: no deadline)."""
+    global _deadline
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    _deadline = time.monotonic() + remaining() / 1000 - DEADLINE_RESERVE if remaining else None
+
+
+def time_left():
+    return float("inf") if _deadline is None else _deadline - time.monotonic()
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def backoff(attempt, profile="interactive"):
+    """
+    Full-jitter delay before retry number attempt (1 for the first retry), or None when it would not leave
+    time for the call before the deadline.
+    """
+    settings = BACKOFF[profile]
+    delay = random.uniform(0, min(settings["max_delay"], settings["base_delay"] * 2 ** attempt))
+    return delay if delay + settings["base_delay"] < time_left() else None
+
+
+def unprocessed(service, attempt, total_attempts, profile="interactive"):
+    """
+    Partial throttling (UnprocessedItems / UnprocessedKeys) after attempt requests: feed the limiter and
+    return the delay before resending, or None when the attempts or the deadline are used up.
+    """
+    limiter(service).throttled()
+    delay = backoff(attempt, profile) if attempt < total_attempts else None
+    count("throttles_absorbed" if delay is not None else "throttles_surfaced")
+    return delay
+
+
+def classify(response, caught_exception):
+    """'throttle', 'transient' or None (success or an error retrying cannot fix)."""
+    if caught_exception is not None:
+        return "transient" if isinstance(caught_exception, (ConnectionError, HTTPClientError)) else None
+    http, parsed = response
+    code = parsed.get("Error", {}).get("Code")
+    if code in THROTTLE_CODES:
+        return "throttle"
+    if http.status_code in TRANSIENT_STATUS:
+        return "transient"
+    return None
+
+
+def install(client, service, profile, total_attempts):
+    """Register the limiter and the retry policy (at most total_attempts per call) on a DynamoDB or S3 client."""
+    bucket = limiter(service)
+
+    def before_send(**kwargs):
+        wait = bucket.reserve()
+        if wait:
+            wait = min(wait, max(0.0, time_left()))
+            count("token_wait_ms", round(wait * 1000))
+            time.sleep(wait)
+
+    def needs_retry(response=None, attempts=1, caught_exception=None, **kwargs):
+        kind = classify(response, caught_exception)
+        if kind is None:
+            if caught_exception is None and response[0].status_code < 300:
+                bucket.succeeded()
+            return None
+        if kind == "throttle":
+            bucket.throttled()
+        delay = backoff(attempts, profile) if attempts < total_attempts else None
+        if kind == "throttle":
+            count("throttles_absorbed" if delay is not None else "throttles_surfaced")
+        elif delay is not None:
+            count("transient_retries")
+        return delay
+
+    events = client.meta.events
+    events.register(f"before-send.{service}", before_send, unique_id="throttling-before-send")
+    events.register(f"needs-retry.{service}", needs_retry, unique_id="throttling-needs-retry")
+
+
+def reset():
+    """Forget the limiters, counters and deadline (tests)."""
+    global _deadline
+    with _lock:
+        _limiters.clear()
+        _counters.update(dict.fromkeys(_counters, 0))
+        _deadline = None